@@ -357,7 +357,9 @@ def create_config_from_post(post_data, config_path):
     # return the key and message for the POSTed parameter.
     config = Config(config_path)
     config.update(post_data)
-    validation_messages = config.do_validate(include_ssh=True)
+    # Only the POSTed keys are reported on, so only they need validating. The full configuration is
+    # still validated before anything is generated from it.
+    validation_messages = config.do_validate(include_ssh=True, only=post_data.keys())
 
     # TODO(cmaloney): Return all errors to the UI so it can display / decide how
     # it wants to log (new parameter might cause an error with an old set key)
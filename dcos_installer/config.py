@@ -94,7 +94,12 @@ class Config():
     def as_gen_format(self):
         return gen.stringify_configuration(self._config)
 
-    def do_validate(self, include_ssh):
+    def do_validate(self, include_ssh, only=None):
+        """Validate the configuration, returning a dictionary of error messages by key.
+
+        If only is given just those keys, what they depend on and the validation involving them
+        are checked, which is much quicker than validating the whole configuration.
+        """
         user_arguments = self.as_gen_format()
         extra_sources = [onprem_source]
         extra_targets = []
@@ -105,7 +110,10 @@ class Config():
         sources, targets, _ = gen.get_dcosconfig_source_target_and_templates(user_arguments, [], extra_sources)
         targets = targets + extra_targets
 
-        resolver = gen.internals.resolve_configuration(sources, targets)
+        if only is None:
+            resolver = gen.internals.resolve_configuration(sources, targets)
+        else:
+            resolver = gen.internals.resolve_partial_configuration(sources, targets, only)
         # TODO(cmaloney): kill this function and make the API return the structured
         # results api as was always intended rather than the flattened / lossy other
         # format. This will be an  API incompatible change. The messages format was
@@ -11,14 +11,18 @@ Operates strictly:
   - empty string is not the same as "not specified"
 """
 
+import hashlib
 import importlib.machinery
 import json
 import logging as log
+import lzma
 import os
 import os.path
+import tarfile
 import textwrap
 from copy import copy, deepcopy
-from tempfile import TemporaryDirectory
+from functools import lru_cache
+from io import BytesIO
 from typing import List
 
 import yaml
@@ -29,7 +33,7 @@ import gen.template
 from gen.exceptions import ValidationError
 from pkgpanda import PackageId
 from pkgpanda.build import hash_checkout
-from pkgpanda.util import json_prettyprint, load_string, make_tar, write_json
+from pkgpanda.util import json_prettyprint, load_string, write_json
 
 # List of all roles all templates should have.
 role_names = {"master", "slave", "slave_public"}
@@ -202,6 +206,13 @@ def load_templates(template_dict):
     return result
 
 
+# Generations with similar arguments render many templates to the same text.
+# Parsing that YAML again is much slower than copying the earlier result.
+@lru_cache(maxsize=64)
+def _load_rendered_yaml(text):
+    return yaml.safe_load(text)
+
+
 # Render the Jinja/YAML into YAML, then load the YAML and merge it to make the
 # final configuration files.
 def render_templates(template_dict, arguments):
@@ -218,7 +229,7 @@ def render_templates(template_dict, arguments):
                 assert len(templates) == 1
                 full_template = rendered_template
                 continue
-            template_data = yaml.safe_load(rendered_template)
+            template_data = deepcopy(_load_rendered_yaml(rendered_template))
 
             if full_template:
                 full_template = merge_dictionaries(full_template, template_data)
@@ -259,6 +270,41 @@ def write_to_non_taken(base_filename, json):
     return filename
 
 
+# pax header in generated packages recording the hash of their contents.
+package_content_hash_header = 'DCOS.content_sha256'
+
+
+def package_files(config):
+    """The files of a package config by their path inside the package, with their permissions."""
+    # Only contains package, root
+    assert config.keys() == {"package"}
+
+    files = dict()
+    for file_info in config["package"]:
+        assert file_info.keys() <= {"path", "content", "permissions"}
+        # the file has special mode defined, handle that.
+        if 'permissions' in file_info:
+            assert isinstance(file_info['permissions'], str)
+            mode = int(file_info['permissions'], 8)
+        else:
+            mode = 0o644
+        files[os.path.normpath(file_info['path'].lstrip('/'))] = (file_info['content'], mode)
+    return files
+
+
+def package_content_hash(files):
+    return hashlib.sha256(json.dumps(sorted(files.items())).encode()).hexdigest()
+
+
+def get_package_content_hash(package_filename):
+    """The content hash recorded in the package at package_filename, or None if there isn't one."""
+    try:
+        with tarfile.open(package_filename) as tar:
+            return tar.pax_headers.get(package_content_hash_header)
+    except (OSError, EOFError, tarfile.TarError, lzma.LZMAError):
+        return None
+
+
 def do_gen_package(config, package_filename):
     # Generate the specific dcos-config package.
     # Version will be setup-{sha1 of contents}
@@ -266,42 +312,56 @@ def do_gen_package(config, package_filename):
     # uniform permissions
     os.umask(0o000)
 
-    with TemporaryDirectory("gen_tmp_pkg") as tmpdir:
-
-        # Only contains package, root
-        assert config.keys() == {"package"}
-
-        # Write out the individual files
-        for file_info in config["package"]:
-            assert file_info.keys() <= {"path", "content", "permissions"}
-            if file_info['path'].startswith('/'):
-                path = tmpdir + file_info['path']
+    files = package_files(config)
+    content_hash = package_content_hash(files)
+
+    # Package ids are mostly derived from the configuration, so the same package is often
+    # generated again. Only build it if what's there has different contents.
+    if get_package_content_hash(package_filename) == content_hash:
+        log.info("Package filename: %s (unchanged)", package_filename)
+        return
+
+    # Every directory containing a file is in the package too, readable by users other
+    # than the owner (root).
+    directories = {'.'}
+    for path in files:
+        path = os.path.dirname(path)
+        while path and path not in directories:
+            directories.add(path)
+            path = os.path.dirname(path)
+
+    def make_info(path, mode):
+        info = tarfile.TarInfo('./' + path if path != '.' else '.')
+        info.mode = mode
+        info.uid = info.gid = 0
+        info.uname = info.gname = ''
+        info.mtime = 0
+        return info
+
+    # Ensure the output directory exists
+    if os.path.dirname(package_filename):
+        os.makedirs(os.path.dirname(package_filename), exist_ok=True)
+
+    # Build the package in memory and write it next to its final location, so a package
+    # which is there is always complete.
+    tmp_filename = package_filename + '.tmp'
+    with tarfile.open(
+            tmp_filename,
+            'w:xz',
+            format=tarfile.PAX_FORMAT,
+            pax_headers={package_content_hash_header: content_hash}) as tar:
+        for path in sorted(directories | set(files), key=lambda path: (path != '.', path)):
+            if path in directories:
+                info = make_info(path, 0o755)
+                info.type = tarfile.DIRTYPE
+                tar.addfile(info)
             else:
-                path = tmpdir + '/' + file_info['path']
-            try:
-                if os.path.dirname(path):
-                    os.makedirs(os.path.dirname(path), mode=0o755)
-            except FileExistsError:
-                pass
-
-            with open(path, 'w') as f:
-                f.write(file_info['content'])
-
-            # the file has special mode defined, handle that.
-            if 'permissions' in file_info:
-                assert isinstance(file_info['permissions'], str)
-                os.chmod(path, int(file_info['permissions'], 8))
-            else:
-                os.chmod(path, 0o644)
-
-        # Ensure the output directory exists
-        if os.path.dirname(package_filename):
-            os.makedirs(os.path.dirname(package_filename), exist_ok=True)
-
-        # Make the package top level directory readable by users other than the owner (root).
-        os.chmod(tmpdir, 0o755)
-
-        make_tar(package_filename, tmpdir)
+                content, mode = files[path]
+                data = content.encode()
+                info = make_info(path, mode)
+                info.size = len(data)
+                tar.addfile(info, BytesIO(data))
+    os.replace(tmp_filename, package_filename)
 
     log.info("Package filename: %s", package_filename)
 
@@ -449,7 +509,14 @@ def generate(
         extra_templates=list(),
         cc_package_files=list(),
         extra_sources=list(),
-        extra_targets=list()):
+        extra_targets=list(),
+        base=None):
+    """Generate the configuration packages and templates for the given arguments.
+
+    base may be the result of a previous generate() call with similar sources.
+    Arguments which would be calculated the same as they were for it are taken
+    from it rather than calculated again.
+    """
     # To maintain the old API where we passed arguments rather than the new name.
     user_arguments = arguments
     arguments = None
@@ -458,7 +525,8 @@ def generate(
         user_arguments, extra_templates, extra_sources)
 
     # TODO(cmaloney): Make it so we only get out the dcosconfig target arguments not all the config target arguments.
-    resolver = gen.internals.resolve_configuration(sources, targets + extra_targets)
+    resolver = gen.internals.resolve_configuration(
+        sources, targets + extra_targets, base.resolver if base is not None else None)
     status = resolver.status_dict
 
     if status['status'] == 'errors':
@@ -560,5 +628,6 @@ def generate(
         'arguments': argument_dict,
         'cluster_packages': cluster_package_info,
         'templates': rendered_templates,
-        'utils': utils
+        'utils': utils,
+        'resolver': resolver
     })
@@ -0,0 +1,316 @@
+"""Benchmarks for the gen pipeline
+
+Run with `python -m gen.benchmark`. Everything runs offline: nothing is
+uploaded and CloudFormation validation is replaced with a local stub.
+
+Each benchmark reports statistics over several rounds, like pytest-benchmark.
+Save results with `--json FILE` and compare a later run against them with
+`--compare FILE` to see how a change affected performance. Only compare
+results from the same machine.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from contextlib import contextmanager
+from tempfile import TemporaryDirectory
+from unittest import mock
+
+from pkg_resources import resource_string
+
+import gen
+import gen.build_deploy.aws
+import gen.build_deploy.azure
+import gen.build_deploy.bash
+import gen.internals
+import gen.template
+
+# The largest templates in the tree, which dominate template processing time.
+template_resources = [
+    'aws/templates/advanced/advanced-master.json',
+    'aws/templates/cloudformation.json',
+    'azure/templates/acs.json',
+    'azure/templates/azuredeploy.json',
+    'dcos-config.yaml',
+    'dcos-services.yaml',
+]
+
+# Numbers of masters and agents in the scaled up configurations.
+cluster_sizes = [(1, 10), (5, 1000), (7, 10000)]
+
+
+def measure(fn, repeat, setup=None):
+    """Statistics in seconds over repeat calls of fn. setup is called untimed before each call."""
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {
+        'min': min(times),
+        'max': max(times),
+        'mean': statistics.mean(times),
+        'stddev': statistics.stdev(times) if len(times) > 1 else 0.0,
+        'median': statistics.median(times),
+        'rounds': len(times),
+    }
+
+
+def result(benchmark, name, stats):
+    stats.update({'benchmark': benchmark, 'name': name})
+    return stats
+
+
+def clear_caches():
+    """Forget everything gen caches between generations, so the next one starts cold."""
+    gen.template.clear_parse_cache()
+    gen.internals.clear_pure_cache()
+    gen._load_rendered_yaml.cache_clear()
+
+
+@contextmanager
+def work_dir():
+    """Run in an empty directory, since generating writes packages to the current directory."""
+    old_cwd = os.getcwd()
+    with TemporaryDirectory(prefix='gen-benchmark') as tmpdir:
+        os.chdir(tmpdir)
+        try:
+            with open('ip-detect', 'w') as f:
+                f.write('#!/bin/sh\necho 10.0.0.1\n')
+            yield tmpdir
+        finally:
+            os.chdir(old_cwd)
+
+
+def remove_if_exists(filename):
+    try:
+        os.remove(filename)
+    except FileNotFoundError:
+        pass
+
+
+def onprem_arguments(num_masters, num_agents):
+    return {
+        'bootstrap_id': 'benchmark',
+        'bootstrap_url': 'http://example.com',
+        'bootstrap_variant': '',
+        'cluster_name': 'benchmark',
+        'exhibitor_storage_backend': 'static',
+        'ip_detect_filename': 'ip-detect',
+        'master_discovery': 'static',
+        'master_list': json.dumps(['10.0.{}.{}'.format(i // 250, i % 250 + 1) for i in range(num_masters)]),
+        'agent_list': json.dumps(['10.{}.{}.{}'.format(
+            1 + i // 62500, i // 250 % 250, i % 250 + 1) for i in range(num_agents)]),
+        'resolvers': json.dumps(['8.8.8.8', '8.8.4.4']),
+    }
+
+
+def bench_tokenize(repeat=5, scales=(1, 4, 16)):
+    """Time tokenizing each template, and the template repeated scale times.
+
+    Lexing is linear, so the time per scale should grow linearly too.
+    """
+    results = []
+    for name in template_resources:
+        text = resource_string(gen.__name__, name).decode()
+        for scale in scales:
+            corpus = text * scale
+            results.append(result('tokenize', '{} x{}'.format(name, scale), measure(
+                lambda: gen.template.Tokenizer(corpus), repeat)))
+    return results
+
+
+def bench_parse(repeat=5):
+    """Time parsing each template without the parse cache."""
+    results = []
+    for name in template_resources:
+        text = resource_string(gen.__name__, name).decode()
+        results.append(result('parse', name, measure(lambda: gen.template._parse_uncached(text), repeat)))
+    return results
+
+
+def bench_render(repeat=5, scales=(1, 100, 10000)):
+    """Time rendering a template with a for loop over scale items, plus replacements and a switch."""
+    template = gen.template.parse_str(
+        '{% for item in items %}- {{ item }}: {{ value }}\n{% endfor %}'
+        '{% switch choice %}{% case "a" %}{{ value }}{% case "b" %}b{% endswitch %}')
+    results = []
+    for scale in scales:
+        arguments = {'items': [str(i) for i in range(scale)], 'value': 'value', 'choice': 'a'}
+        results.append(result('render', 'for loop x{}'.format(scale), measure(
+            lambda: template.render(arguments), repeat)))
+    return results
+
+
+def bench_resolve(repeat=5):
+    """Time resolving the on-premises configuration for growing clusters."""
+    results = []
+    with work_dir():
+        for num_masters, num_agents in cluster_sizes:
+            arguments = onprem_arguments(num_masters, num_agents)
+
+            def resolve():
+                sources, targets, _ = gen.get_dcosconfig_source_target_and_templates(
+                    arguments, [], [gen.build_deploy.bash.onprem_source])
+                gen.internals.resolve_configuration(sources, targets)
+
+            results.append(result('resolve', '{} masters {} agents'.format(num_masters, num_agents), measure(
+                resolve, repeat, setup=clear_caches)))
+    return results
+
+
+def bench_merge_dictionaries(repeat=5, scales=(1, 100, 10000)):
+    """Time merging rendered YAML shaped dictionaries with scale files each."""
+    def make(prefix, scale):
+        return {
+            'package': [{'path': '/etc/{}/{}'.format(prefix, i), 'content': 'x' * 100} for i in range(scale)],
+            'nested': {str(i): {'list': [i], 'set': {i}} for i in range(scale)}}
+
+    results = []
+    for scale in scales:
+        inputs = []
+        results.append(result('merge_dictionaries', 'x{}'.format(scale), measure(
+            lambda: gen.merge_dictionaries(*inputs[-1]),
+            repeat,
+            # merge_dictionaries extends lists of its base, so each round needs new inputs.
+            setup=lambda: inputs.append((make('a', scale), make('b', scale))))))
+    return results
+
+
+def bench_gen_package(repeat=5, scales=(10, 100, 1000)):
+    """Time building a config package of scale files, and regenerating it unchanged."""
+    results = []
+    with work_dir():
+        for scale in scales:
+            config = {'package': [
+                {'path': '/etc/file-{}'.format(i), 'content': 'content {}\n'.format(i) * 50} for i in range(scale)]}
+            results.append(result('gen_package', '{} files'.format(scale), measure(
+                lambda: gen.do_gen_package(config, 'packages/test/test--setup.tar.xz'),
+                repeat,
+                setup=lambda: remove_if_exists('packages/test/test--setup.tar.xz'))))
+            results.append(result('gen_package', '{} files unchanged'.format(scale), measure(
+                lambda: gen.do_gen_package(config, 'packages/test/test--setup.tar.xz'), repeat)))
+    return results
+
+
+def bench_generate(repeat=3):
+    """Time generating the on-premises configuration from cold caches, and again with them warm."""
+    results = []
+    with work_dir():
+        for num_masters, num_agents in cluster_sizes:
+            arguments = onprem_arguments(num_masters, num_agents)
+            name = '{} masters {} agents'.format(num_masters, num_agents)
+
+            def generate():
+                gen.generate(arguments, extra_sources=[gen.build_deploy.bash.onprem_source])
+
+            def setup_cold():
+                clear_caches()
+                for root, _, files in os.walk('packages'):
+                    for filename in files:
+                        os.remove(os.path.join(root, filename))
+
+            results.append(result('generate', name, measure(generate, repeat, setup=setup_cold)))
+            results.append(result('generate', name + ' warm', measure(generate, repeat)))
+    return results
+
+
+def run_provider(module, variant_arguments):
+    list(module.do_create(
+        tag='benchmark',
+        build_name='benchmark',
+        reproducible_artifact_path='benchmark/commit/deadbeef',
+        commit='deadbeef',
+        variant_arguments=variant_arguments,
+        all_bootstraps=None))
+
+
+def bench_cloud_templates(repeat=1):
+    """Time generating the full AWS CloudFormation and Azure ARM template matrices."""
+    def variant_arguments(provider, extra):
+        arguments = {
+            'bootstrap_id': 'benchmark',
+            'bootstrap_url': 'http://example.com',
+            'bootstrap_variant': '',
+            'provider': provider}
+        arguments.update(extra)
+        return {None: arguments}
+
+    results = []
+    with work_dir(), mock.patch('gen.build_deploy.aws.validate_cf'):
+        aws_arguments = variant_arguments('aws', {'cloudformation_s3_url_full': 'https://example.com/cf'})
+        results.append(result('cloud_templates', 'aws', measure(
+            lambda: run_provider(gen.build_deploy.aws, aws_arguments), repeat, setup=clear_caches)))
+        azure_arguments = variant_arguments('azure', {'azure_download_url': 'https://example.com/azure'})
+        results.append(result('cloud_templates', 'azure', measure(
+            lambda: run_provider(gen.build_deploy.azure, azure_arguments), repeat, setup=clear_caches)))
+    return results
+
+
+benchmarks = {
+    'cloud_templates': bench_cloud_templates,
+    'gen_package': bench_gen_package,
+    'generate': bench_generate,
+    'merge_dictionaries': bench_merge_dictionaries,
+    'parse': bench_parse,
+    'render': bench_render,
+    'resolve': bench_resolve,
+    'tokenize': bench_tokenize,
+}
+
+
+def print_results(results, baseline=None):
+    columns = ['min', 'max', 'mean', 'stddev', 'median']
+    print("{:<20} {:<56}".format('benchmark', 'name') +
+          ''.join(" {:>10}".format(column) for column in columns) + " {:>6}".format('rounds') +
+          (" {:>8}".format('vs base') if baseline is not None else ''))
+    for item in results:
+        line = "{:<20} {:<56}".format(item['benchmark'], item['name'])
+        line += ''.join(" {:>10.4f}".format(item[column]) for column in columns)
+        line += " {:>6}".format(item['rounds'])
+        if baseline is not None:
+            base = baseline.get((item['benchmark'], item['name']))
+            line += " {:>7.2f}x".format(item['min'] / base['min']) if base else " {:>8}".format('new')
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, help='Number of rounds per benchmark. Defaults differ per benchmark.')
+    parser.add_argument('--json', help='Write the results to this file.')
+    parser.add_argument('--compare', help='Results file written by --json to compare the minimum times against.')
+    parser.add_argument('benchmark', nargs='*', help='Benchmarks to run, out of {}. Defaults to all.'.format(
+        ', '.join(sorted(benchmarks))))
+    args = parser.parse_args()
+
+    unknown = set(args.benchmark) - set(benchmarks)
+    if unknown:
+        parser.error("Unknown benchmarks: {}".format(', '.join(sorted(unknown))))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = {(item['benchmark'], item['name']): item for item in json.load(f)['results']}
+
+    # Don't shell out to git for the commit in every generation.
+    os.environ.setdefault('DCOS_IMAGE_COMMIT', 'deadbeefdeadbeefdeadbeefdeadbeefdeadbeef')
+
+    results = []
+    for name in args.benchmark or sorted(benchmarks):
+        kwargs = {'repeat': args.repeat} if args.repeat else {}
+        new_results = benchmarks[name](**kwargs)
+        print_results(new_results, baseline)
+        sys.stdout.flush()
+        results += new_results
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'python': sys.version, 'results': results}, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
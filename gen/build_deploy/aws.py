@@ -1,7 +1,9 @@
 """AWS Image Creation, Management, Testing"""
 
+import hashlib
 import json
 import logging
+import os
 import re
 from copy import deepcopy
 from typing import Tuple
@@ -17,13 +19,14 @@ import pkgpanda.util
 import release
 import release.storage
 from gen.internals import Source
-from pkgpanda.util import logger
+from pkgpanda.util import logger, write_json
 
 
 def get_ip_detect(name):
     return yaml.dump(resource_string('gen', 'ip-detect/{}.sh'.format(name)).decode())
 
 
+@gen.internals.pure
 def calculate_ip_detect_public_contents(aws_masters_have_public_ip):
     return get_ip_detect({'true': 'aws_public', 'false': 'aws'}[aws_masters_have_public_ip])
 
@@ -301,20 +304,198 @@ def render_cloudformation(cf_template, **kwds):
     return render_cloudformation_transform(cf_template, transform_func=transform_lines, **kwds)
 
 
-@retry(stop_max_attempt_number=5, wait_exponential_multiplier=1000)
+class CloudFormationError(Exception):
+    """A generated CloudFormation template is invalid."""
+
+
+cf_top_level_keys = {
+    'AWSTemplateFormatVersion', 'Conditions', 'Description', 'Mappings', 'Metadata', 'Outputs', 'Parameters',
+    'Resources', 'Transform'}
+cf_pseudo_parameters = {
+    'AWS::AccountId', 'AWS::NotificationARNs', 'AWS::NoValue', 'AWS::Partition', 'AWS::Region', 'AWS::StackId',
+    'AWS::StackName', 'AWS::URLSuffix'}
+# CloudFormation service limits.
+cf_max_template_size = 460800
+cf_max_resources = 200
+cf_max_parameters = 60
+cf_max_outputs = 60
+
+# Templates which passed validation by AWS, by cf_template_hash().
+cf_validation_cache_filename = os.path.expanduser('~/.cache/dcos-image/cloudformation-validation.json')
+_cf_validated = None
+
+
+def check_cf_structure(template_body):
+    """Return a list of the problems with a CloudFormation template found without calling AWS.
+
+    Checks the template's overall shape, the service limits and that everything referenced by
+    Ref, Fn::GetAtt, DependsOn, conditions and Fn::FindInMap is defined.
+    """
+    if len(template_body.encode()) > cf_max_template_size:
+        return ["Template is {} bytes, more than the {} bytes CloudFormation allows".format(
+            len(template_body.encode()), cf_max_template_size)]
+    try:
+        template = json.loads(template_body)
+    except ValueError as ex:
+        return ["Template isn't valid JSON: {}".format(ex)]
+    if not isinstance(template, dict):
+        return ["Template must be a JSON object"]
+
+    errors = []
+    for key in sorted(template.keys() - cf_top_level_keys):
+        errors.append("Unknown top level section {}".format(key))
+    sections = dict()
+    for key in cf_top_level_keys - {'AWSTemplateFormatVersion', 'Description', 'Transform'}:
+        sections[key] = template.get(key, dict())
+        if not isinstance(sections[key], dict):
+            errors.append("{} must be an object".format(key))
+            sections[key] = dict()
+    parameters, resources, outputs = sections['Parameters'], sections['Resources'], sections['Outputs']
+    conditions, mappings = sections['Conditions'], sections['Mappings']
+
+    if not resources:
+        errors.append("Template must define at least one resource")
+    for name, limit, section in [
+            ('resources', cf_max_resources, resources),
+            ('parameters', cf_max_parameters, parameters),
+            ('outputs', cf_max_outputs, outputs)]:
+        if len(section) > limit:
+            errors.append("Template has {} {}, more than the {} CloudFormation allows".format(
+                len(section), name, limit))
+
+    for name, parameter in sorted(parameters.items()):
+        if not isinstance(parameter, dict) or 'Type' not in parameter:
+            errors.append("Parameter {} must have a Type".format(name))
+        elif 'AllowedValues' in parameter and 'Default' in parameter and \
+                parameter['Default'] not in parameter['AllowedValues']:
+            errors.append("Default of parameter {} isn't one of its AllowedValues".format(name))
+
+    for name, resource in sorted(resources.items()):
+        if not isinstance(resource, dict) or not isinstance(resource.get('Type'), str):
+            errors.append("Resource {} must have a Type".format(name))
+            continue
+        if not resource['Type'].startswith(('AWS::', 'Custom::')):
+            errors.append("Resource {} has unknown type {}".format(name, resource['Type']))
+        if not isinstance(resource.get('Properties', dict()), dict):
+            errors.append("Properties of resource {} must be an object".format(name))
+        depends_on = resource.get('DependsOn', [])
+        for dependency in [depends_on] if isinstance(depends_on, str) else depends_on:
+            if dependency not in resources:
+                errors.append("Resource {} depends on undefined resource {}".format(name, dependency))
+        if 'Condition' in resource and resource['Condition'] not in conditions:
+            errors.append("Resource {} uses undefined condition {}".format(name, resource['Condition']))
+
+    for name, output in sorted(outputs.items()):
+        if not isinstance(output, dict) or 'Value' not in output:
+            errors.append("Output {} must have a Value".format(name))
+
+    def check_references(value, path):
+        if isinstance(value, list):
+            for i, item in enumerate(value):
+                check_references(item, '{}[{}]'.format(path, i))
+            return
+        if not isinstance(value, dict):
+            return
+        if len(value) == 1:
+            function, argument = next(iter(value.items()))
+            first = argument[0] if isinstance(argument, list) and argument else None
+            if function == 'Ref' and isinstance(argument, str):
+                if argument not in parameters and argument not in resources and argument not in cf_pseudo_parameters:
+                    errors.append("{}: Ref to undefined {}".format(path, argument))
+            elif function == 'Fn::GetAtt':
+                target = argument.split('.')[0] if isinstance(argument, str) else first
+                if target not in resources:
+                    errors.append("{}: Fn::GetAtt of undefined resource {}".format(path, target))
+            elif function == 'Fn::If' and isinstance(first, str):
+                if first not in conditions:
+                    errors.append("{}: Fn::If on undefined condition {}".format(path, first))
+            elif function == 'Condition' and isinstance(argument, str) and path.startswith('Conditions'):
+                if argument not in conditions:
+                    errors.append("{}: undefined condition {}".format(path, argument))
+            elif function == 'Fn::FindInMap' and isinstance(first, str):
+                if first not in mappings:
+                    errors.append("{}: Fn::FindInMap of undefined mapping {}".format(path, first))
+        for key, item in value.items():
+            check_references(item, '{}.{}'.format(path, key))
+
+    for key in ['Conditions', 'Outputs', 'Resources']:
+        check_references(sections[key], key)
+
+    return errors
+
+
+def cf_template_hash(template_body):
+    """Hash of everything in a template which can affect whether it's valid."""
+    template = json.loads(template_body)
+    # Metadata differs for every build but is never validated.
+    template.pop('Metadata', None)
+    return hashlib.sha256(json.dumps(template, sort_keys=True).encode()).hexdigest()
+
+
+def _load_cf_validated():
+    global _cf_validated
+    if _cf_validated is None:
+        try:
+            with open(cf_validation_cache_filename) as f:
+                _cf_validated = set(json.load(f))
+        except (OSError, ValueError):
+            _cf_validated = set()
+    return _cf_validated
+
+
+def _save_cf_validated():
+    try:
+        os.makedirs(os.path.dirname(cf_validation_cache_filename), exist_ok=True)
+        write_json(cf_validation_cache_filename, sorted(_cf_validated))
+    except OSError as ex:
+        logging.warning("Unable to save the CloudFormation validation cache: {}".format(ex))
+
+
+def _is_retryable(ex):
+    # Invalid templates are never going to become valid, only retry errors talking to AWS.
+    if isinstance(ex, botocore.exceptions.ClientError):
+        return ex.response.get('Error', {}).get('Code') == 'Throttling'
+    return True
+
+
+@retry(stop_max_attempt_number=5, wait_exponential_multiplier=1000, retry_on_exception=_is_retryable)
+def _validate_cf_remote(client, template_body):
+    client.validate_template(TemplateBody=template_body)
+
+
 def validate_cf(template_body):
+    """Validate a generated CloudFormation template.
+
+    The template is always checked offline by check_cf_structure(). If there are AWS test
+    credentials it is also validated by AWS, unless a template with the same contents already
+    was, so builds without network access still validate.
+    """
+    errors = check_cf_structure(template_body)
+    if errors:
+        print(template_body)
+        raise CloudFormationError("Invalid CloudFormation template:\n" + "\n".join(errors))
+
+    template_hash = cf_template_hash(template_body)
+    validated = _load_cf_validated()
+    if template_hash in validated:
+        return
+
     try:
         session = get_test_session()
     except Exception as ex:
-        logging.warning("Skipping  AWS CloudFormation validation because couldn't get a test session: {}".format(ex))
+        logging.warning(
+            "Only validating CloudFormation offline because couldn't get an AWS test session: {}".format(ex))
         return
     client = session.client('cloudformation')
     try:
-        client.validate_template(TemplateBody=template_body)
+        _validate_cf_remote(client, template_body)
     except botocore.exceptions.ClientError as ex:
         print(json.dumps(json.loads(template_body), indent=4))
         raise ex
 
+    validated.add(template_hash)
+    _save_cf_validated()
+
 
 def _as_cf_artifact(filename, cloudformation):
     return {
@@ -344,7 +525,7 @@ def gen_supporting_template():
             cloudformation)
 
 
-def make_advanced_bundle(variant_args, extra_sources, template_name, cc_params):
+def make_advanced_bundle(variant_args, extra_sources, template_name, cc_params, base=None):
     extra_templates = [
         'aws/dcos-config.yaml',
         'aws/templates/advanced/{}'.format(template_name)
@@ -373,7 +554,8 @@ def make_advanced_bundle(variant_args, extra_sources, template_name, cc_params):
         cc_package_files=cc_package_files,
         extra_sources=extra_sources + [aws_base_source],
         # TODO(cmaloney): Merge this with dcos_installer/backend.py::get_aws_advanced_target()
-        extra_targets=[gen.internals.Target(variables={'cloudformation_s3_url_full'})])
+        extra_targets=[gen.internals.Target(variables={'cloudformation_s3_url_full'})],
+        base=base)
 
     cloud_config = results.templates['cloud-config.yaml']
 
@@ -404,7 +586,9 @@ def make_advanced_bundle(variant_args, extra_sources, template_name, cc_params):
     return (cloudformation, results)
 
 
-def gen_advanced_template(arguments, variant_prefix, reproducible_artifact_path, os_type):
+def gen_advanced_template(arguments, variant_prefix, reproducible_artifact_path, os_type, base=None):
+    # Each template is generated from the previous one's resolution, so only
+    # the arguments depending on what differs between them are recalculated.
     for node_type in ['master', 'priv-agent', 'pub-agent']:
         # TODO(cmaloney): This forcibly overwriting arguments might overwrite a user set argument
         # without noticing (such as exhibitor_storage_backend)
@@ -431,7 +615,9 @@ def gen_advanced_template(arguments, variant_prefix, reproducible_artifact_path,
                 bundle = make_advanced_bundle(arguments,
                                               [node_source, local_source, num_masters_source],
                                               template_name,
-                                              params)
+                                              params,
+                                              base)
+                base = bundle[1]
                 yield from _as_artifact('{}.json'.format(master_tk), bundle)
 
                 # Zen template corresponding to this number of masters
@@ -448,7 +634,9 @@ def gen_advanced_template(arguments, variant_prefix, reproducible_artifact_path,
             bundle = make_advanced_bundle(arguments,
                                           [node_source, local_source],
                                           template_name,
-                                          params)
+                                          params,
+                                          base)
+            base = bundle[1]
             yield from _as_artifact('{}-{}'.format(os_type, template_name), bundle)
 
 
@@ -466,7 +654,7 @@ aws_simple_source = Source({
 })
 
 
-def gen_simple_template(variant_prefix, filename, arguments, extra_source):
+def gen_simple_template(variant_prefix, filename, arguments, extra_source, base=None):
     results = gen.generate(
         arguments=arguments,
         extra_templates=[
@@ -482,7 +670,8 @@ def gen_simple_template(variant_prefix, filename, arguments, extra_source):
             '/etc/exhibitor',
             '/etc/mesos-master-provider',
             '/etc/extra_master_addresses'],
-        extra_sources=[aws_base_source, aws_simple_source, extra_source])
+        extra_sources=[aws_base_source, aws_simple_source, extra_source],
+        base=base)
 
     cloud_config = results.templates['cloud-config.yaml']
 
@@ -518,6 +707,7 @@ def gen_simple_template(variant_prefix, filename, arguments, extra_source):
         validate_cf(cloudformation)
 
     yield from _as_artifact_and_pkg(variant_prefix, filename, (cloudformation, results))
+    return results
 
 
 button_template = "<a href='https://console.aws.amazon.com/cloudformation/home?region={region_id}#/stacks/new?templateURL={cloudformation_full_s3_url}/{template_name}.cloudformation.json'><img src='https://s3.amazonaws.com/cloudformation-examples/cloudformation-launch-stack.png' alt='Launch stack button'></a>"  # noqa
@@ -561,26 +751,40 @@ def gen_buttons(build_name, reproducible_artifact_path, tag, commit, variant_arg
         })
 
 
-def do_create(tag, build_name, reproducible_artifact_path, commit, variant_arguments, all_bootstraps):
+def create_parts(variants):
+    """Split do_create into parts which can be built at the same time, each given as do_create keyword arguments.
+
+    Every template of a variant is generated from the one before it, so each
+    variant is one part. The pages common to all variants are the last part.
+    """
+    return [{'variants': [variant], 'common': False} for variant in sorted(variants, key=pkgpanda.util.variant_str)] + \
+        [{'variants': [], 'common': True}]
+
+
+def do_create(tag, build_name, reproducible_artifact_path, commit, variant_arguments, all_bootstraps,
+              variants=None, common=True):
     # Generate the single-master and multi-master templates.
 
     for bootstrap_variant, variant_base_args in variant_arguments.items():
+        if variants is not None and bootstrap_variant not in variants:
+            continue
         variant_prefix = pkgpanda.util.variant_prefix(bootstrap_variant)
 
-        def make(num_masters, filename):
+        def make(num_masters, filename, base):
             num_masters_source = Source()
             num_masters_source.add_must('num_masters', str(num_masters))
-            yield from gen_simple_template(
+            return (yield from gen_simple_template(
                 variant_prefix,
                 filename,
                 variant_base_args,
-                num_masters_source)
+                num_masters_source,
+                base))
 
         # Single master templates
-        yield from make(1, 'single-master.cloudformation.json')
+        base = yield from make(1, 'single-master.cloudformation.json', None)
 
         # Multi master templates
-        yield from make(3, 'multi-master.cloudformation.json')
+        base = yield from make(3, 'multi-master.cloudformation.json', base)
 
         # Advanced templates
         for os_type in ['coreos', 'el7']:
@@ -588,7 +792,11 @@ def do_create(tag, build_name, reproducible_artifact_path, commit, variant_argum
                 variant_base_args,
                 variant_prefix,
                 reproducible_artifact_path,
-                os_type)
+                os_type,
+                base)
+
+    if not common:
+        return
 
     # Button page linking to the basic templates.
     button_page = gen_buttons(build_name, reproducible_artifact_path, tag, commit, variant_arguments)
@@ -118,7 +118,7 @@ def render_arm(
     return json.dumps(template_json)
 
 
-def gen_templates(gen_arguments, arm_template, extra_sources):
+def gen_templates(gen_arguments, arm_template, extra_sources, base=None):
     '''
     Render the cloud_config template given a particular set of options
 
@@ -126,6 +126,7 @@ def gen_templates(gen_arguments, arm_template, extra_sources):
                      input arguments which get filled in/prompted for.
     @param arm_template: string, path to the source arm template for rendering
                          by the gen library (e.g. 'azure/templates/azuredeploy.json')
+    @param base: result of a previous gen.generate() to reuse unchanged arguments from
     '''
     results = gen.generate(
         arguments=gen_arguments,
@@ -137,7 +138,8 @@ def gen_templates(gen_arguments, arm_template, extra_sources):
             '/etc/ui-config.json',
             '/etc/mesos-master-provider',
             '/etc/master_list'],
-        extra_sources=[azure_base_source] + extra_sources)
+        extra_sources=[azure_base_source] + extra_sources,
+        base=base)
 
     cloud_config = results.templates['cloud-config.yaml']
 
@@ -209,14 +211,15 @@ azure_acs_source = Source({
 })
 
 
-def make_template(num_masters, gen_arguments, varietal, bootstrap_variant_prefix):
+def make_template(num_masters, gen_arguments, varietal, bootstrap_variant_prefix, base=None):
     '''
-    Return a tuple: the generated template for num_masters and the artifact dict.
+    Yield the artifacts for the template for num_masters, returning the gen.generate() results.
 
     @param num_masters: int, number of master nodes to embed in the generated template
     @param gen_arguments: dict, args to pass to the gen library. These are user
                           input arguments which get filled in/prompted for.
     @param varietal: string, indicate template varietal to build for either 'acs' or 'dcos'
+    @param base: result of a previous gen.generate() to reuse unchanged arguments from
     '''
 
     master_list_source = Source()
@@ -226,12 +229,14 @@ def make_template(num_masters, gen_arguments, varietal, bootstrap_variant_prefix
         arm, results = gen_templates(
             gen_arguments,
             'azuredeploy',
-            extra_sources=[master_list_source, azure_dcos_source])
+            extra_sources=[master_list_source, azure_dcos_source],
+            base=base)
     elif varietal == 'acs':
         arm, results = gen_templates(
             gen_arguments,
             'acs',
-            extra_sources=[master_list_source, azure_acs_source])
+            extra_sources=[master_list_source, azure_acs_source],
+            base=base)
     else:
         raise ValueError("Unknown Azure varietal specified")
 
@@ -241,17 +246,38 @@ def make_template(num_masters, gen_arguments, varietal, bootstrap_variant_prefix
         'local_content': arm,
         'content_type': 'application/json; charset=utf-8'
     }
-
-
-def do_create(tag, build_name, reproducible_artifact_path, commit, variant_arguments, all_bootstraps):
-    for arm_t in ['dcos', 'acs']:
-        for num_masters in [1, 3, 5]:
-            for bootstrap_name, gen_arguments in variant_arguments.items():
-                yield from make_template(
+    return results
+
+
+def create_parts(variants):
+    """Split do_create into parts which can be built at the same time, each given as do_create keyword arguments.
+
+    Every template of a variant is generated from the one before it, so each
+    variant is one part. The pages common to all variants are the last part.
+    """
+    return [{'variants': [variant], 'common': False} for variant in sorted(variants, key=pkgpanda.util.variant_str)] + \
+        [{'variants': [], 'common': True}]
+
+
+def do_create(tag, build_name, reproducible_artifact_path, commit, variant_arguments, all_bootstraps,
+              variants=None, common=True):
+    for bootstrap_name, gen_arguments in variant_arguments.items():
+        if variants is not None and bootstrap_name not in variants:
+            continue
+        # Every template of a variant is generated from the variant's previous
+        # template, so only the arguments depending on what differs are recalculated.
+        base = None
+        for arm_t in ['dcos', 'acs']:
+            for num_masters in [1, 3, 5]:
+                base = yield from make_template(
                     num_masters,
                     gen_arguments,
                     arm_t,
-                    pkgpanda.util.variant_prefix(bootstrap_name))
+                    pkgpanda.util.variant_prefix(bootstrap_name),
+                    base)
+
+    if not common:
+        return
 
     yield {
         'channel_path': 'azure.html',
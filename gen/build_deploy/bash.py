@@ -1,8 +1,11 @@
 """Generates a bash script for installing by hand or light config management integration"""
 
+import hashlib
 import os
 import subprocess
 import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import pkg_resources
 import py
@@ -571,11 +574,87 @@ def make_bash(gen_out):
     return 'dcos_install.sh'
 
 
+_genconf_base_image = None
+_genconf_base_image_lock = threading.Lock()
+
+
+def make_genconf_base_image():
+    """Build the image holding the installer layers common to every variant, once per process.
+
+    The per variant images are built on top of it so that concurrent builds share its layers rather
+    than each building their own copy. Returns the name of the image.
+    """
+    global _genconf_base_image
+    with _genconf_base_image_lock:
+        if _genconf_base_image is None:
+            dockerfile = pkg_resources.resource_string(__name__, 'bash/Dockerfile.base')
+            image_name = 'mesosphere/dcos-genconf-base:' + hashlib.sha1(dockerfile).hexdigest()[:18]
+            with tempfile.TemporaryDirectory() as build_dir:
+                with open(build_dir + '/Dockerfile', 'wb') as f:
+                    f.write(dockerfile)
+                print("Building docker base image", image_name)
+                subprocess.check_call(['docker', 'build', '-t', image_name, build_dir])
+            _genconf_base_image = image_name
+        return _genconf_base_image
+
+
+def stream_output(cmd, out):
+    """Copy the standard output of cmd into out as it is produced.
+
+    Returns the number of bytes written and their sha256 hex digest.
+    """
+    hasher = hashlib.sha256()
+    size = 0
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    with process.stdout:
+        for chunk in iter(lambda: process.stdout.read(1024 * 1024), b''):
+            hasher.update(chunk)
+            out.write(chunk)
+            size += len(chunk)
+    if process.wait() != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
+    return size, hasher.hexdigest()
+
+
+def write_installer_script(filename, payload_cmd, **format_args):
+    """Write the self extracting installer script with the output of payload_cmd appended to it.
+
+    The payload's offset, length and sha256 are written into the script so that it can seek
+    straight to the payload and check it while loading it. They are fixed width so the script
+    can be filled in once the payload has been written without moving it.
+    """
+    template = pkg_resources.resource_string(__name__, 'bash/dcos_generate_config.sh.in').decode()
+
+    def render(offset, length, sha256):
+        return template.format(
+            payload_offset='{:020d}'.format(offset),
+            payload_length='{:020d}'.format(length),
+            payload_sha256=sha256,
+            **format_args).encode()
+
+    offset = len(render(0, 0, '0' * 64))
+    script = render(offset, 0, '0' * 64)
+    assert len(script) == offset
+
+    try:
+        with open(filename, 'wb') as f:
+            f.write(script)
+            length, sha256 = stream_output(payload_cmd, f)
+            script = render(offset, length, sha256)
+            assert len(script) == offset
+            f.seek(0)
+            f.write(script)
+    except BaseException:
+        os.remove(filename)
+        raise
+    subprocess.check_call(['chmod', '+x', filename])
+
+
 def make_installer_docker(variant, bootstrap_id, installer_bootstrap_id):
     assert len(bootstrap_id) > 0
 
     image_version = util.dcos_image_commit[:18] + '-' + bootstrap_id[:18]
-    genconf_tar = "dcos-genconf." + image_version + ".tar"
+    container_name = "dcos-genconf." + image_version + ".tar"
     installer_filename = "packages/cache/dcos_generate_config." + pkgpanda.util.variant_prefix(variant) + "sh"
     bootstrap_filename = bootstrap_id + ".bootstrap.tar.xz"
     bootstrap_active_filename = bootstrap_id + ".active.json"
@@ -602,6 +681,7 @@ def make_installer_docker(variant, bootstrap_id, installer_bootstrap_id):
                 pkg_resources.resource_string(__name__, 'bash/' + base_name + '.in').decode().format(**format_args))
 
         fill_template('Dockerfile', {
+            'base_image': make_genconf_base_image(),
             'installer_bootstrap_filename': installer_bootstrap_filename,
             'bootstrap_filename': bootstrap_filename,
             'bootstrap_active_filename': bootstrap_active_filename,
@@ -633,20 +713,12 @@ def make_installer_docker(variant, bootstrap_id, installer_bootstrap_id):
         subprocess.check_call(['docker', 'build', '-t', docker_image_name, build_dir])
 
         print("Building", installer_filename)
-        pkgpanda.util.write_string(
+        write_installer_script(
             installer_filename,
-            pkg_resources.resource_string(__name__, 'bash/dcos_generate_config.sh.in').decode().format(
-                genconf_tar=genconf_tar,
-                docker_image_name=docker_image_name,
-                variant=variant) + '\n#EOF#\n')
-        subprocess.check_call(
             ['docker', 'save', docker_image_name],
-            stdout=open(genconf_tar, 'w'))
-        subprocess.check_call(['tar', 'cvf', '-', genconf_tar], stdout=open(installer_filename, 'a'))
-        subprocess.check_call(['chmod', '+x', installer_filename])
-
-        # Cleanup
-        subprocess.check_call(['rm', genconf_tar])
+            container_name=container_name,
+            docker_image_name=docker_image_name,
+            variant=variant)
 
     return installer_filename
 
@@ -675,21 +747,25 @@ def do_create(tag, build_name, reproducible_artifact_path, commit, variant_argum
 
     Outputs the generated dcos_generate_config.sh as it's artifacts.
     """
-    # TODO(cmaloney): Build installers in parallel.
-    # Variants are sorted for stable ordering.
-    for variant, bootstrap_info in sorted(variant_arguments.items(),
-                                          key=lambda kv: pkgpanda.util.variant_str(kv[0])):
-        with logger.scope("Building installer for variant: ".format(pkgpanda.util.variant_name(variant))):
+    # The installers are independent of each other and their builds spend almost all of their time in
+    # docker, so build them all at once. Results are yielded in sorted variant order for stable ordering.
+    variants = sorted(variant_arguments.items(), key=lambda kv: pkgpanda.util.variant_str(kv[0]))
+    with ThreadPoolExecutor(max_workers=max(len(variants), 1)) as executor:
+        installers = []
+        for variant, bootstrap_info in variants:
             bootstrap_installer_name = '{}installer'.format(pkgpanda.util.variant_prefix(variant))
-            bootstrap_installer_id = all_bootstraps[bootstrap_installer_name]
-
-            installer_filename = make_installer_docker(variant, bootstrap_info['bootstrap_id'],
-                                                       bootstrap_installer_id)
-
-            yield {
-                'channel_path': 'dcos_generate_config.{}sh'.format(pkgpanda.util.variant_prefix(variant)),
-                'local_path': installer_filename
-            }
+            installers.append((variant, executor.submit(
+                make_installer_docker,
+                variant,
+                bootstrap_info['bootstrap_id'],
+                all_bootstraps[bootstrap_installer_name])))
+
+        for variant, installer in installers:
+            with logger.scope("Building installer for variant: {}".format(pkgpanda.util.variant_name(variant))):
+                yield {
+                    'channel_path': 'dcos_generate_config.{}sh'.format(pkgpanda.util.variant_prefix(variant)),
+                    'local_path': installer.result()
+                }
 
     # Build dcos-launch
     # TODO(cmaloney): This really doesn't belong to here, but it's the best place it fits for now.
@@ -122,6 +122,16 @@ def calculate_environment_variable(name):
     return value
 
 
+def file_state(filename):
+    """Summary of a file which changes whenever its contents likely do, for pure calculators."""
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return (os.path.abspath(filename), stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+@gen.internals.pure(extra_key=lambda: (os.getenv('DCOS_IMAGE_COMMIT'), os.getcwd()))
 def calulate_dcos_image_commit():
     dcos_image_commit = os.getenv('DCOS_IMAGE_COMMIT', None)
 
@@ -178,6 +188,7 @@ def calculate_mesos_log_directory_max_files(mesos_log_retention_mb):
     return str(25 + int(calculate_mesos_log_retention_count(mesos_log_retention_mb)))
 
 
+@gen.internals.pure(extra_key=lambda ip_detect_filename: file_state(ip_detect_filename))
 def calculate_ip_detect_contents(ip_detect_filename):
     assert os.path.exists(ip_detect_filename), "ip-detect script `{}` must exist".format(ip_detect_filename)
     return yaml.dump(open(ip_detect_filename, encoding='utf-8').read())
@@ -187,6 +198,7 @@ def calculate_ip_detect_public_contents(ip_detect_contents):
     return ip_detect_contents
 
 
+@gen.internals.pure
 def calculate_rexray_config_contents(rexray_config):
     return yaml.dump(
         # Assume block style YAML (not flow) for REX-Ray config.
@@ -383,6 +395,7 @@ def calculate_adminrouter_auth_enabled(oauth_enabled):
     return oauth_enabled
 
 
+@gen.internals.pure
 def calculate_config_yaml(user_arguments):
     return textwrap.indent(
         yaml.dump(json.loads(user_arguments), default_style='|', default_flow_style=False, indent=2),
@@ -1,6 +1,8 @@
 import copy
 import inspect
 import logging
+import threading
+from collections import OrderedDict
 from contextlib import contextmanager
 from functools import partial, partialmethod
 from typing import Callable, List, Tuple, Union
@@ -41,6 +43,53 @@ def validate_one_of(val: str, valid_values) -> None:
         raise AssertionError("Must be one of {}. Got '{}'.".format(options_string, val))
 
 
+def pure(function=None, *, extra_key=None):
+    """Declare a calculator's result depends only on its arguments.
+
+    Results of pure calculators are kept across resolutions and reused whenever
+    the calculator is called with the same arguments again. Calculators which
+    also depend on something outside their arguments, such as a file or an
+    environment variable, pass extra_key. It is called with the calculator's
+    arguments and returns a hashable summary of that outside state, which
+    becomes part of the cache key.
+    """
+    if function is None:
+        return partial(pure, extra_key=extra_key)
+    function.pure_extra_key = extra_key if extra_key is not None else lambda **kwargs: None
+    return function
+
+
+# Results of pure calculators, most recently used last.
+_pure_cache = OrderedDict()
+_pure_cache_lock = threading.Lock()
+pure_cache_size = 4096
+
+
+def clear_pure_cache():
+    with _pure_cache_lock:
+        _pure_cache.clear()
+
+
+def call_calculator(function: Callable, kwargs: dict):
+    """Call function with kwargs, reusing a previous result if it is pure."""
+    extra_key = getattr(function, 'pure_extra_key', None)
+    if extra_key is None:
+        return function(**kwargs)
+
+    key = (function, tuple(sorted(kwargs.items())), extra_key(**kwargs))
+    with _pure_cache_lock:
+        if key in _pure_cache:
+            _pure_cache.move_to_end(key)
+            return _pure_cache[key]
+
+    value = function(**kwargs)
+    with _pure_cache_lock:
+        _pure_cache[key] = value
+        while len(_pure_cache) > pure_cache_size:
+            _pure_cache.popitem(last=False)
+    return value
+
+
 def function_id(function: Callable):
     return {
         'name': function.__name__,
@@ -70,6 +119,9 @@ class Setter:
         self.conditions = conditions
         self.is_user = is_user
         self._value_id = hash_checkout(value_id(value))
+        # Functions compare by identity, so two setters with equal keys always
+        # calculate the same way.
+        self.key = (name, value, is_optional, tuple(tuple(condition) for condition in conditions), is_user)
 
         def get_value():
             return value
@@ -385,6 +437,17 @@ class Validator:
             for parameter, function in target.yield_validates():
                 self._validate_by_arg.setdefault(parameter, list()).append(function)
 
+    def same_single_validation(self, other, name: str):
+        """True if other validates the given parameter name with the same functions."""
+        def function_key(function):
+            # Switch validation functions are rebuilt for every target, compare what they check.
+            if isinstance(function, partial):
+                return (function.func, function.args, set(function.keywords.get('valid_values', ())))
+            return function
+
+        return ([function_key(fn) for fn in self._validate_by_arg.get(name, [])] ==
+                [function_key(fn) for fn in other._validate_by_arg.get(name, [])])
+
     def validate_single(self, name: str, value: str):
         """Calls all validate functions which validate the given parameter name
 
@@ -401,8 +464,15 @@ class Validator:
     # how / when each is run. Moving the multi-argument validation to as soon as possible after an
     # argument set is finalized rather than one big pass at the end would likely make it much
     # cleaner.
-    def yield_multi_argument_validate_errors(self, arguments: ArgumentDict):
+    def multi_argument_parameter_sets(self, names):
+        """The parameter sets of the multi-argument validate functions which take any of names."""
+        names = set(names)
+        return [parameter_set for parameter_set in self._multi_arg_validate if parameter_set & names]
+
+    def yield_multi_argument_validate_errors(self, arguments: ArgumentDict, parameter_sets=None):
         for parameter_set, validate_fns in self._multi_arg_validate.items():
+            if parameter_sets is not None and parameter_set not in parameter_sets:
+                continue
             # Build up argument map for validate function. If any arguments are
             # unset then skip this validate function.
             kwargs = dict()
@@ -438,9 +508,15 @@ class Validator:
 # dependencies.
 # TODO(cmaloney): Separate chain / path building when unwinding from the root
 #                 error messages.
+#
+# A Resolver may be given the Resolver of a previous, similar configuration as
+# its base. Arguments whose setters, validation and inputs are all the same as
+# in the base take the value calculated there rather than being calculated
+# again, so only the arguments which depend on what changed are recalculated.
 class Resolver:
-    def __init__(self, setters, validate_fns, targets):
+    def __init__(self, setters, validate_fns, targets, base=None):
         self._resolved = False
+        self._base = base
         self._setters = setters
         self._targets = targets
 
@@ -455,6 +531,12 @@ class Resolver:
 
         self._contexts = list()
 
+        # The names each argument read while being calculated, in the order they were read.
+        self._dependencies = dict()
+
+        # Number of arguments taken from the base rather than calculated.
+        self.reused_count = 0
+
         self._validator = Validator(validate_fns, targets)
 
     def _calculate(self, resolvable):
@@ -509,7 +591,7 @@ class Resolver:
             kwargs[parameter] = self._resolve_name(parameter)
 
         try:
-            value = setter.calc(**kwargs)
+            value = call_calculator(setter.calc, kwargs)
             self._validator.validate_single(resolvable.name, value)
         except AssertionError as ex:
             raise CalculatorError(ex.args[0], [ex]) from ex
@@ -541,7 +623,10 @@ class Resolver:
         # the second time the resolvable was encountered, and then trying to finalize a second time
         # when the stack unwinds.
         with self._stack_layer(resolvable.name):
+            self._dependencies[resolvable.name] = list()
             try:
+                if self._reuse_from_base(resolvable):
+                    return
                 resolvable.finalize_value(*self._calculate(resolvable))
             except CalculatorError as ex:
                 resolvable.finalize_error(ex)
@@ -554,7 +639,45 @@ class Resolver:
                 self._errors[resolvable.name] = msg
                 raise
 
+    def _reuse_from_base(self, resolvable):
+        """Finalize resolvable with the value from the base resolver if it would calculate the same.
+
+        That is the case when it has the same setters and validation functions, and every
+        argument its calculation read in the base resolves to the same value here.
+        """
+        if self._base is None:
+            return False
+        name = resolvable.name
+        base_resolvable = self._base._arguments.get(name)
+        if base_resolvable is None or not base_resolvable.is_resolved:
+            return False
+        base_setters = self._base._setters.get(name, list())
+        setters = self._setters.get(name, list())
+        if [setter.key for setter in setters] != [setter.key for setter in base_setters]:
+            return False
+        if not self._validator.same_single_validation(self._base._validator, name):
+            return False
+
+        # Resolving the dependencies in the order the base did makes the same decisions about
+        # conditions as calculating would, stopping at the first difference.
+        for dependency in self._base._dependencies[name]:
+            try:
+                value = self._resolve_name(dependency)
+            except (CalculatorError, SkipError):
+                return False
+            if value != self._base._arguments[dependency].value:
+                return False
+
+        setter = setters[base_setters.index(base_resolvable.setter)]
+        resolvable.finalize_value(base_resolvable.value, setter)
+        self.reused_count += 1
+        return True
+
     def _resolve_name(self, name):
+        # Names read while checking whether the base's value can be reused are the start of what
+        # calculating reads, so only the first read of each is recorded.
+        if self._eval_stack and name not in self._dependencies[self._eval_stack[-1]]:
+            self._dependencies[self._eval_stack[-1]].append(name)
         try:
             resolvable = self._arguments[name]
 
@@ -629,6 +752,33 @@ class Resolver:
         for parameter_set, error in self._validator.yield_multi_argument_validate_errors(self._arguments):
             self._errors[parameter_set] = error
 
+        # Don't keep a chain of every previous resolution alive.
+        self._base = None
+
+    def resolve_partial(self, names):
+        """Calculate only the given arguments and what they depend on.
+
+        The validate functions which take several arguments are run if any of
+        their arguments is one of names. Their other arguments are calculated
+        to do so.
+        """
+        assert not self._resolved, "Resolvers should only be resolved once"
+        self._resolved = True
+
+        for name in names:
+            self._ensure_finalized(self._arguments[name])
+
+        parameter_sets = self._validator.multi_argument_parameter_sets(names)
+        for parameter_set in parameter_sets:
+            for name in parameter_set:
+                self._ensure_finalized(self._arguments[name])
+
+        for parameter_set, error in self._validator.yield_multi_argument_validate_errors(
+                self._arguments, parameter_sets):
+            self._errors[parameter_set] = error
+
+        self._base = None
+
     @property
     def arguments(self):
         assert self._resolved, "Can't get arguments until they've been resolved"
@@ -671,41 +821,32 @@ class Resolver:
         }
 
 
-def resolve_configuration(sources: List[Source], targets: List[Target]):
-
-    # Merge the sources into a big dictionary of setters + validators, ensuring
-    # that all setters are either strings or functions.
-    validate = list()
-    setters = dict()
-
-    # Merge all the config targets into one big group of setters for providing
-    # to the calculator
+def merge_sources(sources: List[Source]):
+    """Merge the setters and validate functions of all the sources for a Resolver."""
     # TODO(cmaloney): The setter management / set code is very similar to that in ConfigTarget, they
     # could probably be joined.
+    setters = dict()
+    validate = list()
     for source in sources:
         for name, setter_list in source.setters.items():
+            # TODO(cmaloney): Make a setter manager already...
             setters.setdefault(name, list())
             setters[name] += setter_list
         validate += source.validate
+    return setters, validate
+
+
+def resolve_configuration(sources: List[Source], targets: List[Target], base=None):
 
     # TODO(cmaloney): Re-enable this after sorting out how to have "optional" config targets which
     # add in extra "acceptable" parameters (SSH Config, AWS Advanced Template config, etc)
     # validate_all_arguments_match_parameters(mandatory_parameters, setters, user_arguments)
 
-    user_config = Source(is_user=True)
-
     # Merge all the seters and validate function into one uber list
-    setters = copy.deepcopy(user_config.setters)
-    validate = copy.deepcopy(user_config.validate)
-    for source in sources:
-        for name, setter_list in source.setters.items():
-            # TODO(cmaloney): Make a setter manager already...
-            setters.setdefault(name, list())
-            setters[name] += setter_list
-        validate += source.validate
+    setters, validate = merge_sources(sources)
 
     # Use setters to caluclate every required parameter
-    resolver = Resolver(setters, validate, targets)
+    resolver = Resolver(setters, validate, targets, base)
     resolver.resolve()
 
     def target_finalized(target):
@@ -721,3 +862,17 @@ def resolve_configuration(sources: List[Source], targets: List[Target]):
     validate_arguments_strings(arg_dict)
 
     return resolver
+
+
+def resolve_partial_configuration(sources: List[Source], targets: List[Target], names):
+    """Resolve just the given argument names, everything they depend on and the validation of those.
+
+    This is much quicker than resolve_configuration() when checking a few arguments, such as
+    each time one field changes in a form. Its status_dict only reports problems found in that
+    part of the configuration, so only resolve_configuration() says whether the whole
+    configuration is valid.
+    """
+    setters, validate = merge_sources(sources)
+    resolver = Resolver(setters, validate, targets)
+    resolver.resolve_partial(names)
+    return resolver
@@ -15,6 +15,8 @@
 #   switch <identifier>
 #   case <string>:
 #   endswith
+import hashlib
+import re
 from typing import Optional, Tuple
 
 from pkg_resources import resource_string
@@ -22,6 +24,7 @@ from pkg_resources import resource_string
 import gen.internals
 
 identifier_valid_characters = 'abcdefghijklmnopqrstuvwxyz_0123456789'
+identifier_regex = re.compile('[{}]*'.format(identifier_valid_characters))
 
 
 class SyntaxError(Exception):
@@ -41,99 +44,126 @@ class Tokenizer():
 
     def __init__(self, corpus: str):
         self.__corpus = corpus
-        self.__to_lex = corpus
+        # Index of the next character to lex. The corpus is never copied or
+        # sliced while lexing, so lexing is linear in the size of the corpus.
+        self.__pos = 0
+        self.__end = len(corpus)
+
+        # Line / column bookkeeping. Advanced incrementally as tokens are
+        # emitted so computing positions is also linear.
+        self.__line = 1
+        self.__line_start = 0
+        self.__counted_to = 0
 
         self.__token_pos = 0
         self.tokens = []
+        # 1-based (line, column) of the start of each token in tokens.
+        self.positions = []
 
         while True:
+            start = self.__pos
             try:
                 kind, value = self.__read_token()
             except SyntaxError as ex:
-                # TOOD(cmaloney): Calculate line and column information
-                context = "context: '{}'".format(self.__to_lex[:10])
+                line, column = self.__line_column(self.__pos)
+                context = "context: '{}'".format(self.__corpus[self.__pos:self.__pos + 10])
                 raise SyntaxError(
-                    "ERROR parsing code near {}. {}".format(context, ex)) from ex
+                    "ERROR parsing code near {} at line {} column {}. {}".format(context, line, column, ex)) from ex
             self.tokens.append((kind, value))
+            self.positions.append(self.__line_column(start))
             if kind == "eof":
                 break
 
+    def __line_column(self, pos):
+        assert pos >= self.__counted_to
+        self.__line += self.__corpus.count('\n', self.__counted_to, pos)
+        last_newline = self.__corpus.rfind('\n', self.__counted_to, pos)
+        if last_newline != -1:
+            self.__line_start = last_newline + 1
+        self.__counted_to = pos
+        return self.__line, pos - self.__line_start + 1
+
     def peek(self):
         if self.__token_pos == len(self.tokens):
             raise RuntimeError("Walked past end of token list")
         return self.tokens[self.__token_pos]
 
+    def peek_position(self):
+        """The (line, column) of the token peek() returns."""
+        return self.positions[self.__token_pos]
+
     def advance(self):
         if self.__token_pos >= len(self.tokens):
             raise RuntimeError("Walked past end of token list")
         self.__token_pos += 1
         return self.tokens[self.__token_pos]
 
-    def __read_token(self):
-        # __to_lex is set to none after the EOF token is emitted.
-        assert self.__to_lex is not None
+    def __startswith(self, prefix):
+        return self.__corpus.startswith(prefix, self.__pos)
+
+    def __char(self, offset=0):
+        """The character offset past the current position, or '' past the end of the corpus."""
+        pos = self.__pos + offset
+        return self.__corpus[pos] if pos < self.__end else ''
 
-        if len(self.__to_lex) == 0:
-            self.__to_lex = None
+    def __read_token(self):
+        if self.__pos == self.__end:
             return "eof", None
 
+        corpus = self.__corpus
+
         # If not starting with '{', consume text until we find '{' as a blob
         # token.
-        if self.__to_lex[0] != '{':
-            split = self.__to_lex.split('{', 1)
-            assert(len(split) == 1 or len(split) == 2)
-
-            if len(split) == 2:
-                self.__to_lex = '{' + split[1]
-            else:
+        if corpus[self.__pos] != '{':
+            start = self.__pos
+            self.__pos = corpus.find('{', start)
+            if self.__pos == -1:
                 # No remaining '{' in text. This is the end of the string.
-                self.__to_lex = ''
-            return 'blob', split[0]
+                self.__pos = self.__end
+            return 'blob', corpus[start:self.__pos]
 
         # Process '{' beginning control sequences.
 
         # Define some helper functions used by multiple methods below.
         def read_whitespace():
-            if self.__to_lex[0] != ' ':
+            if self.__char() != ' ':
                 raise SyntaxError("Expected exactly one space")
-            if self.__to_lex[1].isspace():
+            if self.__char(1).isspace():
                 raise SyntaxError(
                     "Found more spaces than expected. Only one space is allowed by coding convention.")
-            self.__to_lex = self.__to_lex[1:]
+            self.__pos += 1
 
         def read_identifier():
             # Before identifiers is always whitespace / we're in control where
             # whitespace is arbitrary.
             read_whitespace()
-            identifier = ""
-            while self.__to_lex[0] in identifier_valid_characters:
-                identifier += self.__to_lex[0]
-                self.__to_lex = self.__to_lex[1:]
-            return identifier
+            start = self.__pos
+            self.__pos = identifier_regex.match(corpus, start).end()
+            return corpus[start:self.__pos]
 
         def read_str():
             read_whitespace()
-            if not self.__to_lex.startswith('"'):
+            if not self.__startswith('"'):
                 raise SyntaxError(
                     "Expected string starting with '\"' as value for case but didn't find it.")
-            self.__to_lex = self.__to_lex[1:]
+            self.__pos += 1
 
-            value = ""
+            value = []
             has_backslash = False
             while True:
-                if len(self.__to_lex) == 0:
+                if self.__pos == self.__end:
                     raise SyntaxError(
                         "Unexpected end of file when reading contents of string")
 
-                cur = self.__to_lex[0]
-                self.__to_lex = self.__to_lex[1:]
+                cur = corpus[self.__pos]
+                self.__pos += 1
 
                 if cur in ['\n', '\r']:
                     raise SyntaxError("Newlines aren't allowed in strings")
 
                 if has_backslash:
                     if cur in ['"', '\\']:
-                        value += cur
+                        value.append(cur)
                     else:
                         raise SyntaxError("Invalid escape sequence \\{} in quote".format(cur))
                     has_backslash = False
@@ -142,77 +172,77 @@ class Tokenizer():
                 if cur == '\\':
                     has_backslash = True
                 elif cur == '"':
-                    return value
+                    return ''.join(value)
                 else:
-                    value += cur
+                    value.append(cur)
 
         def read_end_control_group():
             # Arbitrary whitespace is allowed before end of the control group
             read_whitespace()
-            if not self.__to_lex.startswith('%}'):
+            if not self.__startswith('%}'):
                 raise SyntaxError(
                     "Expected end of control group '%}' after control statement but didn't find it.")
-            self.__to_lex = self.__to_lex[2:]
+            self.__pos += 2
 
         # Note: We want the longest match to win. Since we are doing prefix
         # matching that means we must test the longest strings which have
         # prefixes which are also valid tokens first.
-        if self.__to_lex.startswith('{{{{'):
-            self.__to_lex = self.__to_lex[4:]
+        if self.__startswith('{{{{'):
+            self.__pos += 4
             return "blob", "{{"
-        if self.__to_lex.startswith('{{{'):
+        if self.__startswith('{{{'):
             raise SyntaxError(
                 "{{{ is illegal. To make an argument substitution use " +
                 "{{ <identifier> }}. To make '{{' use '{{{{'. To make '{{{' " +
                 "use '{{{{{' (the first for become two, then the last is left" +
                 " alone since it is all alone)")
-        elif self.__to_lex.startswith('{%'):
+        elif self.__startswith('{%'):
             # TODO(cmaloney): There is fairly specific parsing happening in control and ident rather
             # than doing what they probably _should_ be doing for generic parsing. There is some
             # duplicated code. That should be removed / refactored at some point.
             # switch <identifier>
             # case <string>
             # endswitch
-            self.__to_lex = self.__to_lex[2:]
+            self.__pos += 2
 
             # Clean leading whitespace
             read_whitespace()
 
-            if self.__to_lex.startswith("switch"):
-                self.__to_lex = self.__to_lex[6:]
+            if self.__startswith("switch"):
+                self.__pos += 6
                 identifier = read_identifier()
                 read_end_control_group()
                 return "switch", identifier
-            elif self.__to_lex.startswith("case"):
-                self.__to_lex = self.__to_lex[4:]
+            elif self.__startswith("case"):
+                self.__pos += 4
                 value = read_str()
                 read_end_control_group()
                 return "case", value
-            elif self.__to_lex.startswith("endswitch"):
-                self.__to_lex = self.__to_lex[9:]
+            elif self.__startswith("endswitch"):
+                self.__pos += 9
                 read_end_control_group()
                 return "endswitch", None
-            elif self.__to_lex.startswith("for"):
-                self.__to_lex = self.__to_lex[3:]
+            elif self.__startswith("for"):
+                self.__pos += 3
                 new_var = read_identifier()
                 read_whitespace()
-                if not self.__to_lex.startswith("in"):
+                if not self.__startswith("in"):
                     raise SyntaxError("Expected {% for foo in bar %}, didn't find the ' in'.")
-                self.__to_lex = self.__to_lex[2:]
+                self.__pos += 2
                 iterable = read_identifier()
                 read_end_control_group()
                 return "for", (new_var, iterable)
-            elif self.__to_lex.startswith("endfor"):
-                self.__to_lex = self.__to_lex[6:]
+            elif self.__startswith("endfor"):
+                self.__pos += 6
                 read_end_control_group()
                 return "endfor", None
             else:
                 raise SyntaxError(
                     "Unknown control group directive. Expected switch, case, or endswitch.")
-        elif self.__to_lex.startswith("{{"):
+        elif self.__startswith("{{"):
             # whitespace ident whitespace close_curly
             # Clean of leading whitespace
-            self.__to_lex = self.__to_lex[2:]
+            self.__pos += 2
 
             try:
                 identifier = read_identifier()
@@ -228,21 +258,21 @@ class Tokenizer():
 
             # Optionally a filter expresion
             filter_id = None
-            if self.__to_lex.startswith('|'):
-                self.__to_lex = self.__to_lex[1:]
+            if self.__startswith('|'):
+                self.__pos += 1
                 filter_id = read_identifier()
                 read_whitespace()
 
             # Close curly braces
-            if not self.__to_lex.startswith('}}'):
+            if not self.__startswith('}}'):
                 raise SyntaxError(
                     "Expected '}}' after '{{ <identifier>' but didn't find it.")
 
-            self.__to_lex = self.__to_lex[2:]
+            self.__pos += 2
             return "replacement", (identifier, filter_id)
         else:
             # Was just a single open curly, we're a single curly blob
-            self.__to_lex = self.__to_lex[1:]
+            self.__pos += 1
             return "blob", "{"
 
 # Language:
@@ -307,68 +337,117 @@ class UnsetMarker():
     pass
 
 
+def _get_argument(arguments, name):
+    try:
+        return arguments[name]
+    except KeyError as ex:
+        raise UnsetParameter("Unset parameter {}".format(name), name) from ex
+
+
+def _compile_text(text):
+    def render_text(out, arguments, filters):
+        out.append(text)
+    return render_text
+
+
+def _compile_replacement(chunk):
+    identifier = chunk.identifier
+    filter_name = chunk.filter
+
+    def render_replacement(out, arguments, filters):
+        value = _get_argument(arguments, identifier)
+        if filter_name is None:
+            out.append(str(value))
+            return
+        try:
+            filter_func = filters[filter_name]
+        except KeyError:
+            raise UnsetParameter("Unset filter parameter {}".format(filter_name), filter_name)
+        out.append(str(filter_func(value)))
+    return render_replacement
+
+
+def _compile_switch(chunk):
+    identifier = chunk.identifier
+    cases = {value: _compile_ast(case) for value, case in chunk.cases.items()}
+
+    def render_switch(out, arguments, filters):
+        choice = _get_argument(arguments, identifier)
+        if choice not in cases:
+            raise ValueError("switch %s: value `%s` is not in the set of handled cases" % (identifier, choice))
+        cases[choice](out, arguments, filters)
+    return render_switch
+
+
+def _compile_for(chunk):
+    new_var = chunk.new_var
+    iterable_name = chunk.iterable
+    body = _compile_ast(chunk.body)
+
+    def render_for(out, arguments, filters):
+        # If the argument is a string, it should be a json list.
+        iterable = _get_argument(arguments, iterable_name)
+        # TODO(cmaloney): for should only be used (for now) in code which doesn't contain
+        # arbitrary user parameters.
+        # STash the original state of the argument.
+        original_value = UnsetMarker()
+        if new_var in arguments:
+            original_value = arguments[new_var]
+
+        assert isinstance(iterable, list)
+        try:
+            for value in iterable:
+                arguments[new_var] = value
+                body(out, arguments, filters)
+        finally:
+            # Reset the argument to the original state.
+            if isinstance(original_value, UnsetMarker):
+                arguments.pop(new_var, None)
+            else:
+                arguments[new_var] = original_value
+    return render_for
+
+
+def _compile_ast(ast):
+    """Turn an AST into a function which appends its rendered pieces to a list.
+
+    Rendering is then one pass over the template which never copies output
+    already produced, joined into a string once at the end.
+    """
+    steps = []
+    for chunk in ast:
+        if isinstance(chunk, Switch):
+            steps.append(_compile_switch(chunk))
+        elif isinstance(chunk, Replacement):
+            steps.append(_compile_replacement(chunk))
+        elif isinstance(chunk, For):
+            steps.append(_compile_for(chunk))
+        elif isinstance(chunk, str):
+            steps.append(_compile_text(chunk))
+        else:
+            raise NotImplementedError(
+                "Unknown chunk type {}".format(type(chunk)))
+
+    def render_ast(out, arguments, filters):
+        for step in steps:
+            step(out, arguments, filters)
+    return render_ast
+
+
 class Template():
 
     def __init__(self, ast: list):
         self.ast = ast
+        self.__compiled = None
 
     def render(self, arguments: dict, filters: dict={}):
-
-        def get_argument(name):
-            try:
-                return arguments[name]
-            except KeyError as ex:
-                raise UnsetParameter("Unset parameter {}".format(name), name) from ex
-
-        def render_ast(ast):
-            rendered = ""
-            for chunk in ast:
-                if isinstance(chunk, Switch):
-                    choice = get_argument(chunk.identifier)
-                    if choice not in chunk.cases:
-                        raise ValueError("switch %s: value `%s` is not in the set of handled cases" % (
-                            chunk.identifier, choice))
-                    rendered += render_ast(chunk.cases[choice])
-                elif isinstance(chunk, Replacement):
-                    value = get_argument(chunk.identifier)
-                    if chunk.filter is None:
-                        rendered += str(value)
-                    else:
-                        try:
-                            filter_func = filters[chunk.filter]
-                        except KeyError:
-                            raise UnsetParameter("Unset filter parameter {}".format(chunk.filter), chunk.filter)
-                        rendered += str(filter_func(value))
-                elif isinstance(chunk, For):
-                    # If the argument is a string, it should be a json list.
-                    iterable = get_argument(chunk.iterable)
-                    # TODO(cmaloney): for should only be used (for now) in code which doesn't contain
-                    # arbitrary user parameters.
-                    # STash the original state of the argument.
-                    original_value = UnsetMarker()
-                    if chunk.new_var in arguments:
-                        original_value = arguments[chunk.new_var]
-
-                    assert isinstance(iterable, list)
-                    for value in iterable:
-                        arguments[chunk.new_var] = value
-                        rendered += render_ast(chunk.body)
-
-                    # Reset the argument to the original state.
-                    if isinstance(original_value, UnsetMarker):
-                        del arguments[chunk.new_var]
-                    else:
-                        arguments[chunk.new_var] = original_value
-
-                elif isinstance(chunk, str):
-                    rendered += chunk
-                else:
-                    raise NotImplementedError(
-                        "Unknown chunk type {}".format(type(chunk)))
-
-            return rendered
-
-        return render_ast(self.ast)
+        # Templates are shared through the parse cache, so compile once on
+        # first use and keep no per render state on the template itself.
+        if self.__compiled is None:
+            self.__compiled = _compile_ast(self.ast)
+        out = []
+        self.__compiled(out, arguments, filters)
+        return ''.join(out)
 
     def target_from_ast(self):
         def variables_from_ast(ast, blacklist):
@@ -437,7 +516,8 @@ def _parse_for(tokenizer):
     # Should stop reading the body at the endfor
     token_type, value = tokenizer.peek()
     if token_type != 'endfor':
-        raise ValueError("Expecting end of for, but found {}.".format(token_type))
+        raise ValueError("Expecting end of for, but found {} at line {} column {}.".format(
+            token_type, *tokenizer.peek_position()))
 
     tokenizer.advance()
     return For(new_var, iterable, body)
@@ -464,11 +544,12 @@ def _parse_switch(tokenizer):
             # Should be unreachable if not before the first as it should be picked up inside a case.
             assert is_first
             if not value.isspace():
-                raise ValueError("Unexpected blob of text outside of switch case statements. Whitespace is all that is allowed.")  # noqa
+                raise ValueError("Unexpected blob of text outside of switch case statements at line {} column {}. Whitespace is all that is allowed.".format(*tokenizer.peek_position()))  # noqa
             tokenizer.advance()
         else:
             raise ValueError(
-                "Unexpected token of type {} inside switch. Expected a case or endswitch.".format(token_type))
+                "Unexpected token of type {} inside switch at line {} column {}. Expected a case or endswitch.".format(
+                    token_type, *tokenizer.peek_position()))
         is_first = False
     raise RuntimeError("Unexpectedly exited the while loop in _parse_switch")
 
@@ -492,13 +573,31 @@ def _parse_chunks(tokenizer):
             return chunks
 
 
+# Parsed templates by the sha256 of their text. Templates are never modified
+# once parsed, so every caller parsing the same text can share one.
+_parse_cache = dict()
+
+
 def parse_str(text):
+    key = hashlib.sha256(text.encode()).hexdigest()
+    template = _parse_cache.get(key)
+    if template is None:
+        template = _parse_cache[key] = _parse_uncached(text)
+    return template
+
+
+def clear_parse_cache():
+    _parse_cache.clear()
+
+
+def _parse_uncached(text):
     tokenizer = Tokenizer(text)
     ast = _parse_chunks(tokenizer)
     token_type, _ = tokenizer.peek()
     if token_type != "eof":
         raise ValueError(
-            "Unexpected token of type {} at end of text, expecting EOF".format(token_type))
+            "Unexpected token of type {} at end of text at line {} column {}, expecting EOF".format(
+                token_type, *tokenizer.peek_position()))
     return Template(ast)
 
 
@@ -1,5 +1,7 @@
 import json
 
+import pytest
+
 import gen.build_deploy.aws
 
 
@@ -9,3 +11,79 @@ def test_gen_aws_mapping():
     assert len(result) == 10
     # check format of response
     assert result["ap-northeast-1"] == {'stable': gen.build_deploy.aws.region_to_ami_map['ap-northeast-1']['stable']}
+
+
+def make_cf_template(**sections):
+    template = {
+        'AWSTemplateFormatVersion': '2010-09-09',
+        'Metadata': {'TemplateGenerationDate': 'now'},
+        'Parameters': {'KeyName': {'Type': 'String'}},
+        'Conditions': {'HasKey': {'Fn::Not': [{'Fn::Equals': [{'Ref': 'KeyName'}, '']}]}},
+        'Mappings': {'Region': {'us-west-2': {'ami': 'ami-1'}}},
+        'Resources': {
+            'Bucket': {'Type': 'AWS::S3::Bucket'},
+            'Instance': {
+                'Type': 'AWS::EC2::Instance',
+                'DependsOn': 'Bucket',
+                'Properties': {
+                    'ImageId': {'Fn::FindInMap': ['Region', {'Ref': 'AWS::Region'}, 'ami']},
+                    'KeyName': {'Fn::If': ['HasKey', {'Ref': 'KeyName'}, {'Ref': 'AWS::NoValue'}]},
+                    'UserData': {'Fn::GetAtt': ['Bucket', 'Arn']}}}},
+        'Outputs': {'Bucket': {'Value': {'Ref': 'Bucket'}}}}
+    template.update(sections)
+    return json.dumps(template)
+
+
+def test_check_cf_structure():
+    check_cf_structure = gen.build_deploy.aws.check_cf_structure
+
+    assert check_cf_structure(make_cf_template()) == []
+    assert check_cf_structure('{') != []
+    assert check_cf_structure(make_cf_template(Resources={}, Outputs={})) == [
+        "Template must define at least one resource"]
+    assert check_cf_structure(make_cf_template(Resourcse={})) == ["Unknown top level section Resourcse"]
+    assert check_cf_structure(make_cf_template(Parameters={'KeyName': {}})) == [
+        "Parameter KeyName must have a Type"]
+    assert check_cf_structure(make_cf_template(Outputs={'Bucket': {'Value': {'Ref': 'Bukcet'}}})) == [
+        "Outputs.Bucket.Value: Ref to undefined Bukcet"]
+    assert check_cf_structure(make_cf_template(Outputs={'Arn': {'Value': {'Fn::GetAtt': 'Bukcet.Arn'}}})) == [
+        "Outputs.Arn.Value: Fn::GetAtt of undefined resource Bukcet"]
+    assert check_cf_structure(make_cf_template(Resources={
+        'Queue': {'Type': 'AWS::SQS::Queue', 'DependsOn': ['Bucket'], 'Condition': 'HasNoKey'}}, Outputs={})) == [
+        "Resource Queue depends on undefined resource Bucket",
+        "Resource Queue uses undefined condition HasNoKey"]
+
+
+class FakeCloudFormation:
+    def __init__(self):
+        self.validated = []
+
+    def client(self, name):
+        assert name == 'cloudformation'
+        return self
+
+    def validate_template(self, **kwargs):
+        self.validated.append(kwargs['TemplateBody'])
+
+
+def test_validate_cf(monkeypatch, tmpdir):
+    session = FakeCloudFormation()
+    monkeypatch.setattr(gen.build_deploy.aws, 'get_test_session', lambda: session)
+    monkeypatch.setattr(gen.build_deploy.aws, 'cf_validation_cache_filename', str(tmpdir.join('cache.json')))
+    monkeypatch.setattr(gen.build_deploy.aws, '_cf_validated', None)
+
+    gen.build_deploy.aws.validate_cf(make_cf_template())
+    assert len(session.validated) == 1
+
+    # Templates only differing in metadata aren't validated again, even by a later build.
+    monkeypatch.setattr(gen.build_deploy.aws, '_cf_validated', None)
+    gen.build_deploy.aws.validate_cf(make_cf_template(Metadata={'TemplateGenerationDate': 'later'}))
+    assert len(session.validated) == 1
+
+    gen.build_deploy.aws.validate_cf(make_cf_template(Description='new'))
+    assert len(session.validated) == 2
+
+    # Structural problems are found without calling AWS.
+    with pytest.raises(gen.build_deploy.aws.CloudFormationError):
+        gen.build_deploy.aws.validate_cf(make_cf_template(Resources={}))
+    assert len(session.validated) == 2
@@ -0,0 +1,93 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import gen.build_deploy.bash
+
+# Stands in for docker when running the installer, keeping whatever is loaded in loaded_image
+# and logging the commands it was run with in commands.
+fake_docker = """#!/bin/bash
+echo "$1" >> {dir}/commands
+case "$1" in
+    version) exit 0 ;;
+    inspect) test -f {dir}/loaded_image ;;
+    load) cat > {dir}/loaded_image ;;
+    rmi) rm {dir}/loaded_image ;;
+    run) echo "ran $@" ;;
+esac
+"""
+
+payload = bytes(range(256)) * 4001
+payload_cmd = [sys.executable, '-c', 'import sys; sys.stdout.buffer.write(bytes(range(256)) * 4001)']
+
+
+@pytest.fixture
+def installer_env(tmpdir):
+    bin_dir = tmpdir.join('bin').ensure(dir=True)
+    docker = bin_dir.join('docker')
+    docker.write(fake_docker.format(dir=tmpdir))
+    docker.chmod(0o755)
+    env = dict(os.environ)
+    env['PATH'] = str(bin_dir) + ':' + env['PATH']
+    return env
+
+
+def write_installer(tmpdir):
+    installer = tmpdir.join('dcos_generate_config.sh')
+    gen.build_deploy.bash.write_installer_script(
+        str(installer),
+        payload_cmd,
+        container_name='dcos-genconf.test',
+        docker_image_name='mesosphere/dcos-genconf:test',
+        variant='test')
+    return installer
+
+
+def test_installer_loads_payload(tmpdir, installer_env):
+    installer = write_installer(tmpdir)
+    assert os.access(str(installer), os.X_OK)
+
+    output = subprocess.check_output([str(installer), '--help'], cwd=str(tmpdir), env=installer_env)
+    assert tmpdir.join('loaded_image').read_binary() == payload
+    assert output.decode().splitlines()[-1] == \
+        'ran run --rm --name=dcos-genconf.test -i -p 9000:9000 -v {}/genconf/:/genconf ' \
+        'mesosphere/dcos-genconf:test --help'.format(tmpdir)
+
+    # The image is only loaded the first time.
+    tmpdir.join('loaded_image').write('loaded')
+    subprocess.check_call([str(installer)], cwd=str(tmpdir), env=installer_env)
+    assert tmpdir.join('loaded_image').read() == 'loaded'
+
+
+def test_installer_corrupt_payload(tmpdir, installer_env):
+    installer = write_installer(tmpdir)
+    data = bytearray(installer.read_binary())
+    data[-1] ^= 0xff
+    installer.write_binary(bytes(data))
+    with pytest.raises(subprocess.CalledProcessError):
+        subprocess.check_call([str(installer)], cwd=str(tmpdir), env=installer_env)
+    # The image was streamed into docker, then removed once its checksum didn't match.
+    assert tmpdir.join('commands').read().split() == ['version', 'inspect', 'load', 'rmi']
+    assert not tmpdir.join('loaded_image').exists()
+
+    # A truncated installer never gets as far as docker load.
+    tmpdir.join('commands').remove()
+    installer.write_binary(bytes(data[:-1]))
+    with pytest.raises(subprocess.CalledProcessError):
+        subprocess.check_call([str(installer)], cwd=str(tmpdir), env=installer_env)
+    assert tmpdir.join('commands').read().split() == ['version', 'inspect']
+    assert not tmpdir.join('loaded_image').exists()
+
+
+def test_write_installer_script_failure(tmpdir):
+    installer = tmpdir.join('dcos_generate_config.sh')
+    with pytest.raises(subprocess.CalledProcessError):
+        gen.build_deploy.bash.write_installer_script(
+            str(installer),
+            [sys.executable, '-c', 'exit(1)'],
+            container_name='dcos-genconf.test',
+            docker_image_name='mesosphere/dcos-genconf:test',
+            variant='test')
+    assert not installer.exists()
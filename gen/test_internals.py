@@ -105,3 +105,146 @@ def test_resolve_simple():
     resolver = gen.internals.resolve_configuration([test_source, test_partial_source], [get_test_target()])
     print(resolver)
     assert resolver.status_dict == {'status': 'errors', 'errors': {}, 'unset': {'c'}}
+
+
+def test_resolve_with_base():
+    calls = []
+
+    def calculate_b(a):
+        calls.append('b')
+        return a + '_b'
+
+    def calculate_c(b, d):
+        calls.append('c')
+        return b + d
+
+    def calculate_e(a):
+        calls.append('e')
+        return a + '_e'
+
+    test_source = Source({
+        'must': {
+            'b': calculate_b,
+            'c': calculate_c,
+            'e': calculate_e,
+        }
+    })
+
+    def resolve(d, base=None):
+        user_source = Source(is_user=True)
+        user_source.add_must('a', 'a')
+        user_source.add_must('d', d)
+        return gen.internals.resolve_configuration([test_source, user_source], [Target({'c', 'e'})], base)
+
+    base = resolve('d_1')
+    assert sorted(calls) == ['b', 'c', 'e']
+    calls.clear()
+
+    # Only c depends on d. a, b and e come from the base.
+    derived = resolve('d_2', base)
+    assert calls == ['c']
+    assert derived.arguments['c'].value == 'a_bd_2'
+    assert derived.arguments['e'].value == 'a_e'
+    assert derived.reused_count == 3
+    calls.clear()
+
+    # A different setter is never reused.
+    other_source = Source({'must': {'b': lambda a: a + '_other', 'c': calculate_c, 'e': calculate_e}})
+    user_source = Source(is_user=True)
+    user_source.add_must('a', 'a')
+    user_source.add_must('d', 'd_2')
+    other = gen.internals.resolve_configuration([other_source, user_source], [Target({'c', 'e'})], derived)
+    assert other.arguments['c'].value == 'a_otherd_2'
+    assert calls == ['c']
+
+
+def test_pure_calculators():
+    gen.internals.clear_pure_cache()
+    calls = []
+    state = {'extra': 1}
+
+    @gen.internals.pure
+    def calculate_b(a):
+        calls.append(('b', a))
+        return a + '_b'
+
+    @gen.internals.pure(extra_key=lambda a: state['extra'])
+    def calculate_c(a):
+        calls.append(('c', a))
+        return a + '_c'
+
+    def calculate_d(a):
+        calls.append(('d', a))
+        return a + '_d'
+
+    def resolve(a):
+        user_source = Source(is_user=True)
+        user_source.add_must('a', a)
+        source = Source({'must': {'b': calculate_b, 'c': calculate_c, 'd': calculate_d}})
+        resolver = gen.internals.resolve_configuration([source, user_source], [Target({'b', 'c', 'd'})])
+        assert resolver.status_dict == {'status': 'ok'}
+        return {name: resolver.arguments[name].value for name in 'bcd'}
+
+    assert resolve('x') == {'b': 'x_b', 'c': 'x_c', 'd': 'x_d'}
+    assert sorted(calls) == [('b', 'x'), ('c', 'x'), ('d', 'x')]
+    calls.clear()
+
+    # Pure calculators with the same arguments aren't called again.
+    assert resolve('x') == {'b': 'x_b', 'c': 'x_c', 'd': 'x_d'}
+    assert calls == [('d', 'x')]
+    calls.clear()
+
+    # New arguments or a new extra key mean calculating again.
+    assert resolve('y') == {'b': 'y_b', 'c': 'y_c', 'd': 'y_d'}
+    assert sorted(calls) == [('b', 'y'), ('c', 'y'), ('d', 'y')]
+    calls.clear()
+    state['extra'] = 2
+    resolve('y')
+    assert sorted(calls) == [('c', 'y'), ('d', 'y')]
+
+
+def test_resolve_partial():
+    calls = []
+
+    def calculate_b(a):
+        calls.append('b')
+        return a + '_b'
+
+    def calculate_c():
+        calls.append('c')
+        return 'c'
+
+    def validate_a_and_d(a, d):
+        if a == d:
+            raise AssertionError("a and d must differ")
+
+    test_source = Source({
+        'validate': [validate_a_and_d],
+        'must': {
+            'b': calculate_b,
+            'c': calculate_c,
+        }
+    })
+
+    def resolve_partial(names, **arguments):
+        user_source = Source(is_user=True)
+        for name, value in arguments.items():
+            user_source.add_must(name, value)
+        return gen.internals.resolve_partial_configuration(
+            [test_source, user_source], [Target({'b', 'c', 'e'})], names)
+
+    # Only what b depends on is calculated, and unset e isn't reported.
+    resolver = resolve_partial(['b'], a='x', d='y')
+    assert resolver.status_dict == {'status': 'ok'}
+    assert resolver.arguments['b'].value == 'x_b'
+    assert calls == ['b']
+
+    # Validation involving a requested argument runs, calculating its other arguments.
+    resolver = resolve_partial(['a'], a='x', d='x')
+    assert resolver.status_dict == {
+        'status': 'errors',
+        'errors': {'a': {'message': 'a and d must differ'}, 'd': {'message': 'a and d must differ'}},
+        'unset': set()}
+
+    # Unset arguments needed by the requested ones are reported.
+    assert resolve_partial(['b'], d='y').status_dict == {'status': 'errors', 'errors': {}, 'unset': {'a'}}
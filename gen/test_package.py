@@ -0,0 +1,42 @@
+import os
+import tarfile
+
+import gen
+
+
+def get_members(package_filename):
+    with tarfile.open(package_filename) as tar:
+        return {
+            member.name: (member.type, oct(member.mode), tar.extractfile(member).read() if member.isfile() else None)
+            for member in tar.getmembers()}
+
+
+def test_do_gen_package(tmpdir):
+    package_filename = str(tmpdir.join('packages/dcos-config/dcos-config--setup_abc.tar.xz'))
+    config = {'package': [
+        {'path': '/etc/config.json', 'content': '{}'},
+        {'path': 'bin/run', 'content': '#!/bin/sh', 'permissions': '0755'}]}
+
+    gen.do_gen_package(config, package_filename)
+    assert get_members(package_filename) == {
+        '.': (tarfile.DIRTYPE, '0o755', None),
+        './bin': (tarfile.DIRTYPE, '0o755', None),
+        './bin/run': (tarfile.REGTYPE, '0o755', b'#!/bin/sh'),
+        './etc': (tarfile.DIRTYPE, '0o755', None),
+        './etc/config.json': (tarfile.REGTYPE, '0o644', b'{}')}
+
+    # Generating the same contents again leaves the package alone.
+    stat = os.stat(package_filename)
+    gen.do_gen_package(config, package_filename)
+    assert os.stat(package_filename).st_ino == stat.st_ino
+
+    # New contents replace it.
+    config['package'][0]['content'] = '{"a": 1}'
+    gen.do_gen_package(config, package_filename)
+    assert get_members(package_filename)['./etc/config.json'][2] == b'{"a": 1}'
+
+    # So does a package without a recorded content hash.
+    with open(package_filename, 'w') as f:
+        f.write('not a package')
+    gen.do_gen_package(config, package_filename)
+    assert get_members(package_filename)['./etc/config.json'][2] == b'{"a": 1}'
@@ -78,6 +78,28 @@ def test_lex():
     with pytest.raises(gen.template.SyntaxError):
         get_tokens("{{ test}}")
 
+    # Running off the end of the text part way through a token is a syntax error.
+    with pytest.raises(gen.template.SyntaxError):
+        get_tokens("{{ test ")
+    with pytest.raises(gen.template.SyntaxError):
+        get_tokens("{{ test")
+    with pytest.raises(gen.template.SyntaxError):
+        get_tokens('{% case "abc')
+
+
+def test_tokenize_positions():
+    tokenizer = Tokenizer("a\nbc{{ d }}\n\n  {% for x in y %}{% endfor %}")
+    assert tokenizer.positions == [(1, 1), (2, 3), (2, 10), (4, 3), (4, 19), (4, 31)]
+
+    with pytest.raises(gen.template.SyntaxError) as exinfo:
+        Tokenizer("foo\nbar {{ baz}}")
+    assert "line 2 column 11" in str(exinfo.value)
+    assert "context: '}}'" in str(exinfo.value)
+
+    with pytest.raises(ValueError) as exinfo:
+        gen.template.parse_str("a\n{% endfor %}")
+    assert "line 2 column 1" in str(exinfo.value)
+
 
 def test_parse():
     assert(parse_str("a").ast == ["a"])
@@ -150,3 +172,18 @@ def test_render():
             "btcelsefoo")
     with pytest.raises(UnsetParameter):
         parse_str("{% for a in b %}{{ a }}{% endfor %}else{{ a }}").render({"b": ['b', 't', 'c']})
+
+
+def test_parse_cache():
+    gen.template.clear_parse_cache()
+    template = parse_str("{{ a }}b")
+    assert parse_str("{{ a }}b") is template
+    assert parse_str("{{ a }}c") is not template
+    # Shared templates render independently of each other.
+    assert template.render({'a': '1'}) == "1b"
+    assert parse_str("{{ a }}b").render({'a': '2'}) == "2b"
+
+    # Failed parses aren't cached.
+    for _ in range(2):
+        with pytest.raises(gen.template.SyntaxError):
+            parse_str("{{ a")
@@ -10,13 +10,14 @@ environment variables from the package.
 
 """
 import grp
+import hashlib
 import json
 import os
 import os.path
 import pwd
 import re
 import shutil
-import tempfile
+import threading
 from collections import Iterable
 from itertools import chain
 from subprocess import CalledProcessError, check_call, check_output
@@ -24,9 +25,10 @@ from typing import Union
 
 from pkgpanda.constants import (DCOS_SERVICE_CONFIGURATION_FILE,
                                 RESERVED_UNIT_NAMES)
-from pkgpanda.exceptions import (InstallError, PackageError, PackageNotFound,
-                                 ValidationError)
-from pkgpanda.util import (download, extract_tarball, if_exists, load_json, write_json, write_string)
+from pkgpanda.exceptions import (FetchError, InstallError, PackageError,
+                                 PackageNotFound, ValidationError)
+from pkgpanda.util import (chown_tree, download_extract, hash_tree, if_exists, load_json, load_string, write_json,
+                           write_string)
 
 # TODO(cmaloney): Can we switch to something like a PKGBUILD from ArchLinux and
 # then just do the mutli-version stuff ourself and save a lot of re-implementation?
@@ -41,6 +43,10 @@ env_export_header = """# Pkgpanda provided environment variables
 export LD_LIBRARY_PATH={0}/lib
 export PATH="{0}/bin:$PATH"\n\n"""
 
+# Recorded in the environment file so a later activation can tell whether it
+# would generate exactly what is already active.
+fingerprint_prefix = "# Pkgpanda activation fingerprint: "
+
 name_regex = "^[a-zA-Z0-9@_+][a-zA-Z0-9@._+\-]*$"
 version_regex = "^[a-zA-Z0-9@_+:.]+$"
 username_regex = "^dcos_[a-z0-9_]+$"
@@ -290,27 +296,44 @@ def validate_compatible(packages, roles):
 
 
 # TODO(cmaloney): Add a github fetcher, useful for grabbing config tarballs.
-def requests_fetcher(base_url, id_str, target, work_dir):
+def requests_fetcher(base_url, id_str, target, work_dir, sha1=None, progress=None, tarball=None):
+    """Fetch the package id_str from base_url, extracting it into target.
+
+    base_url may be a list of repository urls (mirrors, or peers serving their
+    local repository through the pkgpanda HTTP API), which are tried in order.
+    The tarball is streamed straight into `tar` rather than being written to
+    disk first. If sha1 is given the tarball must match it or the fetch fails
+    and target is removed. Repositories don't publish the sha1 of their
+    packages, so none of the fetches pkgpanda makes itself pass one; those rely
+    on the integrity check built into every xz stream, which `tar` verifies
+    while extracting. progress and tarball are passed through to
+    download_extract().
+    """
     assert base_url
     assert type(id_str) == str
     id = PackageId(id_str)
+    base_urls = [base_url] if isinstance(base_url, str) else base_url
     # TODO(cmaloney): That file:// urls are allowed in base_url is likely a security hole.
     # TODO(cmaloney): Switch to mesos-fetcher or aci or something so
     # all the logic can go away, we gain integrity checking, etc.
-    base_url = base_url.rstrip('/')
-    url = base_url + "/packages/{0}/{1}.tar.xz".format(id.name, id_str)
-    # TODO(cmaloney): Use a private tmp directory so there is no chance of a user
-    # intercepting the tarball + other validation data locally.
-    with tempfile.NamedTemporaryFile(suffix=".tar.xz") as file:
-        download(file.name, url, work_dir)
-        extract_tarball(file.name, target)
+    urls = [url.rstrip('/') + "/packages/{0}/{1}.tar.xz".format(id.name, id_str) for url in base_urls]
+    download_extract(urls, target, work_dir, sha1, progress, tarball)
 
 
 class Repository:
 
-    def __init__(self, path):
+    def __init__(self, path, keep_tarballs=False):
         self.__path = os.path.abspath(path)
+        self.__keep_tarballs = keep_tarballs
         self.__packages = None
+        self.__ids_by_name = None
+        self.__loaded = dict()
+        # Modification time of the repository directory the index was built
+        # from. Adding or removing a package folder changes it.
+        self.__index_mtime = None
+        # A repository may be shared between threads, for instance by the
+        # pkgpanda HTTP API, so the index and loaded packages are guarded.
+        self.__lock = threading.Lock()
 
     @property
     def path(self):
@@ -319,9 +342,59 @@ class Repository:
     def package_path(self, id):
         return os.path.join(self.__path, id)
 
+    def tarball_path(self, id):
+        """Where the tarball a package was fetched from is kept, to serve to peers.
+
+        Packages added some other way, such as from a delta, have no tarball.
+        """
+        return os.path.join(self.__path, '.tarballs', id + '.tar.xz')
+
+    def kept_tarball_path(self, id):
+        """Where to keep the tarball package id is fetched from, or None if tarballs aren't kept.
+
+        Keeping them doubles the disk space packages take, so it is only done
+        when the repository is created with keep_tarballs set.
+        """
+        return self.tarball_path(id) if self.__keep_tarballs else None
+
+    def _invalidate(self):
+        with self.__lock:
+            self.__packages = None
+
+    def _refresh_index(self):
+        """Bring the index up to date, returning the package ids and the ids of each package name.
+
+        The index is replaced rather than changed when the repository changes,
+        so what is returned can be used without holding the lock.
+        """
+        try:
+            mtime = os.stat(self.__path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+
+        with self.__lock:
+            if self.__packages is not None and mtime == self.__index_mtime:
+                return self.__packages, self.__ids_by_name
+
+            packages = set()
+            ids_by_name = dict()
+            if mtime is not None:
+                for id in os.listdir(self.__path):
+                    if PackageId.is_id(id):
+                        packages.add(id)
+                        ids_by_name.setdefault(id.split('--')[0], set()).add(id)
+
+            self.__packages = packages
+            self.__ids_by_name = ids_by_name
+            self.__index_mtime = mtime
+            # Drop loaded packages which are no longer in the repository.
+            for id in set(self.__loaded) - packages:
+                del self.__loaded[id]
+            return packages, ids_by_name
+
     def get_ids(self, name):
-        # TODO(cmaloney): There is a lot of excess re-parsing here...
-        return list(pkg_id for pkg_id in self.list() if PackageId(pkg_id).name == name)
+        _, ids_by_name = self._refresh_index()
+        return list(ids_by_name.get(name, ()))
 
     def has_package(self, id):
         return id in self.list()
@@ -330,21 +403,16 @@ class Repository:
         """List the available packages in the repository.
 
         A package is a folder which contains a pkginfo.json"""
-        if self.__packages is not None:
-            return self.__packages
-
-        packages = set()
-        if not os.path.exists(self.__path):
-            return packages
-
-        for id in os.listdir(self.__path):
-            if PackageId.is_id(id):
-                packages.add(id)
-        self.__packages = packages
-        return self.__packages
+        packages, _ = self._refresh_index()
+        return packages
 
     # Load the given package
     def load(self, id: str):
+        if self.has_package(id):
+            with self.__lock:
+                package = self.__loaded.get(id)
+            if package is not None:
+                return package
 
         # Validate the package id.
         PackageId(id)
@@ -362,7 +430,10 @@ class Repository:
         if not isinstance(pkginfo, dict):
             raise PackageError("Usage should be a dictionary, not a {0}".format(type(pkginfo).__name__))
 
-        return Package(path, id, pkginfo)
+        package = Package(path, id, pkginfo)
+        with self.__lock:
+            self.__loaded[id] = package
+        return package
 
     def load_packages(self, ids: Iterable):
         packages = set()
@@ -378,7 +449,10 @@ class Repository:
     # Add the given package to the repository.
     # If the package is already in the repository does a no-op and returns false.
     # Returns true otherwise.
-    def add(self, fetcher, id, warn_added=True):
+    # If a delta_fetcher is given it is first tried against every other version
+    # of the package in the repository, falling back to fetcher if none of them
+    # can be used as the base of a delta.
+    def add(self, fetcher, id, warn_added=True, delta_fetcher=None):
         # Validate the package id.
         PackageId(id)
 
@@ -404,15 +478,66 @@ class Repository:
         # package extractions.
         check_call(['rm', '-rf', tmp_path])
 
-        fetcher(id, tmp_path)
-        os.rename(tmp_path, pkg_path)
+        try:
+            if delta_fetcher is None or not self._add_from_delta(delta_fetcher, id, tmp_path):
+                fetcher(id, tmp_path)
+            os.rename(tmp_path, pkg_path)
+        finally:
+            self._invalidate()
         return True
 
+    def _add_from_delta(self, delta_fetcher, id, tmp_path):
+        name = PackageId(id).name
+        for base_id in sorted(self.get_ids(name)):
+            if base_id == id or base_id.endswith('_tmp'):
+                continue
+            try:
+                delta_fetcher(base_id, self.package_path(base_id), id, tmp_path)
+                return True
+            except FetchError:
+                # No delta from this base.
+                pass
+            except Exception as ex:
+                print("WARNING: Unable to use delta from {} to {}: {}".format(base_id, id, ex))
+            check_call(['rm', '-rf', tmp_path])
+        return False
+
     def remove(self, id):
         path = self.package_path(id)
         if not os.path.exists(path):
             raise PackageNotFound(id)
-        shutil.rmtree(path)
+        try:
+            shutil.rmtree(path)
+            if os.path.exists(self.tarball_path(id)):
+                os.remove(self.tarball_path(id))
+        finally:
+            self._invalidate()
+
+
+def _state_dir_record(path, uid, package_id):
+    st = os.stat(path)
+    top_level = hashlib.sha1('{} {}\n'.format(st.st_uid, st.st_mtime_ns).encode())
+    for entry in sorted(os.scandir(path), key=lambda entry: entry.name):
+        entry_st = entry.stat(follow_symlinks=False)
+        top_level.update('{} {} {}\n'.format(entry.name, entry_st.st_uid, entry_st.st_mtime_ns).encode())
+    return [uid, package_id, st.st_dev, st.st_ino, top_level.hexdigest()]
+
+
+def fix_state_dir_owner(path, uid, package_id, recorded):
+    """Make uid the owner of everything in the state directory path.
+
+    recorded is what this returned the last time it fixed up path. Walking a
+    large state directory is slow, so it is skipped if the directory was last
+    fixed up for the same owner and package and neither it nor anything
+    directly inside it has changed since. Changes deeper in the tree aren't
+    noticed, so a wrongly owned file there is only fixed once the package is
+    upgraded, the owner changes or something at the top level changes.
+    Returns what to record for next time.
+    """
+    if recorded == _state_dir_record(path, uid, package_id):
+        return recorded
+    chown_tree(path, uid)
+    return _state_dir_record(path, uid, package_id)
 
 
 class ConflictingFile(ValidationError):
@@ -470,7 +595,10 @@ class UserManagement:
     def __init__(self, manage_users: bool, add_users: bool):
         self._manage_users = manage_users
         self._add_users = add_users
-        self._users = set()
+        # Map of username -> group of the users to ensure exist.
+        self._requested = dict()
+        # Map of username -> uid, filled in by ensure_users_exist().
+        self._users = None
 
     @staticmethod
     def validate_username(username):
@@ -505,38 +633,88 @@ class UserManagement:
         if not group_name:
             return
 
-        group = grp.getgrnam(group_name)
+        UserManagement._check_user_group(user, grp.getgrnam(group_name))
+
+    @staticmethod
+    def _check_user_group(user, group):
         if user.pw_gid != group.gr_gid:
 
             # check if the user is the right group, but the group is not primary.
-            if username in group.gr_mem:
+            if user.pw_name in group.gr_mem:
                 return
 
             raise ValidationError(
                 "User {} exists with current UID {}, however he should be assigned to group {} with {} UID, please "
-                "check `buildinfo.json`".format(username, user.pw_gid, group_name, group.gr_gid))
+                "check `buildinfo.json`".format(user.pw_name, user.pw_gid, group.gr_name, group.gr_gid))
 
     def add_user(self, username, group):
         UserManagement.validate_username(username)
+        assert self._users is None, "add_user() can't be called after ensure_users_exist()"
 
         if not self._manage_users:
             return
 
-        # Check if the user already exists and exit.
-        try:
-            UserManagement.validate_user_group(username, group)
-            self._users.add(username)
+        if username in self._requested and self._requested[username] != group:
+            raise ValidationError("User {} is required with both group {} and group {}".format(
+                username, self._requested[username], group))
+
+        self._requested[username] = group
+
+    def ensure_users_exist(self):
+        """Check all the users given to add_user() exist in the right groups, adding missing ones.
+
+        The user and group databases are read once for all the users, rather
+        than looking up each user separately. Users and groups which aren't
+        enumerable (some network user databases) are looked up by name.
+        """
+        self._users = dict()
+        if not self._requested:
             return
-        except KeyError as ex:
-            # Doesn't exist, fall through
-            pass
 
-        # If we're not allowed to manage users, error
-        if not self._add_users:
-            raise ValidationError("User {} doesn't exist but is required by a DC/OS Component, and "
-                                  "automatic user addition is disabled".format(username))
+        def snapshot():
+            return {user.pw_name: user for user in pwd.getpwall()}, \
+                {group.gr_name: group for group in grp.getgrall()}
+
+        def lookup(table, name, getter):
+            if name not in table:
+                table[name] = getter(name)
+            return table[name]
+
+        users, groups = snapshot()
 
-        # Add the user:
+        missing = []
+        for username, group_name in sorted(self._requested.items()):
+            try:
+                group = lookup(groups, group_name, grp.getgrnam) if group_name else None
+            except KeyError:
+                UserManagement.validate_group_name(group_name)
+                raise ValidationError("Group {} does not exist on the system".format(group_name))
+            try:
+                user = lookup(users, username, pwd.getpwnam)
+            except KeyError:
+                missing.append((username, group_name))
+                continue
+            if group:
+                UserManagement._check_user_group(user, group)
+
+        if missing:
+            # If we're not allowed to manage users, error
+            if not self._add_users:
+                raise ValidationError("Users {} don't exist but are required by DC/OS Components, and "
+                                      "automatic user addition is disabled".format(
+                                          ', '.join(username for username, _ in missing)))
+
+            for username, group_name in missing:
+                self._add_missing_user(username, group_name)
+
+            # Pick up the uids of the users just added.
+            users, groups = snapshot()
+
+        for username in self._requested:
+            self._users[username] = lookup(users, username, pwd.getpwnam).pw_uid
+
+    @staticmethod
+    def _add_missing_user(username, group_name):
         add_user_cmd = [
             'useradd',
             '--system',
@@ -545,17 +723,15 @@ class UserManagement:
             '-c', 'DCOS System User',
         ]
 
-        if group is not None:
-            UserManagement.validate_group(group)
+        if group_name:
             add_user_cmd += [
-                '-g', group
+                '-g', group_name
             ]
 
         add_user_cmd += [username]
 
         try:
             check_output(add_user_cmd)
-            self._users.add(username)
         except CalledProcessError as ex:
             raise ValidationError("User {} doesn't exist and couldn't be created because of: {}"
                                   .format(username, ex.output))
@@ -563,9 +739,10 @@ class UserManagement:
     def get_uid(self, username):
         # Code should have already asserted all users exist, and be passing us
         # a user we know about. This method only works for package users.
+        assert self._users is not None, "get_uid() can only be called after ensure_users_exist()"
         assert username in self._users
 
-        return pwd.getpwnam(username).pw_uid
+        return self._users[username]
 
 
 # A rooted install tree.
@@ -603,6 +780,11 @@ class Install:
         self.__manage_systemd = manage_systemd
         self.__block_systemd = block_systemd
 
+        # The active set, and the (inode, mtime) of the active folder it was read from.
+        # The stat of the active folder and the active set read from it, kept
+        # together so threads sharing the Install always see a matching pair.
+        self.__active = None
+
         # Look up the machine roles
         self.__roles = []
         if self.__config_dir:
@@ -641,6 +823,14 @@ class Install:
                 raise InstallError(
                     "Install directory {0} has no active folder. Has it been bootstrapped?".format(self.__root))
 
+        # Activation swaps in a new active folder, so the active set can only
+        # have changed if the folder has a different inode or modification time.
+        st = os.stat(active_dir)
+        active_stat = (st.st_ino, st.st_mtime_ns)
+        cached = self.__active
+        if cached is not None and cached[0] == active_stat:
+            return set(cached[1])
+
         ids = set()
         for name in os.listdir(active_dir):
             package_path = os.path.realpath(os.path.join(active_dir, name))
@@ -648,7 +838,8 @@ class Install:
             # cope if there is something invalid in the current active dir.
             ids.add(os.path.basename(package_path))
 
-        return ids
+        self.__active = (active_stat, ids)
+        return set(ids)
 
     def has_flag(self, name):
         return os.path.exists(self.get_config_filename(name))
@@ -656,6 +847,15 @@ class Install:
     def get_config_filename(self, name):
         return os.path.join(self.__config_dir, name)
 
+    def keep_package_tarballs(self):
+        """Whether fetched package tarballs should be kept so peers can fetch packages from this node.
+
+        Off unless the setup-flags/keep-package-tarballs file exists in the
+        config dir, which is meant for the nodes peers are pointed at, like
+        masters.
+        """
+        return os.path.exists(self.get_config_filename("setup-flags/keep-package-tarballs"))
+
     def _make_abs(self, name):
         return os.path.abspath(os.path.join(self.__root, name))
 
@@ -668,12 +868,102 @@ class Install:
                 "active",
                 "active.buildinfo.full.json"
             ]))
+
+    def _activation_fingerprint(self, packages):
+        """Hash of everything which determines what activating packages generates.
+
+        Packages are immutable once added to a repository, so their ids stand
+        in for their contents, except for setup packages which are rewritten
+        in place on config changes.
+        """
+        hasher = hashlib.sha1()
+        hasher.update(json.dumps({
+            'packages': sorted(
+                [str(package.id), hash_tree(package.path) if package.id.version == 'setup' else None]
+                for package in packages),
+            'roles': sorted(self.__roles),
+            'root': self.__root,
+            'fake_path': self.__fake_path,
+            'well_known_dirs': self.__well_known_dirs,
+            'dcos_service_configuration': self._get_dcos_configuration_template(),
+        }, sort_keys=True).encode())
+        return hasher.hexdigest()
+
+    def _get_active_fingerprint(self):
+        """The fingerprint of the active set, or None if it isn't known to be complete."""
+        if os.path.exists(self._make_abs("install_progress")):
+            return None
+        if not all(map(os.path.exists, self.get_active_names())):
+            return None
+        for line in load_string(self._make_abs("environment")).splitlines():
+            if line.startswith(fingerprint_prefix):
+                return line[len(fingerprint_prefix):]
+        return None
+
+    def is_active(self, packages):
+        """Whether activating packages would change nothing about the active set."""
+        try:
+            if self.get_active() != {str(package.id) for package in packages}:
+                return False
+        except InstallError:
+            return False
+        return self._get_active_fingerprint() == self._activation_fingerprint(packages)
+
+    def _ensure_users_and_state_dirs(self, packages):
+        """Create the package users and give them their state directories.
+
+        Done on every activation, including ones which otherwise change
+        nothing, so users and state directories which went missing or were
+        changed since the last activation get fixed up.
+        """
+        # Building up the set of users
+        sysusers = UserManagement(self.__manage_users, self.__add_users)
+        for package in packages:
+            # NOTE: It is critical the state dir, the package name and the user name are all the
+            # same. Otherwise on upgrades we might remove access to a files by changing their chown
+            # to something incompatible. We survive the first upgrade because everything goes from
+            # root to specific users, and root can access all user files.
+            if package.username is not None:
+                sysusers.add_user(package.username, package.group)
+
+        # Create / validate all the package users at once.
+        sysusers.ensure_users_exist()
+
+        # Ensure the state directory in `/var/lib/dcos` exists
+        # TODO(cmaloney): On upgrade take a snapshot?
+        if self.__manage_state_dir:
+            owners_filename = self._make_abs("state_dir_owners.json")
+            try:
+                owners = if_exists(load_json, owners_filename) or {}
+            except ValueError:
+                owners = {}
+            new_owners = {}
+            for package in packages:
+                if not package.state_directory:
+                    continue
+                state_dir_path = '/var/lib/dcos/{}'.format(package.name)
+                check_call(['mkdir', '-p', state_dir_path])
+
+                if package.username:
+                    uid = sysusers.get_uid(package.username)
+                    new_owners[state_dir_path] = fix_state_dir_owner(
+                        state_dir_path, uid, str(package.id), owners.get(state_dir_path))
+            if new_owners != owners:
+                write_json(owners_filename, new_owners)
+
     # Builds new working directories for the new active set, then swaps it into place as atomically as possible.
+    # Returns False without touching anything else (including running services)
+    # if the packages are already active with the same config, after making sure
+    # their users and state directories are still in place.
 
     def activate(self, packages):
         # Ensure the new set is reasonable.
         validate_compatible(packages, self.__roles)
 
+        if self.is_active(packages):
+            self._ensure_users_and_state_dirs(packages)
+            return False
+
         # Build the absolute paths for the running config, new config location,
         # and where to archive the config.
         active_names = self.get_active_names()
@@ -704,15 +994,13 @@ class Install:
 
         # Set the new LD_LIBRARY_PATH, PATH.
         env_contents = env_header.format("/opt/mesosphere" if self.__fake_path else self.__root)
+        env_contents += fingerprint_prefix + self._activation_fingerprint(packages) + "\n\n"
         env_export_contents = env_export_header.format("/opt/mesosphere" if self.__fake_path else self.__root)
 
         active_buildinfo_full = {}
 
         dcos_service_configuration = self._get_dcos_configuration_template()
 
-        # Building up the set of users
-        sysusers = UserManagement(self.__manage_users, self.__add_users)
-
         def _get_service_files(_dir):
             service_files = []
             for root, directories, filenames in os.walk(_dir):
@@ -782,24 +1070,6 @@ class Install:
                 # setup-packages to add a buildinfo.full for those packages
                 active_buildinfo_full[package.name] = None
 
-            # NOTE: It is critical the state dir, the package name and the user name are all the
-            # same. Otherwise on upgrades we might remove access to a files by changing their chown
-            # to something incompatible. We survive the first upgrade because everything goes from
-            # root to specific users, and root can access all user files.
-            if package.username is not None:
-                sysusers.add_user(package.username, package.group)
-
-            # Ensure the state directory in `/var/lib/dcos` exists
-            # TODO(cmaloney): On upgrade take a snapshot?
-            if self.__manage_state_dir:
-                state_dir_path = '/var/lib/dcos/{}'.format(package.name)
-                if package.state_directory:
-                    check_call(['mkdir', '-p', state_dir_path])
-
-                    if package.username:
-                        uid = sysusers.get_uid(package.username)
-                        check_call(['chown', '-R', str(uid), state_dir_path])
-
             if package.sysctl:
                 service_names = _get_service_names(package.path)
 
@@ -811,6 +1081,8 @@ class Install:
                     if service in package.sysctl:
                         dcos_service_configuration["sysctl"][service] = package.sysctl[service]
 
+        self._ensure_users_and_state_dirs(packages)
+
         dcos_service_configuration_file = os.path.join(self._make_abs("etc.new"), DCOS_SERVICE_CONFIGURATION_FILE)
         write_json(dcos_service_configuration_file, dcos_service_configuration)
 
@@ -827,6 +1099,7 @@ class Install:
         write_json(new_buildinfo_meta, active_buildinfo_full)
 
         self.swap_active(".new")
+        return True
 
     def recover_swap_active(self):
         state_filename = self._make_abs("install_progress")
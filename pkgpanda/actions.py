@@ -7,9 +7,10 @@ from subprocess import CalledProcessError, check_call
 from pkgpanda import PackageId, requests_fetcher
 from pkgpanda.constants import (DCOS_SERVICE_CONFIGURATION_PATH,
                                 SYSCTL_SETTING_KEY)
+from pkgpanda.delta import requests_delta_fetcher
 from pkgpanda.exceptions import FetchError, PackageConflict, ValidationError
 from pkgpanda.util import (extract_tarball, if_exists, load_json, load_string,
-                           write_string)
+                           rank_by_latency, write_string)
 
 DCOS_TARGET_CONTENTS = """[Install]
 WantedBy=multi-user.target
@@ -28,7 +29,8 @@ def activate_packages(install, repository, package_ids, systemd, block_systemd):
     block_systemd: if systemd, block waiting for systemd services to come up
 
     """
-    install.activate(repository.load_packages(package_ids))
+    if not install.activate(repository.load_packages(package_ids)):
+        print("Packages are already active with the same configuration, nothing to do.")
     if systemd:
         _start_dcos_target(block_systemd)
 
@@ -64,31 +66,45 @@ def swap_active_package(install, repository, package_id, systemd, block_systemd)
     activate_packages(install, repository, new_active, systemd, block_systemd)
 
 
-def fetch_package(repository, repository_url, package_id, work_dir):
+def fetch_package(repository, repository_url, package_id, work_dir, progress=None, show_progress=True):
     """Fetch package_id from repository_url into repository.
 
     repository: pkgpanda.Repository
-    repository_url: URL for remote package repository
+    repository_url: URL for remote package repository, or a list of URLs of
+        mirrors / peers to try in order
     package_id: package ID to fetch
     work_dir: location for temporary files, used only if repository_url is a file URL with a relative path
+    progress: optional callable given the size of each chunk of the package downloaded
+    show_progress: whether to write which package is being fetched to stdout, which
+        should be off when fetching several packages at once
+
+    Returns False if the package was already in the repository.
 
     """
     def fetcher(id_, target):
-        return requests_fetcher(repository_url, id_, target, work_dir)
+        return requests_fetcher(
+            repository_url, id_, target, work_dir, progress=progress, tarball=repository.kept_tarball_path(id_))
+
+    def delta_fetcher(base_id, base_dir, id_, target):
+        return requests_delta_fetcher(repository_url, base_id, base_dir, id_, target, work_dir)
 
     # TODO(cmaloney): Make this not use escape sequences when not at a
     # `real` terminal.
-    sys.stdout.write("\rFetching: {0}".format(package_id))
-    sys.stdout.flush()
+    if show_progress:
+        sys.stdout.write("\rFetching: {0}".format(package_id))
+        sys.stdout.flush()
     try:
-        repository.add(fetcher, package_id)
+        added = repository.add(fetcher, package_id, warn_added=show_progress, delta_fetcher=delta_fetcher)
     except FetchError as ex:
         raise Exception("Unable to fetch package {0}: {1}".format(package_id, ex)) from ex
     else:
-        sys.stdout.write("\rFetched: {0}".format(package_id))
+        if show_progress:
+            sys.stdout.write("\rFetched: {0}".format(package_id))
     finally:
-        sys.stdout.write("\n")
-        sys.stdout.flush()
+        if show_progress:
+            sys.stdout.write("\n")
+            sys.stdout.flush()
+    return added
 
 
 def add_package_file(repository, package_filename):
@@ -194,13 +210,21 @@ def _do_bootstrap(install, repository):
     # These files should be set by the environment which initially builds
     # the host (cloud-init).
     repository_url = if_exists(load_string, install.get_config_filename("setup-flags/repository-url"))
+    if repository_url is not None:
+        # Multiple whitespace separated mirrors may be given, use the fastest
+        # to respond first.
+        repository_url = rank_by_latency(repository_url.split())
 
     # TODO(cmaloney): If there is 1+ master, grab the active config from a master.
     # If the config can't be grabbed from any of them, fail.
     def fetcher(id, target):
         if repository_url is None:
             raise ValidationError("ERROR: Non-local package {} but no repository url given.".format(repository_url))
-        return requests_fetcher(repository_url, id, target, os.getcwd())
+        return requests_fetcher(repository_url, id, target, os.getcwd(), tarball=repository.kept_tarball_path(id))
+
+    delta_fetcher = None
+    if repository_url is not None:
+        delta_fetcher = partial(requests_delta_fetcher, repository_url, work_dir=os.getcwd())
 
     # Copy host/cluster-specific packages written to the filesystem manually
     # from the setup-packages folder into the repository. Do not overwrite or
@@ -238,7 +262,7 @@ def _do_bootstrap(install, repository):
         # Ensure all packages are local
         print("Ensuring all packages in active set {} are local".format(",".join(to_activate)))
         for package in to_activate:
-            repository.add(fetcher, package)
+            repository.add(fetcher, package, delta_fetcher=delta_fetcher)
     else:
         print("Calculated active packages from bootstrap tarball")
         to_activate = list(install.get_active())
@@ -259,7 +283,7 @@ def _do_bootstrap(install, repository):
 
                 # Fetch the packages if not local
                 if not repository.has_package(package_id_str):
-                    repository.add(fetcher, package_id_str)
+                    repository.add(fetcher, package_id_str, delta_fetcher=delta_fetcher)
 
                 # Add the package to the set to activate
                 setup_packages_to_activate.append(package_id_str)
@@ -10,7 +10,7 @@ Usage:
   pkgpanda remove <id>... [options]
   pkgpanda setup [options]
   pkgpanda uninstall [options]
-  pkgpanda check [--list] [options]
+  pkgpanda check [--list] [--json] [--check-timeout=<seconds>] [--check-jobs=<n>] [options]
 
 Options:
     --config-dir=<conf-dir>     Use an alternate directory for finding machine
@@ -22,18 +22,31 @@ Options:
                                 repository directory [default: {default_repository}]
     --rooted-systemd            Use $ROOT/dcos.target.wants for systemd management
                                 rather than /etc/systemd/system/dcos.target.wants
+    --repository-url=<url>      Remote package repository to fetch from. May be a
+                                comma separated list of mirrors / peers, which are
+                                tried fastest first.
+    --json                      Print check results as JSON.
+    --check-timeout=<seconds>   Kill checks which run for longer than this and count
+                                them as failed. By default checks aren't timed out.
+    --check-jobs=<n>            Maximum number of checks to run at once. [default: 8]
 """
 
+import json
 import os
+import signal
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from itertools import groupby
 from os import umask
-from subprocess import CalledProcessError, check_call
+from subprocess import check_call, PIPE, Popen, TimeoutExpired
 
 from docopt import docopt
 
 from pkgpanda import actions, constants, Install, PackageId, Repository
 from pkgpanda.exceptions import PackageError, PackageNotFound, ValidationError
+from pkgpanda.util import json_prettyprint_args, rank_by_latency
 
 
 def print_repo_list(packages):
@@ -109,16 +122,155 @@ def list_checks(checks):
             print(' - {}'.format(check_file))
 
 
-def run_checks(checks, install, repository):
-    exit_code = 0
+def run_check(path, timeout=None, on_output=None):
+    """Run the check executable at path, killing it after timeout seconds.
+
+    Checks run in their own session so anything they start is killed along
+    with them on timeout. Output is passed to on_output(stream, data) as the
+    check writes it, where stream is 'stdout' or 'stderr'. Returns the status
+    (ok, failed, timeout or error), exit code, duration and output of the check.
+    """
+    start = time.monotonic()
+    try:
+        proc = Popen([path], stdout=PIPE, stderr=PIPE, start_new_session=True)
+    except OSError as ex:
+        message = 'Unable to run check: {}\n'.format(ex)
+        if on_output:
+            on_output('stderr', message.encode())
+        return {
+            'status': 'error',
+            'returncode': None,
+            'duration': time.monotonic() - start,
+            'stdout': '',
+            'stderr': message}
+
+    output = {'stdout': [], 'stderr': []}
+
+    def read(name, pipe):
+        with pipe:
+            for data in iter(lambda: os.read(pipe.fileno(), 65536), b''):
+                output[name].append(data)
+                if on_output:
+                    on_output(name, data)
+
+    readers = [
+        threading.Thread(target=read, args=('stdout', proc.stdout)),
+        threading.Thread(target=read, args=('stderr', proc.stderr))]
+    for reader in readers:
+        reader.start()
+
+    try:
+        proc.wait(timeout=timeout)
+        status = 'ok' if proc.returncode == 0 else 'failed'
+    except TimeoutExpired:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        proc.wait()
+        status = 'timeout'
+
+    for reader in readers:
+        reader.join()
+
+    return {
+        'status': status,
+        'returncode': proc.returncode,
+        'duration': time.monotonic() - start,
+        'stdout': b''.join(output['stdout']).decode(errors='replace'),
+        'stderr': b''.join(output['stderr']).decode(errors='replace')}
+
+
+class OrderedOutput:
+    """Forward the output of concurrently running checks without interleaving it.
+
+    Output of the first unfinished check is written as soon as it arrives.
+    Output of later checks is held back until every check before them has
+    finished, so the output reads the same as if the checks had run one after
+    another.
+    """
+
+    def __init__(self, count):
+        self._lock = threading.Lock()
+        self._current = 0
+        self._held = [[] for _ in range(count)]
+        self._finished = [False] * count
+
+    def _write(self, stream, data):
+        stream.flush()
+        stream.buffer.write(data)
+        stream.flush()
+
+    def write(self, index, name, data):
+        stream = sys.stdout if name == 'stdout' else sys.stderr
+        with self._lock:
+            if index == self._current:
+                self._write(stream, data)
+            else:
+                self._held[index].append((stream, data))
+
+    def finish(self, index):
+        with self._lock:
+            self._finished[index] = True
+            while self._current < len(self._finished) and self._finished[self._current]:
+                self._current += 1
+                if self._current < len(self._held):
+                    for stream, data in self._held[self._current]:
+                        self._write(stream, data)
+                    self._held[self._current] = []
+
+
+def execute_checks(checks, repository, timeout=None, jobs=8, output=None):
+    """Run checks concurrently, at most jobs at a time.
+
+    If output is an OrderedOutput the output of the checks along with a
+    message for each one which didn't pass is streamed to it. Returns one
+    result per check in the same order as list_checks prints them.
+    """
+    to_run = []
     for pkg_id, check_files in sorted(checks.items()):
         check_dir = repository.load(pkg_id).check_dir
         for check_file in check_files:
-            try:
-                check_call([os.path.join(check_dir, check_file)])
-            except CalledProcessError:
-                print('Check failed: {}'.format(check_file))
-                exit_code = 1
+            to_run.append((pkg_id, check_file, os.path.join(check_dir, check_file)))
+
+    def run(index, check_file, path):
+        on_output = None
+        if output:
+            def on_output(name, data):
+                output.write(index, name, data)
+        result = run_check(path, timeout, on_output)
+        if output:
+            if result['status'] == 'timeout':
+                message = 'Check timed out after {:.1f}s: {}\n'.format(result['duration'], check_file)
+                output.write(index, 'stdout', message.encode())
+            elif result['status'] != 'ok':
+                output.write(index, 'stdout', 'Check failed: {}\n'.format(check_file).encode())
+            output.finish(index)
+        return result
+
+    if not to_run:
+        return []
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(run, index, check_file, path)
+            for index, (_, check_file, path) in enumerate(to_run)]
+        results = []
+        for (pkg_id, check_file, _), future in zip(to_run, futures):
+            result = future.result()
+            result.update({'package': pkg_id, 'check': check_file})
+            results.append(result)
+    return results
+
+
+def run_checks(checks, install, repository, timeout=None, jobs=8, json_output=False):
+    # Check output is streamed as it is written unless it is collected into JSON.
+    output = None if json_output else OrderedOutput(sum(len(files) for files in checks.values()))
+    results = execute_checks(checks, repository, timeout, jobs, output)
+    exit_code = 0 if all(result['status'] == 'ok' for result in results) else 1
+
+    if json_output:
+        print(json.dumps({'status': exit_code, 'checks': results}, **json_prettyprint_args))
     return exit_code
 
 
@@ -143,7 +295,7 @@ def main():
         add_users=not os.path.exists('/etc/mesosphere/manual_host_users'),
         manage_state_dir=True)
 
-    repository = Repository(os.path.abspath(arguments['--repository']))
+    repository = Repository(os.path.abspath(arguments['--repository']), install.keep_package_tarballs())
 
     try:
         if arguments['setup']:
@@ -164,10 +316,11 @@ def main():
             sys.exit(0)
 
         if arguments['fetch']:
+            repository_urls = rank_by_latency(arguments['--repository-url'].split(','))
             for package_id in arguments['<id>']:
                 actions.fetch_package(
                     repository,
-                    arguments['--repository-url'],
+                    repository_urls,
                     package_id,
                     os.getcwd())
             sys.exit(0)
@@ -208,7 +361,13 @@ def main():
                 list_checks(checks)
                 sys.exit(0)
             # Run all checks
-            sys.exit(run_checks(checks, install, repository))
+            sys.exit(run_checks(
+                checks,
+                install,
+                repository,
+                timeout=float(arguments['--check-timeout']) if arguments['--check-timeout'] else None,
+                jobs=int(arguments['--check-jobs']),
+                json_output=arguments['--json']))
     except ValidationError as ex:
         print("Validation Error: {0}".format(ex))
         sys.exit(1)
@@ -0,0 +1,142 @@
+"""Deltas between two versions of a package
+
+A delta lets a node which already has a base package reconstruct a target
+package (another version of the same package) without downloading the whole
+target tarball. It is a tarball containing:
+
+ - delta.json: the base and target ids, the paths to remove from the base and
+   the tree hash of the full target package.
+ - files/: every file, directory and symlink of the target which is new or
+   differs from the base.
+
+The reconstructed package is always checked against the target tree hash
+before it is used.
+"""
+import json
+import os
+import tarfile
+import tempfile
+from io import BytesIO
+from shutil import rmtree
+from subprocess import check_call
+
+from pkgpanda import PackageId
+from pkgpanda.exceptions import FetchError, ValidationError
+from pkgpanda.util import download, hash_tree, json_prettyprint_args, tree_entries
+
+manifest_name = 'delta.json'
+files_prefix = 'files/'
+
+
+def delta_filename(base_id, target_id):
+    """Name of the delta from base_id to target_id in a package repository."""
+    base = PackageId(base_id)
+    target = PackageId(target_id)
+    if base.name != target.name:
+        raise ValidationError("Deltas are only between versions of the same package. Got {} and {}".format(
+            base_id, target_id))
+    return "packages/{}/{}.delta-from-{}.tar.xz".format(target.name, target_id, base.version)
+
+
+def _reset_owner(tarinfo):
+    tarinfo.uid = tarinfo.gid = 0
+    tarinfo.uname = tarinfo.gname = ''
+    return tarinfo
+
+
+def make_delta(base_id, base_dir, target_id, target_dir, out_filename):
+    """Write the delta which turns the package base_dir into target_dir to out_filename."""
+    base_dir = base_dir.rstrip('/')
+    target_dir = target_dir.rstrip('/')
+    base = tree_entries(base_dir)
+    target = tree_entries(target_dir)
+
+    # Files and symlinks which change are removed and then re-added rather
+    # than overwritten in place, as are paths which change kind. Directories
+    # which stay directories keep their contents.
+    def is_removed(path, entry):
+        if path not in target or target[path][0] != entry[0]:
+            return True
+        return entry[0] != 'd' and target[path] != entry
+    removed = sorted(path for path, entry in base.items() if is_removed(path, entry))
+    changed = sorted(path for path, entry in target.items() if base.get(path) != entry)
+
+    manifest = json.dumps({
+        'base': base_id,
+        'target': target_id,
+        'removed': removed,
+        'tree_hash': hash_tree(target_dir)
+    }, **json_prettyprint_args).encode()
+
+    with tarfile.open(out_filename, 'w:xz') as tar:
+        manifest_info = _reset_owner(tarfile.TarInfo(manifest_name))
+        manifest_info.size = len(manifest)
+        tar.addfile(manifest_info, BytesIO(manifest))
+        for path in changed:
+            tar.add(
+                os.path.join(target_dir, path),
+                arcname=files_prefix + path,
+                recursive=False,
+                filter=_reset_owner)
+
+
+def apply_delta(base_id, base_dir, target_id, delta_file, target):
+    """Reconstruct the package target_id into target from base_dir and a delta.
+
+    If the result doesn't match the tree hash of the target package target is
+    removed and a ValidationError raised.
+    """
+    assert not os.path.exists(target)
+    try:
+        with tarfile.open(delta_file) as tar:
+            manifest = json.loads(tar.extractfile(manifest_name).read().decode())
+            if manifest['base'] != base_id or manifest['target'] != target_id:
+                raise ValidationError("Delta is from {} to {}, not from {} to {}".format(
+                    manifest['base'], manifest['target'], base_id, target_id))
+
+            members = []
+            for member in tar.getmembers():
+                if not member.name.startswith(files_prefix):
+                    continue
+                member.name = member.name[len(files_prefix):]
+                if os.path.isabs(member.name) or '..' in member.name.split('/'):
+                    raise ValidationError("Delta contains a path outside of the package: {}".format(member.name))
+                members.append(member)
+
+            check_call(['cp', '-a', base_dir, target])
+            for path in manifest['removed']:
+                full_path = os.path.join(target, path)
+                if os.path.isdir(full_path) and not os.path.islink(full_path):
+                    rmtree(full_path)
+                elif os.path.lexists(full_path):
+                    os.remove(full_path)
+            tar.extractall(target, members=members, numeric_owner=True)
+
+        tree_hash = hash_tree(target)
+        if tree_hash != manifest['tree_hash']:
+            raise ValidationError("Package {} reconstructed from a delta has tree hash {} rather than {}".format(
+                target_id, tree_hash, manifest['tree_hash']))
+    except BaseException:
+        rmtree(target, ignore_errors=True)
+        raise
+
+
+def requests_delta_fetcher(base_url, base_id, base_dir, target_id, target, work_dir):
+    """Fetch the delta from base_id to target_id from base_url and apply it.
+
+    base_url may be a list of repository urls, which are tried in order.
+    """
+    base_urls = [base_url] if isinstance(base_url, str) else base_url
+    path = delta_filename(base_id, target_id)
+    fetch_error = None
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        delta_file = os.path.join(tmp_dir, os.path.basename(path))
+        for url in base_urls:
+            try:
+                download(delta_file, url.rstrip('/') + '/' + path, work_dir)
+            except FetchError as ex:
+                fetch_error = ex
+                continue
+            apply_delta(base_id, base_dir, target_id, delta_file, target)
+            return
+    raise fetch_error
@@ -4,12 +4,15 @@ import http.client
 import logging
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
-from flask import current_app, Flask, jsonify, make_response, request
+from flask import current_app, Flask, jsonify, make_response, request, send_file, url_for
 
-from pkgpanda import actions, Install, Repository
-from pkgpanda.exceptions import (PackageConflict, PackageError,
+from pkgpanda import actions, Install, PackageId, Repository
+from pkgpanda.exceptions import (InstallError, PackageConflict, PackageError,
                                  PackageNotFound, ValidationError)
+from pkgpanda.http.jobs import JobManager
 
 
 empty_response = ('', http.client.NO_CONTENT)
@@ -70,10 +73,35 @@ def package_response(package_id, repository):
     return response
 
 
+def get_repository_url(body):
+    """The repository_url from a request body, which is either a single url or a list of mirrors / peers."""
+    repository_url = body['repository_url']
+    if isinstance(repository_url, list):
+        if not repository_url or not all(isinstance(url, str) for url in repository_url):
+            raise ValueError('Invalid repository_url list')
+    elif not isinstance(repository_url, str):
+        raise ValueError('Invalid repository_url')
+    return repository_url
+
+
+def prefers_async():
+    """Whether the client asked for long running operations to be run as a job (RFC 7240)."""
+    return 'respond-async' in request.headers.get('Prefer', '')
+
+
+def job_accepted_response(job):
+    response = jsonify(job.to_json())
+    response.status_code = http.client.ACCEPTED
+    response.headers['Location'] = url_for('get_job', job_id=job.id)
+    return response
+
+
 app = Flask(__name__)
 app.config.from_object('pkgpanda.http.config')
 app.config.from_envvar('PKGPANDA_HTTP_CONFIG', silent=True)
 
+jobs = JobManager()
+
 
 @app.errorhandler(Exception)
 def unexpected_exception_handler(exc):
@@ -88,6 +116,14 @@ def uncaught_exception_handler(exc):
 
 @app.before_request
 def set_app_attrs_from_config():
+    # The Install and Repository are kept between requests so what they cache
+    # about the active set and the packages on disk is too. They notice changes
+    # on disk themselves, and are only recreated if the config changes.
+    state_key = tuple(current_app.config[name] for name in [
+        'DCOS_ROOT', 'DCOS_CONFIG_DIR', 'DCOS_ROOTED_SYSTEMD', 'DCOS_REPO_DIR'])
+    if getattr(current_app, 'state_key', None) == state_key:
+        return
+
     current_app.install = Install(
         current_app.config['DCOS_ROOT'],
         current_app.config['DCOS_CONFIG_DIR'],
@@ -95,7 +131,31 @@ def set_app_attrs_from_config():
         manage_systemd=True,
         block_systemd=False)
     current_app.repository = Repository(
-        current_app.config['DCOS_REPO_DIR'])
+        current_app.config['DCOS_REPO_DIR'],
+        current_app.install.keep_package_tarballs())
+    current_app.state_key = state_key
+
+
+def recover_job(job):
+    """Settle a job which was still pending or running when the API went away.
+
+    Activating packages restarts the API, so an activation which was running
+    at the time succeeded if its packages are what is active now.
+    """
+    if job.operation == 'activate' and job.state == 'running':
+        try:
+            if current_app.install.get_active() == set(job.packages):
+                job.state = 'succeeded'
+                return
+        except InstallError:
+            pass
+    job.state = 'failed'
+    job.error = 'Interrupted by the pkgpanda API restarting.'
+
+
+@app.before_request
+def load_jobs():
+    jobs.load(current_app.config['JOBS_DIR'], recover_job)
 
 
 @app.before_request
@@ -103,11 +163,89 @@ def create_work_dir():
     os.makedirs(current_app.config['WORK_DIR'], exist_ok=True)
 
 
+@app.after_request
+def add_etag(response):
+    """Tag JSON responses with an ETag, answering 304 if the client already has the same response.
+
+    Pollers which send If-None-Match then only cost a lookup in the cached
+    state, with no body sent back.
+    """
+    if request.method in ('GET', 'HEAD') and response.status_code == http.client.OK and \
+            response.mimetype == 'application/json':
+        response.add_etag()
+        response.make_conditional(request)
+    return response
+
+
 @app.route('/repository/', methods=['GET'])
 def get_package_list():
     return package_listing_response(current_app.repository.list())
 
 
+@app.route('/repository/', methods=['POST'])
+def fetch_packages():
+    try:
+        repository_url = get_repository_url(request.json)
+        package_ids = request.json['package_ids']
+        if not isinstance(package_ids, list) or not all(isinstance(id, str) for id in package_ids):
+            raise ValueError('Invalid package_ids')
+    except Exception:
+        return (
+            error_response(
+                'Request body must be a json object with `repository_url` and '
+                '`package_ids` keys.'
+            ),
+            http.client.BAD_REQUEST,
+        )
+
+    invalid_package_ids = []
+    for package_id in package_ids:
+        try:
+            PackageId(package_id)
+        except ValidationError:
+            invalid_package_ids.append(package_id)
+    if invalid_package_ids:
+        return (
+            error_response('Invalid package IDs.', invalid_package_ids=invalid_package_ids),
+            http.client.BAD_REQUEST,
+        )
+
+    package_ids = sorted(set(package_ids))
+    repository = current_app.repository
+    work_dir = current_app.config['WORK_DIR']
+    parallelism = current_app.config['FETCH_PARALLELISM']
+
+    def run_fetch_all(job):
+        job.set_phase('fetching')
+        job.set_progress('bytes_downloaded', 0)
+        job.set_progress('packages_extracted', 0)
+        job.set_progress('packages_total', len(package_ids))
+
+        def fetch(package_id):
+            try:
+                added = actions.fetch_package(
+                    repository,
+                    repository_url,
+                    package_id,
+                    work_dir,
+                    progress=partial(job.add_progress, 'bytes_downloaded'),
+                    show_progress=False)
+            except Exception as ex:
+                logging.exception('Unable to fetch package %s', package_id)
+                return {'status': 'failed', 'error': str(ex)}
+            job.add_progress('packages_extracted', 1)
+            return {'status': 'fetched' if added else 'present'}
+
+        with ThreadPoolExecutor(max_workers=parallelism) as executor:
+            return dict(zip(package_ids, executor.map(fetch, package_ids)))
+
+    job, result = jobs.submit('fetch', package_ids, run_fetch_all)
+    if prefers_async():
+        return job_accepted_response(job)
+
+    return jsonify(result.result())
+
+
 @app.route('/repository/<package_id>', methods=['GET'])
 def get_package(package_id):
     return package_response(package_id, current_app.repository)
@@ -116,7 +254,7 @@ def get_package(package_id):
 @app.route('/repository/<package_id>', methods=['POST'])
 def fetch_package(package_id):
     try:
-        repository_url = request.json['repository_url']
+        repository_url = get_repository_url(request.json)
     except Exception:
         return (
             error_response(
@@ -127,11 +265,34 @@ def fetch_package(package_id):
         )
 
     try:
+        PackageId(package_id)
+    except ValidationError:
+        return (
+            invalid_package_id_response(package_id),
+            http.client.BAD_REQUEST,
+        )
+
+    repository = current_app.repository
+    work_dir = current_app.config['WORK_DIR']
+
+    def run_fetch(job):
+        job.set_phase('fetching')
+        job.set_progress('bytes_downloaded', 0)
+        job.set_progress('packages_extracted', 0)
         actions.fetch_package(
-            current_app.repository,
+            repository,
             repository_url,
             package_id,
-            current_app.config['WORK_DIR'])
+            work_dir,
+            progress=partial(job.add_progress, 'bytes_downloaded'))
+        job.set_progress('packages_extracted', 1)
+
+    job, result = jobs.submit('fetch', [package_id], run_fetch)
+    if prefers_async():
+        return job_accepted_response(job)
+
+    try:
+        result.result()
     except ValidationError:
         response = (
             invalid_package_id_response(package_id),
@@ -146,10 +307,11 @@ def fetch_package(package_id):
 @app.route('/repository/<package_id>', methods=['DELETE'])
 def remove_package(package_id):
     try:
-        actions.remove_package(
-            current_app.install,
-            current_app.repository,
-            package_id)
+        with jobs.operation_lock:
+            actions.remove_package(
+                current_app.install,
+                current_app.repository,
+                package_id)
     except PackageNotFound:
         response = (
             package_not_found_response(package_id),
@@ -171,6 +333,28 @@ def remove_package(package_id):
     return response
 
 
+@app.route('/packages/<name>/<package_id>.tar.xz', methods=['GET'])
+def get_package_tarball(name, package_id):
+    """Serve a local package in the layout of a package repository.
+
+    This lets other nodes use this one as a peer to fetch packages from.
+    """
+    try:
+        valid = PackageId(package_id).name == name
+    except ValidationError:
+        valid = False
+    if not valid:
+        return invalid_package_id_response(package_id), http.client.NOT_FOUND
+
+    # Serve the tarball the package was fetched from as is, so that it is byte
+    # for byte what the mirrors have, matches their sha1 and can be resumed.
+    tarball = current_app.repository.tarball_path(package_id)
+    if not current_app.repository.has_package(package_id) or not os.path.exists(tarball):
+        return package_not_found_response(package_id), http.client.NOT_FOUND
+
+    return send_file(tarball, mimetype='application/x-xz', conditional=True)
+
+
 @app.route('/active/', methods=['GET'])
 def get_active_package_list():
     return package_listing_response(current_app.install.get_active())
@@ -214,22 +398,49 @@ def activate_packages():
             http.client.CONFLICT,
         )
 
+    install = current_app.install
+    repository = current_app.repository
+    package_ids = request.json
+    systemd = not current_app.config.get('TESTING')
+
+    def run_activate(job):
+        job.set_phase('activating')
+        job.set_progress('packages_total', len(package_ids))
+        actions.activate_packages(
+            install,
+            repository,
+            package_ids,
+            systemd=systemd,
+            block_systemd=False)
+
     # This will stop all DC/OS services, including this app. Use a web server
     # that supports graceful shutdown to ensure that activation is completed
-    # and a response is returned.
+    # and a response is returned, or run it as a job and poll the job's status.
+    job, result = jobs.submit('activate', package_ids, run_activate)
+    if prefers_async():
+        return job_accepted_response(job)
+
     try:
-        actions.activate_packages(
-            current_app.install,
-            current_app.repository,
-            request.json,
-            systemd=(not current_app.config.get('TESTING')),
-            block_systemd=False)
+        result.result()
     except ValidationError as exc:
         return error_response(str(exc)), http.client.CONFLICT
 
     return empty_response
 
 
+@app.route('/jobs/', methods=['GET'])
+def get_job_list():
+    return jsonify([job.to_json() for job in jobs.list()])
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return error_response('Job {} not found.'.format(job_id)), http.client.NOT_FOUND
+    return jsonify(job.to_json())
+
+
 if __name__ == '__main__':
     # TODO(branden): expose app config as cli params
     if '-d' in sys.argv[1:]:
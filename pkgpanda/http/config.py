@@ -10,3 +10,10 @@ DCOS_REPO_DIR = constants.repository_base
 DCOS_ROOTED_SYSTEMD = False
 
 WORK_DIR = os.path.join(tempfile.gettempdir(), 'pkgpanda_api')
+
+# Where job statuses are kept so they survive the API restarting. None keeps
+# them in memory only.
+JOBS_DIR = None
+
+# Maximum number of packages fetched at once by bulk fetches.
+FETCH_PARALLELISM = 4
@@ -0,0 +1,195 @@
+"""Background jobs for long running pkgpanda HTTP API operations
+
+Fetching and activating packages can take longer than clients are willing to
+hold a request open. They run as jobs on a single worker thread instead, which
+also serializes them so two operations never change the repository or the
+active set at the same time. Clients poll the job's status to see its progress
+and final result.
+
+Activating packages restarts the API itself, so job statuses can be kept on
+disk and are loaded again when it starts back up.
+"""
+
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from pkgpanda.util import load_json, write_json
+
+
+class Job:
+    """A single operation and its progress.
+
+    The function running the job updates phase and progress as it goes. The
+    job is saved with save(job) whenever its state or phase changes.
+    """
+
+    def __init__(self, operation, packages, save=None):
+        self.id = uuid.uuid4().hex
+        self.operation = operation
+        self.packages = list(packages)
+        self.description = ','.join(self.packages)
+        self.state = 'pending'
+        self.phase = 'queued'
+        self.progress = {}
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.__save = save
+        self.__lock = threading.Lock()
+
+    @classmethod
+    def from_json(cls, data, save=None):
+        job = cls(data['operation'], data['packages'], save)
+        keys = ['id', 'description', 'state', 'phase', 'progress', 'result', 'error', 'created', 'started', 'finished']
+        for key in keys:
+            setattr(job, key, data[key])
+        return job
+
+    def save(self):
+        if self.__save:
+            self.__save(self)
+
+    def set_phase(self, phase):
+        self.phase = phase
+        self.save()
+
+    def add_progress(self, key, amount):
+        with self.__lock:
+            self.progress[key] = self.progress.get(key, 0) + amount
+
+    def set_progress(self, key, value):
+        with self.__lock:
+            self.progress[key] = value
+
+    def to_json(self):
+        with self.__lock:
+            progress = dict(self.progress)
+        return {
+            'id': self.id,
+            'operation': self.operation,
+            'packages': self.packages,
+            'description': self.description,
+            'state': self.state,
+            'phase': self.phase,
+            'progress': progress,
+            'result': self.result,
+            'error': self.error,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+        }
+
+
+class JobManager:
+    """Runs jobs one at a time in submission order, keeping the most recent ones for status queries."""
+
+    def __init__(self, max_finished=100):
+        self.__max_finished = max_finished
+        self.__jobs = OrderedDict()
+        self.__jobs_lock = threading.Lock()
+        self.__jobs_dir = None
+        self.__save_lock = threading.Lock()
+        self.__executor = ThreadPoolExecutor(max_workers=1)
+        # Held while a job runs. Synchronous operations which also change the
+        # repository or the active set take it to serialize with the jobs.
+        self.operation_lock = threading.Lock()
+
+    def submit(self, operation, packages, fn):
+        """Queue fn(job) to run as a job operating on the given package ids.
+
+        Returns the job and a future for the result of fn.
+        """
+        job = Job(operation, packages, self.__save)
+        with self.__jobs_lock:
+            self.__jobs[job.id] = job
+            job.save()
+            self.__forget_finished()
+        return job, self.__executor.submit(self.__run, job, fn)
+
+    def load(self, jobs_dir, recover):
+        """Keep job statuses in jobs_dir from now on, loading the ones already kept there.
+
+        Jobs which were pending or running when the process keeping them went
+        away are passed to recover(job), which sets their state, result and
+        error to what became of them. Does nothing if jobs_dir is already in
+        use, and stops keeping job statuses on disk if it is None.
+        """
+        with self.__jobs_lock:
+            if jobs_dir == self.__jobs_dir:
+                return
+            self.__jobs_dir = jobs_dir
+            if jobs_dir is None:
+                return
+
+            os.makedirs(jobs_dir, exist_ok=True)
+            jobs = list(self.__jobs.values())
+            for name in os.listdir(jobs_dir):
+                if not name.endswith('.json') or name[:-len('.json')] in self.__jobs:
+                    continue
+                try:
+                    job = Job.from_json(load_json(os.path.join(jobs_dir, name)), self.__save)
+                except (KeyError, TypeError, ValueError):
+                    logging.exception("Ignoring unreadable job status %s", name)
+                    continue
+                if job.finished is None:
+                    recover(job)
+                    job.phase = 'done'
+                    job.finished = time.time()
+                    job.save()
+                jobs.append(job)
+
+            self.__jobs = OrderedDict((job.id, job) for job in sorted(jobs, key=lambda job: job.created))
+            self.__forget_finished()
+
+    def __job_path(self, job_id):
+        return os.path.join(self.__jobs_dir, job_id + '.json')
+
+    def __save(self, job):
+        with self.__save_lock:
+            if self.__jobs_dir is None:
+                return
+            path = self.__job_path(job.id)
+            write_json(path + '.tmp', job.to_json())
+            os.replace(path + '.tmp', path)
+
+    def __run(self, job, fn):
+        with self.operation_lock:
+            job.state = 'running'
+            job.started = time.time()
+            job.save()
+            try:
+                job.result = fn(job)
+                job.state = 'succeeded'
+                return job.result
+            except Exception as ex:
+                logging.exception("Job %s (%s) failed", job.id, job.description)
+                job.error = str(ex)
+                job.state = 'failed'
+                raise
+            finally:
+                job.phase = 'done'
+                job.finished = time.time()
+                job.save()
+
+    def __forget_finished(self):
+        finished = [job_id for job_id, job in self.__jobs.items() if job.finished is not None]
+        for job_id in finished[:max(0, len(finished) - self.__max_finished)]:
+            del self.__jobs[job_id]
+            with self.__save_lock:
+                if self.__jobs_dir is not None and os.path.exists(self.__job_path(job_id)):
+                    os.remove(self.__job_path(job_id))
+
+    def get(self, job_id):
+        with self.__jobs_lock:
+            return self.__jobs.get(job_id)
+
+    def list(self):
+        with self.__jobs_lock:
+            return list(self.__jobs.values())
@@ -1,6 +1,10 @@
+import json
+import os
+import time
 from subprocess import check_output, PIPE, Popen, STDOUT
 
-from pkgpanda.util import resources_test_dir
+from pkgpanda.cli import execute_checks, OrderedOutput, run_check
+from pkgpanda.util import resources_test_dir, write_string
 
 list_output = """WARNING: `not_executable.py` is not executable
 pkg1--12345
@@ -40,3 +44,82 @@ def test_check_target_run():
     stdout, stderr = cmd.communicate()
     assert stdout.decode() == run_output_stdout
     assert stderr.decode() == run_output_stderr
+
+
+def test_check_target_run_json():
+    cmd = Popen([
+        'pkgpanda',
+        'check',
+        '--json',
+        '--root', resources_test_dir('opt/mesosphere'),
+        '--repository', resources_test_dir('opt/mesosphere/packages')],
+        stdout=PIPE, stderr=PIPE)
+    stdout, stderr = cmd.communicate()
+    assert cmd.returncode == 0
+    results = json.loads(stdout.decode())
+    assert results['status'] == 0
+    assert [(check['package'], check['check'], check['status']) for check in results['checks']] == [
+        ('pkg1--12345', 'hello_world_ok.py', 'ok'),
+        ('pkg2--12345', 'failed_check.py', 'ok'),
+        ('pkg2--12345', 'shell_script_check.sh', 'ok')]
+    assert results['checks'][0]['stdout'] == 'Hello World\n'
+    assert all(check['duration'] >= 0 for check in results['checks'])
+
+
+def make_check(tmpdir, name, contents):
+    path = str(tmpdir.join(name))
+    write_string(path, contents)
+    os.chmod(path, 0o755)
+    return path
+
+
+def test_run_check(tmpdir):
+    result = run_check(make_check(tmpdir, 'fail', '#!/bin/sh\necho broken >&2\nexit 3\n'), 10)
+    assert result['status'] == 'failed'
+    assert result['returncode'] == 3
+    assert result['stderr'] == 'broken\n'
+
+    assert run_check(str(tmpdir.join('missing')), 10)['status'] == 'error'
+
+
+def test_run_check_timeout(tmpdir):
+    # The sleep holds the output pipes open, so it must be killed along with the check itself.
+    path = make_check(tmpdir, 'hang', '#!/bin/sh\necho started\nsleep 60 &\nsleep 60\n')
+    start = time.monotonic()
+    result = run_check(path, 0.5)
+    assert time.monotonic() - start < 10
+    assert result['status'] == 'timeout'
+    assert result['stdout'] == 'started\n'
+
+
+def test_run_check_streams_output(tmpdir):
+    # The check only exits once its first line of output has been seen.
+    seen = str(tmpdir.join('seen'))
+    path = make_check(tmpdir, 'wait', '#!/bin/sh\necho started\nwhile [ ! -e {} ]; do sleep 0.1; done\n'.format(seen))
+
+    def on_output(name, data):
+        assert (name, data) == ('stdout', b'started\n')
+        write_string(seen, '')
+
+    result = run_check(path, 10, on_output)
+    assert result['status'] == 'ok'
+    assert result['stdout'] == 'started\n'
+
+
+def test_execute_checks_output_ordered(tmpdir, capfd):
+    class Package:
+        check_dir = str(tmpdir)
+
+    class FakeRepository:
+        def load(self, pkg_id):
+            return Package()
+
+    # The slow check comes first so the fast check's output has to be held back.
+    make_check(tmpdir, 'a_slow', '#!/bin/sh\necho slow\nsleep 1\necho done\nexit 1\n')
+    make_check(tmpdir, 'b_fast', '#!/bin/sh\necho fast\necho warning >&2\n')
+    checks = {'pkg--1': ['a_slow', 'b_fast']}
+    results = execute_checks(checks, FakeRepository(), jobs=2, output=OrderedOutput(2))
+    assert [result['status'] for result in results] == ['failed', 'ok']
+    stdout, stderr = capfd.readouterr()
+    assert stdout == 'slow\ndone\nCheck failed: a_slow\nfast\n'
+    assert stderr == 'warning\n'
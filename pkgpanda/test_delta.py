@@ -0,0 +1,120 @@
+"""Test building and applying package deltas"""
+import os
+import shutil
+import tarfile
+
+import pytest
+
+from pkgpanda import Repository
+from pkgpanda.delta import apply_delta, delta_filename, hash_tree, make_delta
+from pkgpanda.exceptions import FetchError, ValidationError
+from pkgpanda.util import write_string
+
+
+def make_package(path, files, links=None):
+    for name, contents in files.items():
+        full_path = os.path.join(path, name)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        write_string(full_path, contents)
+    for name, target in (links or {}).items():
+        os.symlink(target, os.path.join(path, name))
+
+
+@pytest.fixture
+def packages(tmpdir):
+    base = str(tmpdir.join('foo--1'))
+    target = str(tmpdir.join('foo--2'))
+    make_package(base, {
+        'pkginfo.json': '{}',
+        'bin/foo': 'foo v1',
+        'lib/unchanged': 'same',
+        'lib/removed': 'gone',
+        'lib/becomes_dir': 'file',
+        'share/removed/readme': 'gone too'
+    }, {'bin/bar': 'foo'})
+    make_package(target, {
+        'pkginfo.json': '{}',
+        'bin/foo': 'foo v2',
+        'lib/unchanged': 'same',
+        'lib/added': 'new',
+        'lib/becomes_dir/file': 'now a dir'
+    }, {'bin/bar': 'baz'})
+    os.chmod(os.path.join(target, 'bin/foo'), 0o755)
+    return base, target
+
+
+def test_delta_filename():
+    assert delta_filename('foo--1', 'foo--2') == 'packages/foo/foo--2.delta-from-1.tar.xz'
+    with pytest.raises(ValidationError):
+        delta_filename('foo--1', 'bar--2')
+
+
+def test_make_apply_delta(packages, tmpdir):
+    base, target = packages
+    delta = str(tmpdir.join('delta.tar.xz'))
+    make_delta('foo--1', base, 'foo--2', target, delta)
+
+    # Only what changed is in the delta.
+    with tarfile.open(delta) as tar:
+        names = set(tar.getnames())
+    assert 'files/lib/unchanged' not in names
+    assert 'files/bin/foo' in names
+
+    result = str(tmpdir.join('result'))
+    apply_delta('foo--1', base, 'foo--2', delta, result)
+    assert hash_tree(result) == hash_tree(target)
+    assert os.readlink(os.path.join(result, 'bin/bar')) == 'baz'
+    assert not os.path.exists(os.path.join(result, 'share/removed'))
+
+
+def test_apply_delta_bad(packages, tmpdir):
+    base, target = packages
+    delta = str(tmpdir.join('delta.tar.xz'))
+    make_delta('foo--1', base, 'foo--2', target, delta)
+    result = str(tmpdir.join('result'))
+
+    with pytest.raises(ValidationError):
+        apply_delta('foo--0', base, 'foo--2', delta, result)
+    assert not os.path.exists(result)
+
+    # A base which differs from the one the delta was made against gives the
+    # wrong package, which must be thrown away.
+    write_string(os.path.join(base, 'lib/unchanged'), 'modified')
+    with pytest.raises(ValidationError):
+        apply_delta('foo--1', base, 'foo--2', delta, result)
+    assert not os.path.exists(result)
+
+
+def test_repository_add_delta(packages, tmpdir):
+    base, target = packages
+    repository = Repository(str(tmpdir.join('repository')))
+    os.makedirs(repository.path)
+    shutil.copytree(base, repository.package_path('foo--1'), symlinks=True)
+
+    delta = str(tmpdir.join('delta.tar.xz'))
+    make_delta('foo--1', base, 'foo--2', target, delta)
+
+    def delta_fetcher(base_id, base_dir, id, target):
+        apply_delta(base_id, base_dir, id, delta, target)
+
+    def fetcher(id, target):
+        raise AssertionError("The full package shouldn't be fetched")
+
+    assert repository.add(fetcher, 'foo--2', delta_fetcher=delta_fetcher)
+    assert hash_tree(repository.package_path('foo--2')) == hash_tree(target)
+
+
+def test_repository_add_delta_fallback(packages, tmpdir):
+    base, target = packages
+    repository = Repository(str(tmpdir.join('repository')))
+    os.makedirs(repository.path)
+    shutil.copytree(base, repository.package_path('foo--1'), symlinks=True)
+
+    def delta_fetcher(base_id, base_dir, id, target):
+        raise FetchError(id, target, Exception("Not found"), False)
+
+    def fetcher(id, target):
+        shutil.copytree(packages[1], target, symlinks=True)
+
+    assert repository.add(fetcher, 'foo--2', delta_fetcher=delta_fetcher)
+    assert hash_tree(repository.package_path('foo--2')) == hash_tree(target)
@@ -1,4 +1,16 @@
-from pkgpanda.util import expect_fs, resources_test_dir, run
+import http.server
+import os
+import socketserver
+import threading
+import time
+from subprocess import check_call
+
+import pytest
+
+import pkgpanda.util
+from pkgpanda import requests_fetcher
+from pkgpanda.exceptions import FetchError
+from pkgpanda.util import expect_fs, rank_by_latency, resources_test_dir, run, sha1, stream_chunk_size
 
 fetch_output = """\rFetching: mesos--0.22.0\rFetched: mesos--0.22.0\n"""
 
@@ -22,6 +34,24 @@ def test_fetch(tmpdir):
         {
             "mesos--0.22.0": ["lib", "bin_master", "bin_slave", "pkginfo.json", "bin"]
         })
+
+    # Nodes configured to serve peers keep the tarball to serve.
+    repository = tmpdir.join('repository')
+    tmpdir.join('config', 'setup-flags', 'keep-package-tarballs').ensure()
+    run([
+        "pkgpanda",
+        "fetch",
+        "mesos--0.22.0",
+        "--repository={0}".format(repository),
+        "--config-dir={0}".format(tmpdir.join('config')),
+        "--repository-url=file://{}/".format(resources_test_dir('remote_repo'))
+    ])
+    expect_fs(
+        str(repository),
+        {
+            "mesos--0.22.0": ["lib", "bin_master", "bin_slave", "pkginfo.json", "bin"],
+            ".tarballs": ["mesos--0.22.0.tar.xz"]
+        })
     # TODO(cmaloney): Test multiple fetches on one line.
     # TODO(cmaloney): Test unable to fetch case.
 
@@ -41,3 +71,183 @@ def test_add(tmpdir):
             "mesos--0.22.0": ["lib", "bin_master", "bin_slave", "pkginfo.json", "bin"]
         })
     # TODO(branden): Test unable to add case.
+
+
+def test_requests_fetcher_sha1(tmpdir):
+    repo_url = "file://{}/".format(resources_test_dir('remote_repo'))
+    tarball_sha1 = sha1(resources_test_dir('remote_repo/packages/mesos/mesos--0.22.0.tar.xz'))
+
+    target = str(tmpdir.join('good'))
+    requests_fetcher(repo_url, 'mesos--0.22.0', target, os.getcwd(), tarball_sha1)
+    expect_fs(target, ["lib", "bin_master", "bin_slave", "pkginfo.json", "bin"])
+
+    # A mismatched sha1 fails the fetch and leaves nothing behind.
+    target = str(tmpdir.join('bad'))
+    with pytest.raises(FetchError):
+        requests_fetcher(repo_url, 'mesos--0.22.0', target, os.getcwd(), '0' * 40)
+    assert not os.path.exists(target)
+
+
+class RepoRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the files under server.root, optionally honoring range requests.
+
+    Stands in for a package mirror or a peer node in tests.
+    """
+
+    def do_HEAD(self):  # noqa: N802
+        time.sleep(self.server.delay)
+        self.send_response(200)
+        self.end_headers()
+
+    def do_GET(self):  # noqa: N802
+        self.server.requests.append((self.path, self.headers.get('Range')))
+        path = os.path.join(self.server.root, self.path.lstrip('/'))
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        with open(path, 'rb') as f:
+            body = f.read()
+
+        start = 0
+        range_header = self.headers.get('Range')
+        if range_header and self.server.ranges:
+            start = int(range_header[len('bytes='):].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(body) - 1, len(body)))
+        else:
+            self.send_response(200)
+        body = body[start:]
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        # Simulate the connection dropping part way through, for the first
+        # truncate_times responses or every response if it is None.
+        if self.server.truncate_times is None or self.server.truncate_times > 0:
+            if self.server.truncate_times is not None:
+                self.server.truncate_times -= 1
+            body = body[:self.server.truncate_at]
+        self.wfile.write(body)
+        # Then hold the connection open without sending anything.
+        time.sleep(self.server.stall)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def repo_server():
+    servers = []
+
+    def start(
+            root=resources_test_dir('remote_repo'), ranges=True, truncate_at=None, truncate_times=None, delay=0,
+            stall=0):
+        server = socketserver.TCPServer(('127.0.0.1', 0), RepoRequestHandler)
+        server.root = root
+        server.ranges = ranges
+        server.truncate_at = truncate_at
+        server.truncate_times = truncate_times
+        server.delay = delay
+        server.stall = stall
+        server.requests = []
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server, 'http://127.0.0.1:{}/'.format(server.server_address[1])
+
+    yield start
+
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_requests_fetcher_fallback(tmpdir, repo_server):
+    _, empty_url = repo_server(root=str(tmpdir.join('empty')))
+    _, good_url = repo_server()
+
+    target = str(tmpdir.join('target'))
+    requests_fetcher(['http://127.0.0.1:1/', empty_url, good_url], 'mesos--0.22.0', target, os.getcwd())
+    expect_fs(target, ["lib", "bin_master", "bin_slave", "pkginfo.json", "bin"])
+
+    # Every mirror failing fails the fetch.
+    target = str(tmpdir.join('failed'))
+    with pytest.raises(FetchError):
+        requests_fetcher(['http://127.0.0.1:1/', empty_url], 'mesos--0.22.0', target, os.getcwd())
+    assert not os.path.exists(target)
+
+
+@pytest.fixture
+def big_repo(tmpdir):
+    """A repository with a package foo--1 whose tarball is several download chunks long."""
+    package = tmpdir.join('foo--1').ensure(dir=True)
+    package.join('pkginfo.json').write('{}')
+    package.join('data').write_binary(os.urandom(3 * stream_chunk_size))
+    repo = tmpdir.join('big_repo')
+    tarball = repo.join('packages', 'foo', 'foo--1.tar.xz')
+    tarball.dirpath().ensure(dir=True)
+    check_call(['tar', '-cJf', str(tarball), '-C', str(package), '.'])
+    return str(repo), str(tarball)
+
+
+def test_requests_fetcher_resume(tmpdir, repo_server, big_repo):
+    root, tarball = big_repo
+    path = '/packages/foo/foo--1.tar.xz'
+
+    # Cut off right after the first whole chunk, which the client sees before
+    # the connection drops.
+    resuming_server, resuming_url = repo_server(root=root, truncate_at=stream_chunk_size, truncate_times=1)
+    target = str(tmpdir.join('target'))
+    kept = str(tmpdir.join('kept', 'foo--1.tar.xz'))
+    requests_fetcher(resuming_url, 'foo--1', target, os.getcwd(), sha1(tarball), tarball=kept)
+    expect_fs(target, ['pkginfo.json', 'data'])
+    # The retry only had to send the rest of the tarball.
+    assert resuming_server.requests == [(path, None), (path, 'bytes={}-'.format(stream_chunk_size))]
+    # The tarball is kept byte for byte.
+    assert sha1(kept) == sha1(tarball)
+
+    # A source which can't resume restarts the download from scratch.
+    no_ranges_server, no_ranges_url = repo_server(
+        root=root, ranges=False, truncate_at=stream_chunk_size, truncate_times=1)
+    target = str(tmpdir.join('restarted'))
+    requests_fetcher(no_ranges_url, 'foo--1', target, os.getcwd(), sha1(tarball))
+    expect_fs(target, ['pkginfo.json', 'data'])
+    assert no_ranges_server.requests == [(path, None), (path, 'bytes={}-'.format(stream_chunk_size))]
+
+    # The next source's tarball may not be the same, so it is never resumed from.
+    _, truncated_url = repo_server(root=root, ranges=False, truncate_at=stream_chunk_size)
+    next_server, next_url = repo_server(root=root)
+    target = str(tmpdir.join('next'))
+    requests_fetcher([truncated_url, next_url], 'foo--1', target, os.getcwd(), sha1(tarball))
+    expect_fs(target, ['pkginfo.json', 'data'])
+    assert next_server.requests == [(path, None)]
+
+    # A source which keeps breaking off fails once it has been retried resume_attempts times.
+    target = str(tmpdir.join('failed'))
+    kept = str(tmpdir.join('failed.tar.xz'))
+    with pytest.raises(FetchError):
+        requests_fetcher(truncated_url, 'foo--1', target, os.getcwd(), tarball=kept)
+    assert not os.path.exists(target)
+    assert not os.path.exists(kept)
+    assert not os.path.exists(kept + '.tmp')
+
+
+def test_requests_fetcher_stalled(tmpdir, repo_server, big_repo, monkeypatch):
+    monkeypatch.setattr(pkgpanda.util, 'fetch_timeout', (1, 0.5))
+    root, tarball = big_repo
+    path = '/packages/foo/foo--1.tar.xz'
+
+    # A source which stops sending part way through is given up on rather
+    # than waited on or retried, and the next source is used.
+    stalled_server, stalled_url = repo_server(root=root, truncate_at=stream_chunk_size, stall=2)
+    next_server, next_url = repo_server(root=root)
+    target = str(tmpdir.join('target'))
+    requests_fetcher([stalled_url, next_url], 'foo--1', target, os.getcwd(), sha1(tarball))
+    expect_fs(target, ['pkginfo.json', 'data'])
+    assert stalled_server.requests == [(path, None)]
+    assert next_server.requests == [(path, None)]
+
+
+def test_rank_by_latency(repo_server):
+    _, slow_url = repo_server(delay=0.2)
+    _, fast_url = repo_server()
+    unreachable_url = 'http://127.0.0.1:1/'
+
+    assert rank_by_latency([unreachable_url, slow_url, fast_url]) == [fast_url, slow_url, unreachable_url]
@@ -1,10 +1,13 @@
 import json
 import operator
 import os
-from shutil import copytree
+import time
+from shutil import copyfile, copytree
 
+import pkgpanda.http
 from pkgpanda.http import app
-from pkgpanda.util import resources_test_dir
+from pkgpanda.http.jobs import Job, JobManager
+from pkgpanda.util import extract_tarball, resources_test_dir, write_json
 
 
 def assert_response(response, status_code, body, headers=None, body_cmp=operator.eq):
@@ -81,6 +84,7 @@ def _set_test_config(app):
     app.config['TESTING'] = True
     app.config['DCOS_ROOT'] = resources_test_dir('install')
     app.config['DCOS_REPO_DIR'] = resources_test_dir('packages')
+    app.config['JOBS_DIR'] = None
 
 
 def test_list_packages():
@@ -267,3 +271,198 @@ def test_remove_package(tmpdir):
     # Attempted deletion of nonexistent package.
     assert_error(client.delete('/repository/nonexistent-package--fakeversion'), 404)
     assert_error(client.delete('/repository/invalid---package'), 404)
+
+
+def test_get_package_tarball(tmpdir):
+    _set_test_config(app)
+    repo_dir = str(tmpdir.join('repo'))
+    copytree(resources_test_dir('packages'), repo_dir)
+    app.config['DCOS_REPO_DIR'] = repo_dir
+    source = resources_test_dir('remote_repo/packages/mesos/mesos--0.22.0.tar.xz')
+    os.makedirs(os.path.join(repo_dir, '.tarballs'))
+    copyfile(source, os.path.join(repo_dir, '.tarballs', 'mesos--0.22.0.tar.xz'))
+    with open(source, 'rb') as f:
+        source_data = f.read()
+    client = app.test_client()
+
+    # The tarball the package was fetched from is served as is.
+    response = client.get('/packages/mesos/mesos--0.22.0.tar.xz')
+    assert response.status_code == 200
+    assert response.data == source_data
+    assert response.headers['Content-Length'] == str(len(source_data))
+    tarball = tmpdir.join('mesos--0.22.0.tar.xz')
+    tarball.write(response.data, 'wb')
+    extract_tarball(str(tarball), str(tmpdir.join('mesos--0.22.0')))
+    assert os.path.exists(str(tmpdir.join('mesos--0.22.0', 'pkginfo.json')))
+
+    response = client.get('/packages/mesos/mesos--0.22.0.tar.xz', headers={'Range': 'bytes=100-'})
+    assert response.status_code == 206
+    assert response.data == source_data[100:]
+
+    # Packages without a tarball can't be served.
+    assert_error(client.get('/packages/mesos/mesos--0.23.0.tar.xz'), 404)
+    assert_error(client.get('/packages/mesos/mesos--0.21.0.tar.xz'), 404)
+    assert_error(client.get('/packages/other/mesos--0.22.0.tar.xz'), 404)
+    assert_error(client.get('/packages/mesos/invalid---package.tar.xz'), 404)
+
+
+def test_etag(tmpdir):
+    _set_test_config(app)
+    repo_dir = str(tmpdir.join('repo'))
+    copytree(resources_test_dir('packages'), repo_dir)
+    app.config['DCOS_REPO_DIR'] = repo_dir
+    client = app.test_client()
+
+    response = client.get('/repository/')
+    etag = response.headers['ETag']
+    assert etag
+
+    # Nothing changed, so nothing is sent.
+    response = client.get('/repository/', headers={'If-None-Match': etag})
+    assert_response(response, 304, b'')
+
+    # Changes made on disk invalidate the cached state.
+    os.rename(os.path.join(repo_dir, 'mesos--0.23.0'), os.path.join(repo_dir, 'mesos--0.24.0'))
+    response = client.get('/repository/', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert 'mesos--0.24.0' in json.loads(response.data.decode('utf-8'))
+    assert response.headers['ETag'] != etag
+
+    etag = client.get('/active/').headers['ETag']
+    assert_response(client.get('/active/', headers={'If-None-Match': etag}), 304, b'')
+
+
+def wait_for_job(client, location):
+    for _ in range(100):
+        job = json.loads(client.get(location).data.decode('utf-8'))
+        if job['state'] in ('succeeded', 'failed'):
+            return job
+        time.sleep(0.1)
+    raise AssertionError('Job {} did not finish'.format(location))
+
+
+def test_fetch_package_async(tmpdir):
+    _set_test_config(app)
+    client = app.test_client()
+    app.config['DCOS_REPO_DIR'] = str(tmpdir)
+    repository_url = 'file://{}/{}/'.format(os.getcwd(), resources_test_dir('remote_repo'))
+
+    response = client.post(
+        '/repository/mesos--0.22.0',
+        content_type='application/json',
+        headers={'Prefer': 'respond-async'},
+        data=json.dumps({'repository_url': repository_url}))
+    assert response.status_code == 202
+    job = json.loads(response.data.decode('utf-8'))
+    assert job['operation'] == 'fetch'
+    assert job['packages'] == ['mesos--0.22.0']
+    assert response.headers['Location'].endswith('/jobs/' + job['id'])
+
+    job = wait_for_job(client, response.headers['Location'])
+    assert job['state'] == 'succeeded'
+    assert job['progress']['bytes_downloaded'] > 0
+    assert job['progress']['packages_extracted'] == 1
+    assert_json_response(client.get('/repository/'), 200, ['mesos--0.22.0'])
+
+    # Failures are reported through the job.
+    response = client.post(
+        '/repository/mesos--0.23.0',
+        content_type='application/json',
+        headers={'Prefer': 'respond-async'},
+        data=json.dumps({'repository_url': repository_url}))
+    job = wait_for_job(client, response.headers['Location'])
+    assert job['state'] == 'failed'
+    assert job['error']
+
+    assert job['id'] in [job['id'] for job in json.loads(client.get('/jobs/').data.decode('utf-8'))]
+    assert_error(client.get('/jobs/nonexistent'), 404)
+
+
+def test_activate_packages_async(tmpdir):
+    _set_test_config(app)
+    install_dir = str(tmpdir.join('install'))
+    copytree(resources_test_dir('install'), install_dir, symlinks=True)
+    app.config['DCOS_ROOT'] = install_dir
+    app.config['DCOS_ROOTED_SYSTEMD'] = True
+    client = app.test_client()
+
+    new_packages = [
+        'mesos--0.23.0',
+        'mesos-config--ffddcfb53168d42f92e4771c6f8a8a9a818fd6b8',
+    ]
+    response = client.put(
+        '/active/',
+        content_type='application/json',
+        headers={'Prefer': 'respond-async'},
+        data=json.dumps(new_packages))
+    assert response.status_code == 202
+    job = wait_for_job(client, response.headers['Location'])
+    assert job['state'] == 'succeeded'
+    assert job['operation'] == 'activate'
+    assert_json_response(client.get('/active/'), 200, new_packages)
+
+
+def test_jobs_survive_restart(tmpdir, monkeypatch):
+    _set_test_config(app)
+    jobs_dir = tmpdir.join('jobs')
+    app.config['JOBS_DIR'] = str(jobs_dir)
+    app.config['DCOS_REPO_DIR'] = str(tmpdir.join('repository').ensure(dir=True))
+    client = app.test_client()
+    repository_url = 'file://{}/{}/'.format(os.getcwd(), resources_test_dir('remote_repo'))
+
+    response = client.post(
+        '/repository/mesos--0.22.0',
+        content_type='application/json',
+        headers={'Prefer': 'respond-async'},
+        data=json.dumps({'repository_url': repository_url}))
+    fetched = wait_for_job(client, response.headers['Location'])
+
+    # Activating restarts the API while the job is running, and a queued job never gets to run.
+    activation = Job('activate', ['mesos--0.22.0', 'mesos-config--ffddcfb53168d42f92e4771c6f8a8a9a818fd6b8'])
+    activation.state = 'running'
+    queued = Job('fetch', ['mesos--0.23.0'])
+    for job in [activation, queued]:
+        write_json(str(jobs_dir.join(job.id + '.json')), job.to_json())
+    monkeypatch.setattr(pkgpanda.http, 'jobs', JobManager())
+
+    assert json.loads(client.get(response.headers['Location']).data.decode('utf-8')) == fetched
+    job = json.loads(client.get('/jobs/' + activation.id).data.decode('utf-8'))
+    assert (job['state'], job['phase']) == ('succeeded', 'done')
+    job = json.loads(client.get('/jobs/' + queued.id).data.decode('utf-8'))
+    assert (job['state'], job['phase']) == ('failed', 'done')
+    assert job['error']
+
+
+def test_fetch_packages(tmpdir, capsys):
+    _set_test_config(app)
+    client = app.test_client()
+    app.config['DCOS_REPO_DIR'] = str(tmpdir)
+    repository_url = 'file://{}/{}/'.format(os.getcwd(), resources_test_dir('remote_repo'))
+
+    def fetch_packages(package_ids, **kwargs):
+        return client.post(
+            '/repository/',
+            content_type='application/json',
+            data=json.dumps({'repository_url': repository_url, 'package_ids': package_ids}),
+            **kwargs)
+
+    response = fetch_packages(['mesos--0.22.0', 'mesos--0.23.0'])
+    assert response.status_code == 200
+    results = json.loads(response.data.decode('utf-8'))
+    assert results['mesos--0.22.0'] == {'status': 'fetched'}
+    assert results['mesos--0.23.0']['status'] == 'failed'
+    assert results['mesos--0.23.0']['error']
+    assert_json_response(client.get('/repository/'), 200, ['mesos--0.22.0'])
+    # Packages fetched at once don't write over each other's progress on stdout.
+    assert 'Fetch' not in capsys.readouterr()[0]
+
+    # Already fetched packages are reported as present.
+    response = fetch_packages(['mesos--0.22.0'], headers={'Prefer': 'respond-async'})
+    assert response.status_code == 202
+    job = wait_for_job(client, response.headers['Location'])
+    assert job['result'] == {'mesos--0.22.0': {'status': 'present'}}
+
+    assert_error(fetch_packages(['invalid---package']), 400, invalid_package_ids=['invalid---package'])
+    assert_error(
+        client.post('/repository/', content_type='application/json', data=json.dumps({'package_ids': []})),
+        400)
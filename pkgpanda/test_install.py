@@ -90,3 +90,15 @@ def test_recovery_move_new(tmpdir):
             "include": [".gitignore"],
             "lib": ["libmesos.so"]
         })
+
+
+def test_activate_same_set_ensures_users(tmpdir, repository, monkeypatch):
+    install = Install(str(tmpdir.join("install")), resources_test_dir("systemd"), True, False, True)
+    packages = repository.load_packages(['mesos--0.22.0', 'mesos-config--ffddcfb53168d42f92e4771c6f8a8a9a818fd6b8'])
+    assert install.activate(packages) is not False
+
+    # Users and state directories are still checked when nothing else needs doing.
+    ensured = []
+    monkeypatch.setattr(Install, '_ensure_users_and_state_dirs', lambda self, packages: ensured.append(packages))
+    assert install.activate(packages) is False
+    assert ensured == [packages]
@@ -1,11 +1,14 @@
 """Test functionality of the local package repository"""
 
+import os
+import shutil
+
 import pytest
 
 import pkgpanda.exceptions
 from pkgpanda import Repository
 
-from pkgpanda.util import resources_test_dir
+from pkgpanda.util import resources_test_dir, write_json
 
 
 @pytest.fixture
@@ -30,3 +33,36 @@ def test_load_bad(repository):
 def test_load_nonexistant(repository):
     with pytest.raises(pkgpanda.exceptions.PackageError):
         repository.load_packages(["missing-package--42"])
+
+
+def test_get_ids(repository):
+    assert sorted(repository.get_ids('mesos')) == ['mesos--0.22.0', 'mesos--0.23.0']
+    assert repository.get_ids('missing') == []
+
+
+def test_load_cached(repository):
+    package = repository.load('mesos--0.22.0')
+    assert repository.load('mesos--0.22.0') is package
+
+
+def test_index_tracks_changes(tmpdir):
+    repository = Repository(str(tmpdir))
+    assert repository.list() == set()
+
+    def fetcher(id, target):
+        os.makedirs(target)
+        write_json(os.path.join(target, 'pkginfo.json'), {})
+
+    repository.add(fetcher, 'foo--1')
+    assert repository.list() == {'foo--1'}
+    assert repository.get_ids('foo') == ['foo--1']
+    assert repository.load('foo--1').name == 'foo'
+
+    # Changes made on disk behind the repository's back are picked up too.
+    shutil.copytree(str(tmpdir.join('foo--1')), str(tmpdir.join('foo--2')))
+    assert sorted(repository.get_ids('foo')) == ['foo--1', 'foo--2']
+
+    repository.remove('foo--1')
+    assert repository.list() == {'foo--2'}
+    with pytest.raises(pkgpanda.exceptions.PackageNotFound):
+        repository.load('foo--1')
@@ -72,7 +72,23 @@ def test_setup(tmpdir):
 
     assert active == {"env--setup", "mesos--0.22.0", "mesos-config--ffddcfb53168d42f92e4771c6f8a8a9a818fd6b8"}
     tmpdir.join("root", "bootstrap").write("", ensure=True)
-    # If we setup the same directory again we should get .old files.
+    # If we setup the same directory again with the same packages and config
+    # nothing changes.
+    check_call(["pkgpanda",
+                "setup",
+                "--root={0}/root".format(tmpdir),
+                "--rooted-systemd",
+                "--repository={}".format(repo_path),
+                "--config-dir={}".format(resources_test_dir("etc-active")),
+                "--no-systemd"
+                ])
+    assert not tmpdir.join("root", "active.old").check()
+    assert not tmpdir.join("root", "environment.old").check()
+
+    # If what is active doesn't match what would be generated we should get
+    # .old files.
+    tmpdir.join("root", "bootstrap").write("", ensure=True)
+    tmpdir.join("root", "environment").write("")
     check_call(["pkgpanda",
                 "setup",
                 "--root={0}/root".format(tmpdir),
@@ -184,6 +200,17 @@ def test_activate(tmpdir):
 
     assert active == {"mesos--0.22.0", "mesos-config--ffddcfb53168d42f92e4771c6f8a8a9a818fd6b8"}
 
+    # Activating the same packages again is a no-op.
+    assert run(["pkgpanda",
+                "activate",
+                "mesos--0.22.0",
+                "mesos-config--ffddcfb53168d42f92e4771c6f8a8a9a818fd6b8",
+                "--root={0}/root".format(tmpdir),
+                "--rooted-systemd",
+                "--repository={}".format(repo_path),
+                "--config-dir=../resources/etc-active",
+                "--no-systemd"]) == "Packages are already active with the same configuration, nothing to do.\n"
+
     # Swap out one package
     assert run(["pkgpanda",
                 "swap",
@@ -1,5 +1,10 @@
+import grp
+import os
+import pwd
+
 import pytest
 
+import pkgpanda
 import pkgpanda.util
 from pkgpanda import UserManagement
 from pkgpanda.exceptions import ValidationError
@@ -50,3 +55,131 @@ def test_validate_group():
 
     with pytest.raises(ValidationError):
         UserManagement.validate_group('group-should-not-exist')
+
+
+class FakeUserDatabase:
+    """Stands in for pwd / grp, counting how often the whole database is read."""
+
+    def __init__(self):
+        self.users = {'dcos_exists': pwd.struct_passwd(('dcos_exists', 'x', 900, 900, '', '/', '/sbin/nologin'))}
+        self.groups = {'dcos_group': grp.struct_group(('dcos_group', 'x', 900, []))}
+        self.reads = 0
+        self.added = []
+
+    def getpwall(self):
+        self.reads += 1
+        return list(self.users.values())
+
+    def getgrall(self):
+        return list(self.groups.values())
+
+    def getpwnam(self, name):
+        return self.users[name]
+
+    def getgrnam(self, name):
+        return self.groups[name]
+
+    def check_output(self, cmd):
+        assert cmd[0] == 'useradd'
+        username = cmd[-1]
+        self.added.append(username)
+        uid = 1000 + len(self.added)
+        self.users[username] = pwd.struct_passwd((username, 'x', uid, uid, '', '/', '/sbin/nologin'))
+
+
+@pytest.fixture
+def user_database(monkeypatch):
+    database = FakeUserDatabase()
+    for name in ['getpwall', 'getpwnam']:
+        monkeypatch.setattr(pkgpanda.pwd, name, getattr(database, name))
+    for name in ['getgrall', 'getgrnam']:
+        monkeypatch.setattr(pkgpanda.grp, name, getattr(database, name))
+    monkeypatch.setattr(pkgpanda, 'check_output', database.check_output)
+    return database
+
+
+def test_ensure_users_exist(user_database):
+    users = UserManagement(manage_users=True, add_users=True)
+    users.add_user('dcos_exists', 'dcos_group')
+    users.add_user('dcos_new_a', None)
+    users.add_user('dcos_new_b', 'dcos_group')
+    users.add_user('dcos_new_a', None)
+    users.ensure_users_exist()
+
+    assert user_database.added == ['dcos_new_a', 'dcos_new_b']
+    # Once to check the users, once more to get the uids of the added users.
+    assert user_database.reads == 2
+    assert users.get_uid('dcos_exists') == 900
+    assert users.get_uid('dcos_new_b') == 1002
+
+
+def test_ensure_users_exist_no_changes(user_database):
+    users = UserManagement(manage_users=True, add_users=True)
+    users.add_user('dcos_exists', None)
+    users.ensure_users_exist()
+    assert user_database.added == []
+    assert user_database.reads == 1
+
+
+def test_ensure_users_exist_errors(user_database):
+    users = UserManagement(manage_users=True, add_users=False)
+    users.add_user('dcos_missing', None)
+    with pytest.raises(ValidationError):
+        users.ensure_users_exist()
+
+    users = UserManagement(manage_users=True, add_users=True)
+    users.add_user('dcos_missing', 'group-should-not-exist')
+    with pytest.raises(ValidationError):
+        users.ensure_users_exist()
+    assert user_database.added == []
+
+    users = UserManagement(manage_users=True, add_users=True)
+    users.add_user('dcos_exists', None)
+    with pytest.raises(ValidationError):
+        users.add_user('dcos_exists', 'dcos_group')
+
+
+def test_chown_tree(tmpdir, monkeypatch):
+    tmpdir.join('a/b').ensure(dir=True)
+    tmpdir.join('a/b/file').write('contents')
+    tmpdir.join('a/file').write('contents')
+    tmpdir.join('a/link').mksymlinkto('/does-not-exist')
+    root = str(tmpdir.join('a'))
+
+    chowned = []
+    monkeypatch.setattr(pkgpanda.util.os, 'chown', lambda path, uid, gid, follow_symlinks: chowned.append(path))
+
+    # Everything is already owned by us so nothing changes.
+    assert pkgpanda.util.chown_tree(root, os.getuid()) == 0
+    assert chowned == []
+
+    assert pkgpanda.util.chown_tree(root, os.getuid() + 1) == 5
+    assert sorted(chowned) == [root, root + '/b', root + '/b/file', root + '/file', root + '/link']
+
+
+def test_fix_state_dir_owner(tmpdir, monkeypatch):
+    walked = []
+    monkeypatch.setattr(pkgpanda, 'chown_tree', lambda path, uid: walked.append(path))
+    path = str(tmpdir)
+    uid = os.getuid()
+    tmpdir.join('sub', 'file').ensure()
+
+    record = pkgpanda.fix_state_dir_owner(path, uid, 'pkg--1', None)
+    assert walked == [path]
+
+    # Already fixed up, so not walked again.
+    assert pkgpanda.fix_state_dir_owner(path, uid, 'pkg--1', record) == record
+    assert walked == [path]
+
+    # The owner changing means the whole tree needs fixing again.
+    pkgpanda.fix_state_dir_owner(path, uid + 1, 'pkg--1', record)
+    assert walked == [path, path]
+
+    # As does the package being upgraded.
+    pkgpanda.fix_state_dir_owner(path, uid, 'pkg--2', record)
+    assert walked == [path, path, path]
+
+    # Or something at the top of the state directory changing.
+    tmpdir.join('new').ensure()
+    pkgpanda.fix_state_dir_owner(path, uid, 'pkg--1', record)
+    assert walked == [path, path, path, path]
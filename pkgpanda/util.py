@@ -6,6 +6,7 @@ import re
 import shutil
 import socketserver
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager, ExitStack
 from itertools import chain
 from multiprocessing import Process
@@ -15,6 +16,7 @@ from subprocess import check_call
 import requests
 import teamcity
 import yaml
+from requests.packages.urllib3.exceptions import ReadTimeoutError
 from teamcity.messages import TeamcityServiceMessages
 
 from pkgpanda.exceptions import FetchError, ValidationError
@@ -48,6 +50,11 @@ def variant_prefix(variant):
     return variant + '.'
 
 
+# Seconds to wait for a connection to a package source, and for the next
+# data on it, before giving up on it.
+fetch_timeout = (10, 60)
+
+
 def download(out_filename, url, work_dir):
     assert os.path.isabs(out_filename)
     assert os.path.isabs(work_dir)
@@ -67,7 +74,7 @@ def download(out_filename, url, work_dir):
         else:
             # Download the file.
             with open(out_filename, "w+b") as f:
-                r = requests.get(url, stream=True)
+                r = requests.get(url, stream=True, timeout=fetch_timeout)
                 if r.status_code == 301:
                     raise Exception("got a 301")
                 r.raise_for_status()
@@ -120,6 +127,241 @@ def extract_tarball(path, target):
         raise
 
 
+stream_chunk_size = 64 * 1024
+
+
+def _open_url_stream(url, work_dir, offset=0):
+    """Open the body at url starting from byte offset.
+
+    Returns a tuple of an iterator over the chunks of the body and the offset
+    the body actually starts at. That is 0 rather than offset when the source
+    doesn't support range requests.
+    """
+    if url.startswith('file://'):
+        src_filename = url[len('file://'):]
+        if not os.path.isabs(src_filename):
+            src_filename = work_dir + '/' + src_filename
+
+        # Open eagerly so a missing file is reported here rather than on the
+        # first read.
+        f = open(src_filename, 'rb')
+        f.seek(offset)
+
+        def read_file():
+            with f:
+                while True:
+                    chunk = f.read(stream_chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+        return read_file(), offset
+
+    headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+    r = requests.get(url, stream=True, headers=headers, timeout=fetch_timeout)
+    if r.status_code == 301:
+        raise Exception("got a 301")
+    r.raise_for_status()
+    start = offset if r.status_code == 206 else 0
+
+    def read_response():
+        # Don't trust a connection that closed early to have sent everything.
+        # With a Content-Encoding the length is that of the encoded body.
+        expected = None if 'Content-Encoding' in r.headers else r.headers.get('Content-Length')
+        received = 0
+        try:
+            for chunk in r.iter_content(chunk_size=stream_chunk_size):
+                received += len(chunk)
+                yield chunk
+        except requests.ConnectionError as ex:
+            # requests reports the body stalling as a connection error.
+            if ex.args and isinstance(ex.args[0], ReadTimeoutError):
+                raise requests.exceptions.ReadTimeout(*ex.args) from ex
+            raise
+        if expected is not None and received != int(expected):
+            raise IOError("Connection closed after {} of {} bytes".format(received, expected))
+    return read_response(), start
+
+
+def _compression_flag(head):
+    """Pick the tar decompression flag from the magic bytes of a tarball.
+
+    `tar` can only sniff the compression of regular files, not of a pipe.
+    """
+    if head.startswith(b'\x1f\x8b'):
+        return '-z'
+    if head.startswith(b'BZh'):
+        return '-j'
+    return '-J'
+
+
+class _TarExtraction:
+    """A `tar` process extracting a tarball fed to it chunk by chunk.
+
+    If tarball is given the chunks are also written to tarball + '.tmp', which
+    the caller moves into place once the download is verified.
+    """
+
+    def __init__(self, target, tarball=None):
+        self.target = target
+        self.tarball = tarball
+        self.hasher = hashlib.sha1()
+        self.offset = 0
+        self.__tar = None
+        self.__tarball_file = None
+
+    def write(self, chunk):
+        if self.__tar is None:
+            check_call(['mkdir', '-p', self.target])
+            self.__tar = subprocess.Popen(
+                ['tar', _compression_flag(chunk), '-xf', '-', '-C', self.target],
+                stdin=subprocess.PIPE)
+            if self.tarball is not None:
+                os.makedirs(os.path.dirname(self.tarball), exist_ok=True)
+                self.__tarball_file = open(self.tarball + '.tmp', 'wb')
+        self.hasher.update(chunk)
+        self.__tar.stdin.write(chunk)
+        if self.__tarball_file is not None:
+            self.__tarball_file.write(chunk)
+        # Only count what was handed on, so a resume starts right after it.
+        self.offset += len(chunk)
+
+    def finish(self):
+        if self.__tar is None:
+            raise ValidationError("Empty tarball")
+        if self.__tarball_file is not None:
+            self.__tarball_file.close()
+        try:
+            self.__tar.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.__tar.wait()
+        if self.__tar.returncode != 0:
+            raise subprocess.CalledProcessError(self.__tar.returncode, self.__tar.args)
+        return self.hasher.hexdigest()
+
+    def keep_tarball(self):
+        if self.__tarball_file is not None:
+            os.replace(self.tarball + '.tmp', self.tarball)
+
+    def abort(self):
+        if self.__tar is not None:
+            self.__tar.kill()
+            self.__tar.wait()
+        if self.__tarball_file is not None:
+            self.__tarball_file.close()
+            try:
+                os.remove(self.tarball + '.tmp')
+            except FileNotFoundError:
+                pass
+        rmtree(self.target, ignore_errors=True)
+
+
+# Times a download which broke off part way through is resumed from the same url.
+resume_attempts = 3
+
+
+def download_extract(urls, target, work_dir, sha1=None, progress=None, tarball=None):
+    """Stream the tarball at urls straight into `tar` extracting into target.
+
+    The tarball isn't written to disk unless tarball is given, in which case a
+    copy of it is kept there. urls may be a single url or a list of mirrors of
+    the same package, which are tried in order. If a download breaks off part
+    way through it is resumed from the same url with a range request, up to
+    resume_attempts times. A url which stops responding for longer than
+    fetch_timeout isn't retried. Moving on to the next url always starts over,
+    since its tarball may not be byte for byte the same.
+
+    The tarball's sha1 is computed while streaming and if `sha1` is given the
+    extraction is only considered successful when they match. Package
+    repositories have no record of their tarballs' sha1 to check against, so
+    package fetches don't pass one and are only protected by the check in the
+    xz stream itself, which fails the extraction if the data is corrupt. On
+    any error target is removed so a partial extraction is never left behind.
+
+    If given, progress is called with the size of each chunk downloaded.
+    """
+    assert os.path.isabs(work_dir)
+    work_dir = work_dir.rstrip('/')
+
+    # Strip off whitespace to make it so scheme matching doesn't fail because
+    # of simple user whitespace.
+    if isinstance(urls, str):
+        urls = [urls]
+    urls = [url.strip() for url in urls]
+    assert urls
+
+    extraction = _TarExtraction(target, tarball)
+    errors = []
+    for url in urls:
+        if extraction.offset:
+            extraction.abort()
+            extraction = _TarExtraction(target, tarball)
+        resumes = 0
+        while True:
+            offset = extraction.offset
+            try:
+                chunks, start = _open_url_stream(url, work_dir, offset)
+                if start != offset:
+                    # The source can't resume where it stopped.
+                    extraction.abort()
+                    extraction = _TarExtraction(target, tarball)
+                    offset = 0
+                for chunk in chunks:
+                    extraction.write(chunk)
+                    if progress is not None:
+                        progress(len(chunk))
+                digest = extraction.finish()
+                if sha1 is not None and digest != sha1:
+                    raise ValidationError("sha1 of downloaded tarball {} doesn't match the expected sha1 {}".format(
+                        digest, sha1))
+                extraction.keep_tarball()
+                return digest
+            except (BrokenPipeError, subprocess.CalledProcessError, ValidationError) as ex:
+                # What was downloaded so far is bad, start over with the next url.
+                errors.append((url, ex))
+                extraction.abort()
+                extraction = _TarExtraction(target, tarball)
+                break
+            except requests.Timeout as ex:
+                # The source stalled, don't wait on it again.
+                errors.append((url, ex))
+                break
+            except Exception as ex:
+                errors.append((url, ex))
+                # Resume if the source got further this time, otherwise move on.
+                if extraction.offset == offset or resumes == resume_attempts:
+                    break
+                resumes += 1
+
+    extraction.abort()
+    if len(errors) == 1:
+        url, fetch_exception = errors[0]
+    else:
+        url = ', '.join(urls)
+        fetch_exception = Exception('; '.join('{}: {}'.format(*error) for error in errors))
+    raise FetchError(url, target, fetch_exception, os.path.exists(target)) from errors[-1][1]
+
+
+def rank_by_latency(urls, timeout=2):
+    """Order urls fastest first by timing a HEAD request to each.
+
+    Unreachable urls are kept, after the reachable ones, in their original
+    order.
+    """
+    latencies = dict()
+    for url in urls:
+        if url.startswith('file://'):
+            latencies[url] = 0
+            continue
+        try:
+            latencies[url] = requests.head(url, timeout=timeout).elapsed.total_seconds()
+        except requests.exceptions.RequestException:
+            pass
+
+    reachable = sorted((url for url in urls if url in latencies), key=latencies.get)
+    return reachable + [url for url in urls if url not in latencies]
+
+
 def load_json(filename):
     try:
         with open(filename) as f:
@@ -184,6 +426,32 @@ def sha1(filename):
     return hasher.hexdigest()
 
 
+def tree_entries(path):
+    """Map every path inside path to a tuple describing it (kind, mode, content)."""
+    entries = dict()
+    for root, dirs, filenames in os.walk(path):
+        for name in dirs + filenames:
+            full_path = os.path.join(root, name)
+            rel_path = full_path[len(path) + 1:]
+            if os.path.islink(full_path):
+                entries[rel_path] = ('l', 0, os.readlink(full_path))
+                continue
+            mode = os.lstat(full_path).st_mode & 0o7777
+            if os.path.isdir(full_path):
+                entries[rel_path] = ('d', mode, '')
+            else:
+                entries[rel_path] = ('f', mode, sha1(full_path))
+    return entries
+
+
+def hash_tree(path):
+    """Hash of the contents, layout and permissions of everything inside path."""
+    path = path.rstrip('/')
+    hasher = hashlib.sha1()
+    hasher.update(json.dumps(sorted(tree_entries(path).items())).encode())
+    return hasher.hexdigest()
+
+
 def expect_folder(path, files):
     path_contents = os.listdir(path)
     assert set(path_contents) == set(files)
@@ -229,6 +497,44 @@ def rewrite_symlinks(root, old_prefix, new_prefix):
                     os.symlink(new_target, full_path)
 
 
+def chown_tree(path, uid, max_workers=8):
+    """Make uid the owner of path and everything inside it, like `chown -R`.
+
+    Only entries not already owned by uid are changed, and symlinks are
+    changed rather than followed. Directories are scanned level by level on
+    a pool of threads, since on large trees the walk is dominated by waiting
+    on the filesystem. Returns the number of entries changed.
+    """
+    def chown_if_needed(entry_path, st):
+        if st.st_uid == uid:
+            return 0
+        os.chown(entry_path, uid, -1, follow_symlinks=False)
+        return 1
+
+    def scan(dir_path):
+        changed = 0
+        subdirs = []
+        for entry in os.scandir(dir_path):
+            changed += chown_if_needed(entry.path, entry.stat(follow_symlinks=False))
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+        return changed, subdirs
+
+    changed = chown_if_needed(path, os.lstat(path))
+    if not os.path.isdir(path) or os.path.islink(path):
+        return changed
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        level = [path]
+        while level:
+            next_level = []
+            for dir_changed, subdirs in executor.map(scan, level):
+                changed += dir_changed
+                next_level += subdirs
+            level = next_level
+    return changed
+
+
 def check_forbidden_services(path, services):
     """Check if package contains systemd services that may break DC/OS
 
@@ -15,6 +15,10 @@ import logging
 import os.path
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import as_completed, ProcessPoolExecutor, ThreadPoolExecutor
 from distutils.version import LooseVersion
 from typing import Optional
 
@@ -23,6 +27,7 @@ import pkg_resources
 import gen.build_deploy.util as util
 import pkgpanda
 import pkgpanda.build
+import pkgpanda.delta
 import pkgpanda.util
 import release.storage
 from pkgpanda.util import logger
@@ -345,6 +350,49 @@ def make_stable_artifacts(cache_repository_url):
     return metadata
 
 
+def get_package_delta_artifact(base_id_str, package_id_str):
+    delta_filename = pkgpanda.delta.delta_filename(base_id_str, package_id_str)
+    return {
+        'reproducible_path': delta_filename,
+        'local_path': 'packages/cache/' + delta_filename}
+
+
+def make_delta_artifacts(package_ids, base_package_ids, fetch_package):
+    """Make deltas to each of package_ids from the other versions of it in base_package_ids.
+
+    fetch_package(package_id) must put the tarball of a base package at the
+    local_path of its artifact. Deltas which wouldn't be smaller than the full
+    package tarball aren't worth fetching, so are skipped.
+    """
+    base_ids_by_name = dict()
+    for base_id in base_package_ids:
+        base_ids_by_name.setdefault(pkgpanda.PackageId(base_id).name, []).append(base_id)
+
+    artifacts = []
+    for package_id in sorted(package_ids):
+        for base_id in sorted(base_ids_by_name.get(pkgpanda.PackageId(package_id).name, [])):
+            if base_id == package_id:
+                continue
+            artifact = get_package_delta_artifact(base_id, package_id)
+            if not os.path.exists(artifact['local_path']):
+                fetch_package(base_id)
+                with tempfile.TemporaryDirectory() as tmp_dir:
+                    base_dir = os.path.join(tmp_dir, base_id)
+                    package_dir = os.path.join(tmp_dir, package_id)
+                    pkgpanda.util.extract_tarball(get_package_artifact(base_id)['local_path'], base_dir)
+                    pkgpanda.util.extract_tarball(get_package_artifact(package_id)['local_path'], package_dir)
+                    tmp_filename = artifact['local_path'] + '.tmp'
+                    pkgpanda.delta.make_delta(base_id, base_dir, package_id, package_dir, tmp_filename)
+                    os.rename(tmp_filename, artifact['local_path'])
+            if os.path.getsize(artifact['local_path']) >= \
+                    os.path.getsize(get_package_artifact(package_id)['local_path']):
+                logger.normal("Skipping delta {} as it is no smaller than the package".format(
+                    artifact['reproducible_path']))
+                continue
+            artifacts.append(artifact)
+    return artifacts
+
+
 def built_resource_to_artifacts(built_resource: dict):
     # Type switch
     if 'packages' in built_resource:
@@ -367,9 +415,83 @@ def built_resource_to_artifacts(built_resource: dict):
 #       'content': '',
 #       'content_file': '',
 #       }]}}
-def make_channel_artifacts(metadata):
+def make_provider_artifacts(name, metadata, part=None):
+    """Build the channel artifacts of the deploy provider name.
+
+    part is one of the provider's create_parts(), to build only that part of
+    its artifacts, or None to build all of them.
+    """
+    module = load_providers()[name]
     artifacts = []
+    bootstrap_url = metadata['repository_url']
+
+    # If the particular provider has its own storage by the same name then
+    # Use the storage provider rather
+    if name in metadata['storage_urls']:
+        bootstrap_url = metadata['storage_urls'][name] + metadata['repository_path']
+
+    variant_arguments = dict()
+
+    for bootstrap_name, bootstrap_id in metadata['bootstrap_dict'].items():
+        variant_arguments[bootstrap_name] = copy.deepcopy({
+            'bootstrap_url': bootstrap_url,
+            'provider': name,
+            'bootstrap_id': bootstrap_id,
+            'bootstrap_variant': pkgpanda.util.variant_prefix(bootstrap_name)
+        })
+
+        # Load additional default variant arguments out of gen_extra
+        if os.path.exists('gen_extra/calc.py'):
+            mod = importlib.machinery.SourceFileLoader('gen_extra.calc', 'gen_extra/calc.py').load_module()
+            variant_arguments[bootstrap_name].update(mod.provider_template_defaults)
+
+    # Add templates for the default variant.
+    # Use keyword args to make not matching ordering a loud error around changes.
+    with logger.scope("Creating {} deploy tools".format(module.__name__)):
+        # TODO(cmaloney): Cleanup by just having this make and pass another source.
+        module_specific_variant_arguments = copy.deepcopy(variant_arguments)
+        for arg_dict in module_specific_variant_arguments.values():
+            if module.__name__ == 'gen.build_deploy.aws':
+                arg_dict['cloudformation_s3_url_full'] = metadata['cloudformation_s3_url_full']
+            elif module.__name__ == 'gen.build_deploy.azure':
+                arg_dict['azure_download_url'] = metadata['azure_download_url']
+            elif module.__name__ == 'gen.build_deploy.bash':
+                pass
+            else:
+                raise NotImplementedError("Unknown how to add args to deploy tool: {}".format(module.__name__))
+
+        for built_resource in module.do_create(
+                tag=metadata['tag'],
+                build_name=metadata['build_name'],
+                reproducible_artifact_path=metadata['reproducible_artifact_path'],
+                commit=metadata['commit'],
+                variant_arguments=module_specific_variant_arguments,
+                all_bootstraps=metadata["all_bootstraps"],
+                **(part or {})):
+
+            assert isinstance(built_resource, dict), built_resource
+
+            # Type switch
+            if 'packages' in built_resource:
+                for package in built_resource['packages']:
+                    artifacts.append(get_gen_package_artifact(package))
+            else:
+                assert 'packages' not in built_resource
+                artifacts.append(built_resource)
+
+    return artifacts
+
 
+def make_channel_artifacts(metadata, max_workers=None):
+    """Build the channel artifacts of every deploy provider.
+
+    Providers don't depend on each other and building them is CPU bound, so
+    they are built in worker processes. Providers with a create_parts()
+    function are split further into those parts, such as one per variant. max_workers
+    limits how many run at once, with 1 building them all in this process.
+    The artifacts are always in the same order, that of the sorted provider
+    names and then of each provider's parts.
+    """
     # Set logging to debug so we get gen error messages, since those are
     # logging.DEBUG currently to not show up when people are using `--genconf`
     # and friends.
@@ -379,69 +501,30 @@ def make_channel_artifacts(metadata):
     original_log_level = log.getEffectiveLevel()
     log.setLevel(logging.DEBUG)
 
-    provider_data = {}
     providers = load_providers()
-    for name, module in sorted(providers.items()):
-        bootstrap_url = metadata['repository_url']
-
-        # If the particular provider has its own storage by the same name then
-        # Use the storage provider rather
-        if name in metadata['storage_urls']:
-            bootstrap_url = metadata['storage_urls'][name] + metadata['repository_path']
-
-        variant_arguments = dict()
-
-        for bootstrap_name, bootstrap_id in metadata['bootstrap_dict'].items():
-            variant_arguments[bootstrap_name] = copy.deepcopy({
-                'bootstrap_url': bootstrap_url,
-                'provider': name,
-                'bootstrap_id': bootstrap_id,
-                'bootstrap_variant': pkgpanda.util.variant_prefix(bootstrap_name)
-            })
-
-            # Load additional default variant arguments out of gen_extra
-            if os.path.exists('gen_extra/calc.py'):
-                mod = importlib.machinery.SourceFileLoader('gen_extra.calc', 'gen_extra/calc.py').load_module()
-                variant_arguments[bootstrap_name].update(mod.provider_template_defaults)
-
-        # Add templates for the default variant.
-        # Use keyword args to make not matching ordering a loud error around changes.
-        with logger.scope("Creating {} deploy tools".format(module.__name__)):
-            # TODO(cmaloney): Cleanup by just having this make and pass another source.
-            module_specific_variant_arguments = copy.deepcopy(variant_arguments)
-            for arg_dict in module_specific_variant_arguments.values():
-                if module.__name__ == 'gen.build_deploy.aws':
-                    arg_dict['cloudformation_s3_url_full'] = metadata['cloudformation_s3_url_full']
-                elif module.__name__ == 'gen.build_deploy.azure':
-                    arg_dict['azure_download_url'] = metadata['azure_download_url']
-                elif module.__name__ == 'gen.build_deploy.bash':
-                    pass
-                else:
-                    raise NotImplementedError("Unknown how to add args to deploy tool: {}".format(module.__name__))
-
-            for built_resource in module.do_create(
-                    tag=metadata['tag'],
-                    build_name=metadata['build_name'],
-                    reproducible_artifact_path=metadata['reproducible_artifact_path'],
-                    commit=metadata['commit'],
-                    variant_arguments=module_specific_variant_arguments,
-                    all_bootstraps=metadata["all_bootstraps"]):
-
-                assert isinstance(built_resource, dict), built_resource
-
-                # Type switch
-                if 'packages' in built_resource:
-                    for package in built_resource['packages']:
-                        artifacts.append(get_gen_package_artifact(package))
-                else:
-                    assert 'packages' not in built_resource
-                    artifacts.append(built_resource)
-
-            # TODO(cmaloney): Check the provider artifacts adhere to the artifact template.
-            artifacts += provider_data.get('artifacts', list())
+    tasks = []
+    for name in sorted(providers):
+        create_parts = getattr(providers[name], 'create_parts', None)
+        if create_parts is None:
+            tasks.append((name, None))
+        else:
+            tasks += [(name, part) for part in create_parts(list(metadata['bootstrap_dict']))]
+    if max_workers is None:
+        max_workers = min(len(tasks), os.cpu_count() or 1)
 
-    log.setLevel(original_log_level)
+    try:
+        if max_workers == 1:
+            provider_artifacts = [make_provider_artifacts(name, metadata, part) for name, part in tasks]
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                futures = [executor.submit(make_provider_artifacts, name, metadata, part) for name, part in tasks]
+                provider_artifacts = [future.result() for future in futures]
+    finally:
+        log.setLevel(original_log_level)
 
+    artifacts = []
+    for artifact_list in provider_artifacts:
+        artifacts += artifact_list
     return artifacts
 
 
@@ -646,21 +729,154 @@ def get_storage_provider_factory(kind):
     return module.factories[name]
 
 
-def apply_storage_commands(storage_providers: dict, storage_commands: dict) -> None:
+# Number of storage commands run at once. They mostly wait on round trips to the storage providers.
+storage_workers = 16
+
+# Seconds between progress reports while applying storage commands.
+storage_progress_interval = 10
+
+
+def group_storage_commands(commands):
+    """Split the commands of a stage into chains of commands which must run in order.
+
+    A copy from a path which an earlier command of the same stage writes has to wait for that
+    command, so it goes in the same chain. Chains are independent of each other.
+    """
+    chains = []
+    destination_chains = {}
+    for command in commands:
+        source_path = command['args'].get('source_path')
+        if command['method'] == 'copy' and source_path in destination_chains:
+            chain = destination_chains[source_path]
+        else:
+            chain = []
+            chains.append(chain)
+        chain.append(command)
+        destination_chains[command['args']['destination_path']] = chain
+    return chains
+
+
+def storage_command_size(command):
+    """Number of bytes command sends to the storage provider. Copies happen inside the provider."""
+    if command['method'] != 'upload':
+        return 0
+    if command['args'].get('local_path'):
+        return os.path.getsize(command['args']['local_path'])
+    return len(command['args']['blob'])
+
+
+class StorageProgress():
+    """Progress of applying a stage of storage commands to each of the storage providers."""
+
+    def __init__(self, stage, provider_names, total):
+        self.stage = stage
+        self.start = time.time()
+        self.providers = {name: {'total': total, 'done': 0, 'skipped': 0, 'bytes': 0} for name in provider_names}
+        self.__lock = threading.Lock()
+
+    def add(self, provider_name, skipped, size):
+        with self.__lock:
+            progress = self.providers[provider_name]
+            progress['done'] += 1
+            progress['skipped'] += int(skipped)
+            progress['bytes'] += size
+
+    def report(self):
+        elapsed = max(time.time() - self.start, 1e-6)
+        with self.__lock:
+            for name, progress in sorted(self.providers.items()):
+                print("{} to {}: {}/{} commands done ({} skipped), {:.1f} MB in {:.1f}s, "
+                      "{:.1f} commands/s, {:.1f} MB/s".format(
+                          self.stage, name, progress['done'], progress['total'], progress['skipped'],
+                          progress['bytes'] / 1e6, elapsed, progress['done'] / elapsed,
+                          progress['bytes'] / 1e6 / elapsed))
+
+    def summary(self):
+        with self.__lock:
+            return {name: dict(progress, seconds=time.time() - self.start)
+                    for name, progress in self.providers.items()}
+
+
+def find_existing(storage_providers, storage_commands):
+    """For each storage provider, which of the paths only to be stored if missing already exist.
+
+    Uses a bulk query per provider, with the providers queried concurrently.
+    """
+    paths = {command['args']['destination_path']
+             for commands in storage_commands.values()
+             for command in commands
+             if command['if_not_exists']}
+    names = sorted(storage_providers)
+    with ThreadPoolExecutor(max_workers=max(len(names), 1)) as executor:
+        existing = executor.map(lambda name: storage_providers[name].exists_bulk(paths), names)
+        return dict(zip(names, existing))
+
+
+def apply_storage_command(provider_name, provider, command, existing):
+    """Apply a single storage command. Returns whether it was skipped.
+
+    existing is the set of paths in the provider, found by find_existing.
+    """
+    path = command['args']['destination_path']
+    # If it is only supposed to be if the artifact does not exist, skip it if it exists.
+    if command['if_not_exists'] and path in existing:
+        print("Store to", provider_name, "artifact", path, "skipped because it already exists")
+        return True
+    print("Store to", provider_name, "artifact", path, "by method", command['method'])
+    getattr(provider, command['method'])(**command['args'])
+    return False
+
+
+def apply_storage_commands(storage_providers: dict, storage_commands: dict, max_workers=storage_workers) -> dict:
+    """Apply the storage commands to every storage provider.
+
+    Every stage1 command has completed on every provider before any stage2 command starts. Within
+    a stage the commands run concurrently across and within the providers, max_workers at a time,
+    except for copies from a path the stage writes which wait for it. Commands which should only
+    be applied if their destination is missing are pruned using bulk existence queries made before
+    anything is transferred. Progress is reported periodically. Returns for each stage and provider
+    the number of commands done and skipped, bytes uploaded and seconds taken.
+    """
     assert storage_commands.keys() == {'stage1', 'stage2'}
 
+    existing = find_existing(storage_providers, storage_commands)
+
+    stats = {}
     for stage in ['stage1', 'stage2']:
         commands = storage_commands[stage]
-        for provider_name, provider in storage_providers.items():
-            for artifact in commands:
-                path = artifact['args']['destination_path']
-                # If it is only supposed to be if the artifact does not exist, check for existence
-                # and skip if it exists.
-                if artifact['if_not_exists'] and provider.exists(path):
-                    print("Store to", provider_name, "artifact", path, "skipped because it already exists")
-                    continue
-                print("Store to", provider_name, "artifact", path, "by method", artifact['method'])
-                getattr(provider, artifact['method'])(**artifact['args'])
+        chains = group_storage_commands(commands)
+        progress = StorageProgress(stage, storage_providers.keys(), len(commands))
+
+        def apply_chain(provider_name, provider, chain):
+            for command in chain:
+                skipped = apply_storage_command(provider_name, provider, command, existing[provider_name])
+                progress.add(provider_name, skipped, 0 if skipped else storage_command_size(command))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(apply_chain, provider_name, provider, chain)
+                       for chain in chains
+                       for provider_name, provider in sorted(storage_providers.items())]
+            last_report = time.time()
+            try:
+                for future in as_completed(futures):
+                    future.result()
+                    if time.time() - last_report >= storage_progress_interval:
+                        progress.report()
+                        last_report = time.time()
+            except BaseException:
+                # Don't start anything more, and never go on to the next stage.
+                for future in futures:
+                    future.cancel()
+                raise
+
+        progress.report()
+        stats[stage] = progress.summary()
+
+        # Everything the stage stored exists for the next one.
+        for paths in existing.values():
+            paths |= {command['args']['destination_path'] for command in commands}
+
+    return stats
 
 
 # Two stages of uploading artifacts. First puts all the artifacts into their places / uploads
@@ -803,6 +1019,24 @@ class ReleaseManager():
             )
             assert bootstrap_active_packages <= set(info['packages'])
 
+        # Deltas from the packages of an existing channel let clusters running
+        # that release upgrade without downloading every changed package.
+        delta_base_channel = self.__config.get('options', dict()).get('delta_base_channel')
+        if delta_base_channel:
+            base_metadata = self.get_metadata(delta_base_channel)
+
+            def fetch_base_package(package_id):
+                artifact = get_package_artifact(package_id)
+                self.__preferred_provider.download_if_not_exist(
+                    base_metadata['repository_path'] + '/' + artifact['reproducible_path'],
+                    artifact['local_path'])
+
+            with logger.scope("Making deltas from {}".format(delta_base_channel)):
+                metadata['core_artifacts'] += make_delta_artifacts(
+                    metadata['packages'],
+                    base_metadata['packages'],
+                    fetch_base_package)
+
         repository = Repository(repository_path, channel, 'commit/{}'.format(metadata['commit']))
         set_repository_metadata(
             repository, metadata, self.__storage_providers, self.__preferred_provider, self.__config)
@@ -823,7 +1057,10 @@ class ReleaseManager():
             return
 
         with logger.scope("Uploading artifacts"):
-            apply_storage_commands(self.__storage_providers, storage_commands)
+            apply_storage_commands(
+                self.__storage_providers,
+                storage_commands,
+                self.__config.get('options', dict()).get('storage_workers', storage_workers))
 
 
 _config = None
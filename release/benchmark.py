@@ -0,0 +1,87 @@
+"""Benchmarks for applying release storage commands
+
+Run with `python -m release.benchmark`. Everything is stored in temporary
+directories with the local storage provider. Real storage providers spend most
+of their time waiting on round trips, so each storage operation is delayed by
+--latency seconds to stand in for that.
+"""
+import argparse
+import contextlib
+import io
+import os
+import time
+from tempfile import TemporaryDirectory
+
+import release
+from release.storage.local import LocalStorageProvider
+
+
+class SlowLocalStorageProvider(LocalStorageProvider):
+    """Local storage with a delay before every operation, like a round trip to a remote provider."""
+
+    def __init__(self, path, latency):
+        super().__init__(path)
+        self.latency = latency
+
+    def exists(self, path):
+        time.sleep(self.latency)
+        return super().exists(path)
+
+    def copy(self, source_path, destination_path):
+        time.sleep(self.latency)
+        super().copy(source_path, destination_path)
+
+    def upload(self, destination_path, **kwargs):
+        time.sleep(self.latency)
+        super().upload(destination_path, **kwargs)
+
+
+def make_metadata(num_artifacts, artifact_size):
+    content = 'x' * artifact_size
+    return {
+        'core_artifacts': [
+            {'reproducible_path': 'packages/{0}/{0}--1.tar.xz'.format(i), 'local_content': content}
+            for i in range(num_artifacts)],
+        'channel_artifacts': [
+            {'channel_path': 'installer-{}.sh'.format(i), 'local_content': content} for i in range(10)]}
+
+
+def bench_apply_storage_commands(num_artifacts, artifact_size, num_providers, latency, max_workers):
+    """Number of storage commands applied, and the seconds to apply them for a new release and again once it
+    is already stored."""
+    commands = release.Repository('testing', 'pull/1', 'commit/benchmark').make_commands(
+        make_metadata(num_artifacts, artifact_size))
+    times = []
+    with TemporaryDirectory(prefix='release-benchmark') as tmpdir:
+        providers = {}
+        for i in range(num_providers):
+            path = os.path.join(tmpdir, str(i))
+            os.mkdir(path)
+            providers[str(i)] = SlowLocalStorageProvider(path, latency)
+        for _ in range(2):
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                release.apply_storage_commands(providers, commands, max_workers)
+            times.append(time.perf_counter() - start)
+    return len(commands['stage1'] + commands['stage2']) * num_providers, times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--artifacts', type=int, default=500, help='Number of reproducible artifacts.')
+    parser.add_argument('--size', type=int, default=64 * 1024, help='Size in bytes of each artifact.')
+    parser.add_argument('--providers', type=int, default=2, help='Number of storage providers.')
+    parser.add_argument('--latency', type=float, default=0.02, help='Seconds every storage operation takes.')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, release.storage_workers, 64],
+                        help='Numbers of workers to compare.')
+    args = parser.parse_args()
+
+    print("{:>8} {:>12} {:>12} {:>14}".format('workers', 'new (s)', 'stored (s)', 'commands/s'))
+    for max_workers in args.workers:
+        num_commands, (new, stored) = bench_apply_storage_commands(
+            args.artifacts, args.size, args.providers, args.latency, max_workers)
+        print("{:>8} {:>12.2f} {:>12.2f} {:>14.1f}".format(max_workers, new, stored, num_commands / new))
+
+
+if __name__ == '__main__':
+    main()
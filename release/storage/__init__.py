@@ -1,5 +1,6 @@
 import abc
 import os.path
+import posixpath
 import subprocess
 
 
@@ -7,8 +8,37 @@ class UnsupportedOperation(RuntimeError):
     pass
 
 
+def _folder_depth(folder):
+    return folder.count('/') + 1 if folder else 0
+
+
+def group_paths_by_folder(paths, max_folders):
+    """Group paths by the folder containing them, with at most max_folders folders.
+
+    While there are too many folders the deepest ones are replaced by their parents. Returns a
+    dict of folder to the set of paths inside it. Paths at the top level have the folder ''.
+    """
+    path_folders = {path: posixpath.dirname(path) for path in paths}
+    while len(set(path_folders.values())) > max_folders:
+        depth = max(_folder_depth(folder) for folder in path_folders.values())
+        if depth == 0:
+            break
+        path_folders = {
+            path: posixpath.dirname(folder) if _folder_depth(folder) == depth else folder
+            for path, folder in path_folders.items()}
+
+    groups = dict()
+    for path, folder in path_folders.items():
+        groups.setdefault(folder, set()).add(path)
+    return groups
+
+
 class AbstractStorageProvider(metaclass=abc.ABCMeta):
 
+    # Number of folders exists_bulk lists at most. Listings return many names per request, so a
+    # few of them answer for a whole release.
+    bulk_exists_max_folders = 16
+
     @abc.abstractmethod
     def copy(self,
              source_path,
@@ -48,6 +78,23 @@ class AbstractStorageProvider(metaclass=abc.ABCMeta):
         """Return true iff the given file / path exists."""
         pass
 
+    def exists_bulk(self, paths):
+        """Return the set of the given paths which exist.
+
+        Lists the few folders containing the paths rather than checking each one. Falls back to
+        exists() for every path if the provider can't list or the paths are at the top level.
+        """
+        existing = set()
+        for folder, folder_paths in group_paths_by_folder(paths, self.bulk_exists_max_folders).items():
+            if folder:
+                try:
+                    existing |= folder_paths & self.list_recursive(folder)
+                    continue
+                except (NotImplementedError, UnsupportedOperation):
+                    pass
+            existing |= {path for path in folder_paths if self.exists(path)}
+        return existing
+
     @abc.abstractmethod
     def fetch(self, path):
         """Download the given file and return bytes. Do not use on large files.
@@ -107,9 +154,15 @@ class ReadOnlyProxy(AbstractStorageProvider):
     def download(self, path, local_path):
         return self._storage_provider.download(path, local_path)
 
+    def download_inner(self, path, local_path):
+        return self._storage_provider.download_inner(path, local_path)
+
     def exists(self, path):
         return self._storage_provider.exists(path)
 
+    def exists_bulk(self, paths):
+        return self._storage_provider.exists_bulk(paths)
+
     def fetch(self, path):
         return self._storage_provider.fetch(path)
 
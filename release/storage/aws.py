@@ -1,7 +1,10 @@
+import threading
 from typing import Optional
 
 import boto3
+import boto3.s3.transfer
 import botocore
+import botocore.config
 
 from release.storage import AbstractStorageProvider
 
@@ -23,19 +26,62 @@ def get_session(boto3_profile=None, region_name=None, access_key_id=None, secret
                              "secret_access_key, region_name) must be provided")
 
 
+MB = 1024 * 1024
+
+# Object properties which copies carry across from the source object.
+copied_properties = {
+    'cache_control': 'CacheControl',
+    'content_disposition': 'ContentDisposition',
+    'content_encoding': 'ContentEncoding',
+    'content_language': 'ContentLanguage',
+    'content_type': 'ContentType',
+}
+
+
 class S3StorageProvider(AbstractStorageProvider):
+    """Storage in an S3 bucket, under object_prefix if given.
+
+    Objects bigger than multipart_threshold bytes are uploaded, downloaded and copied in parts of
+    multipart_chunksize bytes, max_concurrency parts at a time. endpoint_url points the provider
+    at an S3 compatible service other than AWS, such as a local stand-in for testing.
+    """
     name = 'aws'
 
     def __init__(self, bucket, object_prefix, download_url, boto3_profile=None, region_name=None,
-                 access_key_id=None, secret_access_key=None):
+                 access_key_id=None, secret_access_key=None, endpoint_url=None,
+                 multipart_threshold=64 * MB, multipart_chunksize=64 * MB, max_concurrency=10):
         if object_prefix is not None:
             assert object_prefix and not object_prefix.startswith('/') and not object_prefix.endswith('/')
 
         self.__session = get_session(boto3_profile, region_name, access_key_id, secret_access_key)
-        self.__bucket = self.__session.resource('s3').Bucket(bucket)
+        self.__bucket_name = bucket
+        self.__endpoint_url = endpoint_url
+        self.__transfer_config = boto3.s3.transfer.TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_chunksize,
+            max_concurrency=max_concurrency)
+        # boto3 sessions and resources aren't thread safe, so every thread gets its own resource,
+        # created while holding the lock.
+        self.__session_lock = threading.Lock()
+        self.__thread_local = threading.local()
         self.__object_prefix = object_prefix
         self.__url = download_url
 
+    @property
+    def __bucket(self):
+        if not hasattr(self.__thread_local, 'bucket'):
+            with self.__session_lock:
+                if self.__endpoint_url:
+                    # Stand-ins are addressed by host and port, so the bucket can't be in the host name.
+                    resource = self.__session.resource(
+                        's3',
+                        endpoint_url=self.__endpoint_url,
+                        config=botocore.config.Config(s3={'addressing_style': 'path'}))
+                else:
+                    resource = self.__session.resource('s3')
+                self.__thread_local.bucket = resource.Bucket(self.__bucket_name)
+        return self.__thread_local.bucket
+
     @property
     def object_prefix(self):
         if self.__object_prefix is None:
@@ -54,14 +100,18 @@ class S3StorageProvider(AbstractStorageProvider):
         return self.__bucket.Object(self._get_path(name))
 
     def fetch(self, path):
+        return b''.join(self.fetch_iter(path))
+
+    def fetch_iter(self, path, chunk_size=MB):
+        """Download the given file as an iterator of chunks of bytes, without holding it all in memory."""
         body = self.get_object(path).get()['Body']
-        data = bytes()
-        for chunk in iter(lambda: body.read(4096), b''):
-            data += chunk
-        return data
+        try:
+            yield from iter(lambda: body.read(chunk_size), b'')
+        finally:
+            body.close()
 
     def download_inner(self, path, local_path):
-        self.get_object(path).download_file(local_path)
+        self.get_object(path).download_file(local_path, Config=self.__transfer_config)
 
     @property
     def url(self):
@@ -70,9 +120,19 @@ class S3StorageProvider(AbstractStorageProvider):
     def copy(self, source_path, destination_path):
         src_object = self.get_object(source_path)
         new_object = self.get_object(destination_path)
-        old_path = src_object.bucket_name + '/' + src_object.key
 
-        new_object.copy_from(CopySource=old_path)
+        # Big objects are copied in parts inside S3, which doesn't carry the metadata across by
+        # itself, so always set it explicitly.
+        extra_args = {'MetadataDirective': 'REPLACE', 'Metadata': src_object.metadata}
+        for attribute, arg in copied_properties.items():
+            value = getattr(src_object, attribute)
+            if value:
+                extra_args[arg] = value
+
+        new_object.copy(
+            {'Bucket': src_object.bucket_name, 'Key': src_object.key},
+            ExtraArgs=extra_args,
+            Config=self.__transfer_config)
 
     def upload(self,
                destination_path: str,
@@ -90,8 +150,7 @@ class S3StorageProvider(AbstractStorageProvider):
 
         assert local_path is None or blob is None
         if local_path:
-            with open(local_path, 'rb') as data:
-                s3_object.put(Body=data, **extra_args)
+            s3_object.upload_file(local_path, ExtraArgs=extra_args, Config=self.__transfer_config)
         else:
             assert isinstance(blob, bytes)
             s3_object.put(Body=blob, **extra_args)
@@ -110,7 +169,7 @@ class S3StorageProvider(AbstractStorageProvider):
             name = object_summary.key
 
             # Sanity check the prefix is there before removing.
-            assert name.startswith(self.__object_prefix + '/')
+            assert name.startswith(self.object_prefix)
 
             # Add the unprefixed name since the caller of this function doesn't
             # know we've added the prefix / only sees inside the prefix ever.
@@ -1,4 +1,5 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 
@@ -54,6 +55,12 @@ class HttpStorageProvider(AbstractStorageProvider):
         # indicate resource is found / exists.
         return requests.head(url=url).status_code == 200
 
+    def exists_bulk(self, paths):
+        # Plain HTTP has no listing, so check the paths concurrently instead.
+        paths = list(paths)
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            return {path for path, exists in zip(paths, executor.map(self.exists, paths)) if exists}
+
     def fetch(self, path):
         r = requests.get(url=self._get_absolute(path))
         r.raise_for_status()
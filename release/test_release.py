@@ -1,14 +1,21 @@
 import copy
+import http.server
 import logging
 import os
+import socketserver
 import subprocess
+import threading
+import urllib.parse
 import uuid
+import xml.sax.saxutils
 
 import pytest
 
 import gen.build_deploy.aws
 import release
+import release.storage
 import release.storage.aws
+import release.storage.local
 from pkgpanda.build import BuildError
 from pkgpanda.util import variant_prefix, write_json, write_string
 
@@ -243,6 +250,195 @@ def test_storage_provider_local(tmpdir):
     exercise_storage_provider(work_dir, 'local_path', {'path': str(repo_dir)})
 
 
+class FakeS3Handler(http.server.BaseHTTPRequestHandler):
+    """Just enough of the S3 REST API, with path style addressing, for S3StorageProvider.
+
+    Objects are kept in the server's objects dict as (data, headers). Nothing is authenticated.
+    """
+    protocol_version = 'HTTP/1.1'
+    stored_headers = ['Cache-Control', 'Content-Disposition', 'Content-Encoding', 'Content-Language', 'Content-Type']
+
+    def log_message(self, *args):
+        pass
+
+    def parse(self):
+        url = urllib.parse.urlsplit(self.path)
+        _, bucket, key = (url.path.split('/', 2) + [''])[:3]
+        return bucket, urllib.parse.unquote(key), dict(urllib.parse.parse_qsl(url.query, keep_blank_values=True))
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def request_headers(self):
+        return {name: value for name, value in self.headers.items()
+                if name in self.stored_headers or name.lower().startswith('x-amz-meta-')}
+
+    def respond(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def respond_xml(self, xml):
+        self.respond(200, xml.encode(), {'Content-Type': 'application/xml'})
+
+    def respond_missing(self):
+        self.respond(404, b'<Error><Code>NoSuchKey</Code><Message>Missing</Message></Error>')
+
+    def copy_source(self):
+        source = urllib.parse.unquote(self.headers['x-amz-copy-source'].lstrip('/'))
+        return self.server.objects[source.split('/', 1)[1]]
+
+    def do_HEAD(self):  # noqa: N802
+        self.do_GET()
+
+    def do_GET(self):  # noqa: N802
+        bucket, key, query = self.parse()
+        if not key:
+            contents = ''.join(
+                '<Contents><Key>{}</Key><Size>{}</Size><ETag>"etag"</ETag>'
+                '<LastModified>2017-01-01T00:00:00.000Z</LastModified></Contents>'.format(
+                    xml.sax.saxutils.escape(name), len(data))
+                for name, (data, _) in sorted(self.server.objects.items())
+                if name.startswith(query.get('prefix', '')))
+            self.respond_xml('<ListBucketResult><Name>{}</Name><IsTruncated>false</IsTruncated>{}'
+                             '</ListBucketResult>'.format(bucket, contents))
+            return
+        if key not in self.server.objects:
+            self.respond_missing()
+            return
+        data, headers = self.server.objects[key]
+        headers = dict(headers, ETag='"etag"', **{'Last-Modified': 'Sun, 01 Jan 2017 00:00:00 GMT'})
+        byte_range = self.headers.get('Range')
+        if byte_range:
+            start, end = byte_range[len('bytes='):].split('-')
+            end = min(int(end), len(data) - 1) if end else len(data) - 1
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, len(data))
+            self.respond(206, data[int(start):end + 1], headers)
+        else:
+            self.respond(200, data, headers)
+
+    def do_PUT(self):  # noqa: N802
+        _, key, query = self.parse()
+        body = self.read_body()
+        if 'partNumber' in query:
+            parts = self.server.uploads[query['uploadId']]['parts']
+            if 'x-amz-copy-source' in self.headers:
+                start, end = self.headers['x-amz-copy-source-range'][len('bytes='):].split('-')
+                parts[int(query['partNumber'])] = self.copy_source()[0][int(start):int(end) + 1]
+                self.respond_xml('<CopyPartResult><ETag>"etag"</ETag>'
+                                 '<LastModified>2017-01-01T00:00:00.000Z</LastModified></CopyPartResult>')
+            else:
+                parts[int(query['partNumber'])] = body
+                self.respond(200, headers={'ETag': '"etag"'})
+        elif 'x-amz-copy-source' in self.headers:
+            data, headers = self.copy_source()
+            if self.headers.get('x-amz-metadata-directive') == 'REPLACE':
+                headers = self.request_headers()
+            self.server.objects[key] = (data, headers)
+            self.respond_xml('<CopyObjectResult><ETag>"etag"</ETag>'
+                             '<LastModified>2017-01-01T00:00:00.000Z</LastModified></CopyObjectResult>')
+        else:
+            self.server.objects[key] = (body, self.request_headers())
+            self.respond(200, headers={'ETag': '"etag"'})
+
+    def do_POST(self):  # noqa: N802
+        bucket, key, query = self.parse()
+        self.read_body()
+        if 'uploads' in query:
+            upload_id = uuid.uuid4().hex
+            self.server.uploads[upload_id] = {'headers': self.request_headers(), 'parts': {}}
+            self.respond_xml('<InitiateMultipartUploadResult><Bucket>{}</Bucket><Key>{}</Key><UploadId>{}</UploadId>'
+                             '</InitiateMultipartUploadResult>'.format(bucket, xml.sax.saxutils.escape(key), upload_id))
+        else:
+            upload = self.server.uploads.pop(query['uploadId'])
+            self.server.multipart_counts.append(len(upload['parts']))
+            data = b''.join(part for _, part in sorted(upload['parts'].items()))
+            self.server.objects[key] = (data, upload['headers'])
+            self.respond_xml('<CompleteMultipartUploadResult><Bucket>{}</Bucket><Key>{}</Key><ETag>"etag"</ETag>'
+                             '</CompleteMultipartUploadResult>'.format(bucket, xml.sax.saxutils.escape(key)))
+
+    def do_DELETE(self):  # noqa: N802
+        _, key, query = self.parse()
+        if 'uploadId' in query:
+            self.server.uploads.pop(query['uploadId'], None)
+        else:
+            self.server.objects.pop(key, None)
+        self.respond(204)
+
+
+class FakeS3Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeS3Handler)
+        self.objects = dict()
+        self.uploads = dict()
+        # Number of parts of every completed multipart upload or copy.
+        self.multipart_counts = []
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+
+@pytest.fixture
+def fake_s3():
+    server = FakeS3Server()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def fake_s3_config(fake_s3, **kwargs):
+    config = {
+        'bucket': 'bucket',
+        'object_prefix': 'prefix',
+        'download_url': fake_s3.url + '/bucket/prefix/',
+        'endpoint_url': fake_s3.url,
+        'access_key_id': 'test',
+        'secret_access_key': 'test',
+        'region_name': 'us-west-2'}
+    config.update(kwargs)
+    return config
+
+
+def test_storage_provider_aws_fake(fake_s3, tmpdir):
+    exercise_storage_provider(tmpdir, 'aws_s3', fake_s3_config(fake_s3))
+
+
+def test_storage_provider_aws_multipart(fake_s3, tmpdir):
+    mb = release.storage.aws.MB
+    store = release.storage.aws.S3StorageProvider(**fake_s3_config(
+        fake_s3, multipart_threshold=5 * mb, multipart_chunksize=5 * mb, max_concurrency=4))
+    content = os.urandom(12 * mb)
+    local_file = tmpdir.join('installer.sh')
+    local_file.write_binary(content)
+
+    store.upload('installer.sh', local_path=str(local_file), no_cache=True, content_type='text/x-sh')
+    assert fake_s3.multipart_counts == [3]
+    assert fake_s3.objects['prefix/installer.sh'][0] == content
+
+    assert [len(chunk) for chunk in store.fetch_iter('installer.sh', chunk_size=5 * mb)] == [5 * mb, 5 * mb, 2 * mb]
+    assert store.fetch('installer.sh') == content
+
+    store.download('installer.sh', str(tmpdir.join('download/installer.sh')))
+    assert tmpdir.join('download/installer.sh').read_binary() == content
+
+    # Copies of big objects are done in parts inside S3, keeping the metadata.
+    store.copy('installer.sh', 'channel/installer.sh')
+    assert fake_s3.multipart_counts == [3, 3]
+    data, headers = fake_s3.objects['prefix/channel/installer.sh']
+    assert data == content
+    assert headers['Content-Type'] == 'text/x-sh'
+    assert headers['Cache-Control'] == 'no-cache'
+
+
 copy_make_commands_result = {'stage1': [
     {
         'if_not_exists': True,
@@ -453,6 +649,171 @@ def test_repository():
     # TODO(cmaloney): Exercise make_commands with a channel.
 
 
+class RecordingStorageProvider(release.storage.local.LocalStorageProvider):
+    """Local storage which records the order paths are stored in."""
+
+    def __init__(self, path, log, lock):
+        super().__init__(path)
+        self.log = log
+        self.lock = lock
+
+    def record(self, path):
+        with self.lock:
+            self.log.append((self.url, path))
+
+    def copy(self, source_path, destination_path):
+        assert self.exists(source_path)
+        super().copy(source_path, destination_path)
+        self.record(destination_path)
+
+    def upload(self, destination_path, **kwargs):
+        super().upload(destination_path, **kwargs)
+        self.record(destination_path)
+
+
+def test_group_storage_commands():
+    def upload(path):
+        return {'method': 'upload', 'if_not_exists': True, 'args': {'destination_path': path, 'blob': b''}}
+
+    def copy(source_path, path):
+        return {'method': 'copy', 'if_not_exists': False, 'args': {
+            'source_path': source_path, 'destination_path': path}}
+
+    commands = [
+        upload('a'),
+        copy('/elsewhere/b', 'b'),
+        copy('a', 'channel/a'),
+        upload('c'),
+        copy('b', 'channel/b'),
+        copy('channel/a', 'other/a')]
+    assert release.group_storage_commands(commands) == [
+        [commands[0], commands[2], commands[5]],
+        [commands[1], commands[4]],
+        [commands[3]]]
+
+
+def test_apply_storage_commands(tmpdir):
+    log = []
+    lock = threading.Lock()
+    providers = {
+        name: RecordingStorageProvider(str(tmpdir.mkdir(name)), log, lock) for name in ['a', 'b']}
+
+    artifact_file = tmpdir.join('artifact.tar.xz')
+    artifact_file.write('artifact')
+    metadata = {
+        'core_artifacts': [{'reproducible_path': 'packages/{}.txt'.format(i), 'local_content': str(i)}
+                           for i in range(50)] + [{
+                               'reproducible_path': 'bootstrap/artifact.tar.xz',
+                               'channel_path': 'artifact.tar.xz',
+                               'local_path': str(artifact_file)}],
+        'channel_artifacts': [{'channel_path': 'cf.json', 'local_content': '{}'}]}
+    repository = release.Repository('testing', 'pull/1', 'commit/abc')
+    commands = repository.make_commands(metadata)
+
+    # A package already in a provider is skipped there.
+    providers['a'].upload('testing/packages/0.txt', blob=b'0')
+    del log[:]
+
+    stats = release.apply_storage_commands(providers, commands, max_workers=8)
+
+    metadata_json = release.to_json(release.strip_locals(metadata))
+    for name, provider in providers.items():
+        assert provider.fetch('testing/pull/1/metadata.json').decode() == metadata_json
+        assert provider.fetch('testing/pull/1/artifact.tar.xz') == b'artifact'
+        assert provider.fetch('testing/pull/1/commit/abc/artifact.tar.xz') == b'artifact'
+        assert provider.fetch('testing/packages/49.txt') == b'49'
+        assert stats['stage1'][name]['done'] == len(commands['stage1'])
+        assert stats['stage2'][name]['done'] == len(commands['stage2'])
+    assert stats['stage1']['a']['skipped'] == 1
+    assert stats['stage1']['b']['skipped'] == 0
+    assert stats['stage1']['b']['bytes'] == 10 + 40 * 2 + len('artifact') + len('{}') + len(metadata_json)
+
+    # Nothing of stage2 is stored until everything of stage1 is.
+    stage2_paths = {command['args']['destination_path'] for command in commands['stage2']}
+    stage2_positions = [i for i, (_, path) in enumerate(log) if path in stage2_paths]
+    assert len(stage2_positions) == 2 * len(stage2_paths)
+    assert min(stage2_positions) == len(log) - len(stage2_positions)
+
+
+def test_group_paths_by_folder():
+    paths = ['top', 'a/1', 'a/2', 'a/b/1', 'a/b/c/1', 'a/b/c/2', 'd/1']
+    assert release.storage.group_paths_by_folder(paths, 10) == {
+        '': {'top'}, 'a': {'a/1', 'a/2'}, 'a/b': {'a/b/1'}, 'a/b/c': {'a/b/c/1', 'a/b/c/2'}, 'd': {'d/1'}}
+    assert release.storage.group_paths_by_folder(paths, 4) == {
+        '': {'top'}, 'a': {'a/1', 'a/2'}, 'a/b': {'a/b/1', 'a/b/c/1', 'a/b/c/2'}, 'd': {'d/1'}}
+    assert release.storage.group_paths_by_folder(paths, 3) == {
+        '': {'top'}, 'a': {'a/1', 'a/2', 'a/b/1', 'a/b/c/1', 'a/b/c/2'}, 'd': {'d/1'}}
+    assert release.storage.group_paths_by_folder(paths, 1) == {'': set(paths)}
+
+
+class CountingStorageProvider(release.storage.local.LocalStorageProvider):
+    """Local storage which counts the existence checks and listings done on it."""
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.exists_count = 0
+        self.list_count = 0
+
+    def exists(self, path):
+        self.exists_count += 1
+        return super().exists(path)
+
+    def list_recursive(self, path):
+        self.list_count += 1
+        return super().list_recursive(path)
+
+
+def test_exists_bulk(tmpdir):
+    provider = CountingStorageProvider(str(tmpdir))
+    for path in ['top', 'a/1', 'a/b/1', 'a/b/c/1']:
+        provider.upload(path, blob=b'')
+    paths = ['top', 'missing', 'a/1', 'a/2', 'a/b/1', 'a/b/c/1', 'a/b/c/2', 'd/1']
+
+    assert provider.exists_bulk(paths) == {'top', 'a/1', 'a/b/1', 'a/b/c/1'}
+    assert provider.list_count == 4
+    # Only the top level paths can't be listed.
+    assert provider.exists_count == 2
+
+    # The read only proxy passes the query through.
+    assert release.storage.ReadOnlyProxy(provider).exists_bulk(paths) == {'top', 'a/1', 'a/b/1', 'a/b/c/1'}
+
+
+def test_apply_storage_commands_exists_bulk(tmpdir):
+    provider = CountingStorageProvider(str(tmpdir.mkdir('storage')))
+    metadata = {
+        'core_artifacts': [{'reproducible_path': 'packages/{0}/{0}--1.tar.xz'.format(i), 'local_content': str(i)}
+                           for i in range(100)],
+        'channel_artifacts': []}
+    commands = release.Repository('testing', None, 'commit/abc').make_commands(metadata)
+    for i in range(0, 100, 2):
+        provider.upload('testing/packages/{0}/{0}--1.tar.xz'.format(i), blob=b'old')
+
+    stats = release.apply_storage_commands({'local': provider}, commands)
+
+    assert provider.exists_count == 0
+    assert provider.list_count <= provider.bulk_exists_max_folders
+    assert stats['stage1']['local']['skipped'] == 50
+    assert provider.fetch('testing/packages/0/0--1.tar.xz') == b'old'
+    assert provider.fetch('testing/packages/1/1--1.tar.xz') == b'1'
+
+
+def test_apply_storage_commands_failure(tmpdir):
+    provider = release.storage.local.LocalStorageProvider(str(tmpdir.mkdir('storage')))
+    commands = {
+        'stage1': [{
+            'method': 'upload',
+            'if_not_exists': False,
+            'args': {'destination_path': 'missing', 'local_path': str(tmpdir.join('missing'))}}],
+        'stage2': [{
+            'method': 'upload',
+            'if_not_exists': False,
+            'args': {'destination_path': 'stage2', 'blob': b'stage2'}}]}
+
+    with pytest.raises(subprocess.CalledProcessError):
+        release.apply_storage_commands({'local': provider}, commands)
+    assert not provider.exists('stage2')
+
+
 def test_get_gen_package_artifact(tmpdir):
     assert release.get_gen_package_artifact('foo--test') == {
         'reproducible_path': 'packages/foo/foo--test.tar.xz',
@@ -467,6 +828,46 @@ def test_get_package_artifact(tmpdir):
     }
 
 
+def test_get_package_delta_artifact():
+    assert release.get_package_delta_artifact('foo--1', 'foo--2') == {
+        'reproducible_path': 'packages/foo/foo--2.delta-from-1.tar.xz',
+        'local_path': 'packages/cache/packages/foo/foo--2.delta-from-1.tar.xz'
+    }
+
+
+def test_make_delta_artifacts(monkeypatch, tmpdir):
+    monkeypatch.chdir(str(tmpdir))
+    unchanged = os.urandom(128 * 1024)
+
+    def make_package(package_id, contents):
+        package_dir = str(tmpdir.join('src', package_id))
+        os.makedirs(package_dir)
+        with open(os.path.join(package_dir, 'unchanged'), 'wb') as f:
+            f.write(unchanged)
+        write_string(os.path.join(package_dir, 'changed'), contents)
+        local_path = release.get_package_artifact(package_id)['local_path']
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        subprocess.check_call(['tar', '-cJf', local_path, '-C', package_dir, '.'])
+
+    make_package('foo--2', 'new')
+    make_package('bar--1', 'bar')
+
+    fetched = []
+
+    def fetch_package(package_id):
+        fetched.append(package_id)
+        make_package(package_id, 'old')
+
+    artifacts = release.make_delta_artifacts(['bar--1', 'foo--2'], ['bar--1', 'baz--1', 'foo--1'], fetch_package)
+    assert artifacts == [release.get_package_delta_artifact('foo--1', 'foo--2')]
+    assert fetched == ['foo--1']
+    assert os.path.getsize(artifacts[0]['local_path']) < 64 * 1024
+
+    # Existing deltas are reused rather than remade.
+    assert release.make_delta_artifacts(['foo--2'], ['foo--1'], fetch_package) == artifacts
+    assert fetched == ['foo--1']
+
+
 def mock_do_build_packages(cache_repository_url):
     subprocess.check_call(['mkdir', '-p', 'packages/cache/bootstrap'])
     write_string("packages/cache/bootstrap/bootstrap_id.bootstrap.tar.xz", "bootstrap_contents")
@@ -661,6 +1062,18 @@ def test_make_channel_artifacts(monkeypatch):
         assert 'local_path' in artifact or 'local_content' in artifact
         assert 'reproducible_path' in artifact or 'channel_path' in artifact
 
+    # Building the providers in parallel gives the same artifacts in the same order.
+    assert release.make_channel_artifacts(metadata, max_workers=1) == channel_artifacts
+
+    # Building providers in parts gives the same artifacts as building them whole.
+    def artifact_key(artifact):
+        return artifact.get('channel_path') or artifact['reproducible_path']
+
+    whole = []
+    for name in release.provider_names:
+        whole += release.make_provider_artifacts(name, metadata)
+    assert sorted(whole, key=artifact_key) == sorted(channel_artifacts, key=artifact_key)
+
 
 def test_make_abs():
     assert release.make_abs("/foo") == '/foo'
@@ -92,6 +92,7 @@ setup(
             'azure/templates/azure.html',
             'azure/templates/azuredeploy.json',
             'build_deploy/bash/dcos_generate_config.sh.in',
+            'build_deploy/bash/Dockerfile.base',
             'build_deploy/bash/Dockerfile.in',
             'build_deploy/bash/installer_internal_wrapper.in',
             'build_deploy/bash/dcos-launch.spec',